@@ -0,0 +1,866 @@
+"""
+File: benchmarks.py
+
+Description: Benchmarks for the granulation tools. Run `python benchmarks.py` to run all
+benchmarks, or `python benchmarks.py <name> [<name> ...]` to run specific benchmarks.
+"""
+
+import feature_index
+import grain_bank
+import grain_features
+import grain_assembler
+import grain_sql
+import grain_tools
+import grain_transforms
+from grain_table import GrainTable
+import ingest
+import migrate
+import numpy as np
+import os
+import path_index
+import query_cache
+import render_interpolator
+import scipy.io.wavfile
+import shutil
+import source_cache
+import sqlite3
+import sys
+import tempfile
+import time
+
+
+def _make_grains(num_grains: int, grain_length: int, num_channels: int, num_unique: int = 100, seed: int = 0) -> list:
+    """
+    Makes a list of grain dictionaries for benchmarking. The grain audio is drawn from a small
+    set of unique grains, like the output of `grain_assembler.assemble_repeat`.
+    :param num_grains: The number of grains
+    :param grain_length: The length of each grain
+    :param num_channels: The number of channels
+    :param num_unique: The number of unique grain arrays
+    :param seed: The random seed
+    :return: A list of grain dictionaries with calculated positions
+    """
+    rng = np.random.default_rng(seed)
+    bank = [rng.uniform(-1, 1, grain_length) for _ in range(num_unique)]
+    ids = rng.integers(0, num_unique, num_grains)
+    distances = rng.integers(-grain_length * 3 // 4 - 40, -grain_length * 3 // 4 + 40, num_grains)
+    grains = [{
+        "grain": bank[ids[i]],
+        "channel": (i + 1) % num_channels,
+        "distance_between_grains": int(distances[i])
+    } for i in range(num_grains)]
+    grain_assembler.calculate_grain_positions(grains)
+    return grains
+
+
+def _merge_grain_python(audio: np.ndarray, grain: np.ndarray, start_idx: int, end_idx: int, channel: int):
+    """
+    The original `grain_tools.merge_grain`, which adds one sample at a time. This is the loop that runs
+    when grain_tools is not compiled.
+    :param audio: The audio array
+    :param grain: The grain
+    :param start_idx: The start index for merging
+    :param end_idx: The end index for merging
+    :param channel: The channel in which to merge
+    """
+    j = 0
+    if channel == 0 and audio.ndim == 1:
+        for i in range(start_idx, end_idx):
+            audio[i] += grain[j]
+            j += 1
+    else:
+        for i in range(start_idx, end_idx):
+            audio[channel, i] += grain[j]
+            j += 1
+
+
+def _merge_loop(grains: list, num_channels: int = 1, window_fn=np.hanning, merge_grain=_merge_grain_python) -> np.ndarray:
+    """
+    The per-grain merge loop that `grain_assembler.merge` used before it was batched. The window is
+    calculated for each grain, and each grain is added with a separate `merge_grain` call.
+    :param grains: A list of grain dictionaries
+    :param num_channels: The number of channels
+    :param window_fn: The window function
+    :param merge_grain: The function that adds one grain: `_merge_grain_python`, or the compiled `grain_tools.merge_grain`
+    :return: The merged array of grains
+    """
+    max_idx = max(grain["end_idx"] for grain in grains)
+    if num_channels > 1:
+        audio = np.zeros((num_channels, max_idx))
+    else:
+        audio = np.zeros((max_idx))
+    for grain in grains:
+        window = window_fn(grain["grain"].shape[-1])
+        merge_grain(audio, grain["grain"] * window, grain["start_idx"], grain["end_idx"], grain["channel"])
+    audio = np.nan_to_num(audio)
+    return audio
+
+
+def benchmark_merge(sizes=(10_000, 100_000, 1_000_000), grain_length: int = 512, num_channels: int = 2, max_python_grains: int = 10_000):
+    """
+    Compares the batched `grain_assembler.merge` with the per-grain merge loop, with the original
+    Python `merge_grain` and (if grain_tools is compiled) the compiled `merge_grain`
+    :param sizes: The numbers of grains to merge
+    :param grain_length: The length of each grain
+    :param num_channels: The number of channels
+    :param max_python_grains: The Python loop adds one sample at a time, so it is only timed on this many grains,
+    and the time is scaled up to the number of grains (the loop time is linear in the number of grains)
+    """
+    loops = [("python", _merge_grain_python)]
+    if grain_tools.COMPILED:
+        loops.append(("compiled", grain_tools.merge_grain))
+    print(f"merge: grain length {grain_length}, {num_channels} channels")
+    for num_grains in sizes:
+        grains = _make_grains(num_grains, grain_length, num_channels)
+        start = time.perf_counter()
+        grain_assembler.merge(grains, num_channels)
+        batch_time = time.perf_counter() - start
+        results = []
+        for name, merge_grain in loops:
+            timed = grains[:max_python_grains] if name == "python" else grains
+            start = time.perf_counter()
+            _merge_loop(timed, num_channels, merge_grain=merge_grain)
+            loop_time = (time.perf_counter() - start) * len(grains) / len(timed)
+            estimated = f" (from {len(timed)} grains)" if len(timed) < len(grains) else ""
+            results.append(f"{name} loop {loop_time:8.3f} s{estimated}, speedup {loop_time / batch_time:6.1f}x")
+        print(f"{num_grains:>10} grains: batched {batch_time:8.3f} s; " + "; ".join(results))
+
+
+def _interleave_loop(list1, list2):
+    """
+    The list-slicing version of `grain_assembler.interleave`, from before it calculated an index array
+    :param list1: A list
+    :param list2: A list
+    :return: A combined list
+    """
+    # Determine which list is larger and which is smaller. Also determine the size ratio between the two lists.
+    if len(list1) < len(list2):
+        larger_list = list2
+        smaller_list = list1
+    else:
+        larger_list = list1
+        smaller_list = list2
+    ideal_ratio = len(larger_list) / len(smaller_list)
+
+    # The number added from each list
+    list1_num_added = 0
+    list2_num_added = 0
+
+    combined_list = []
+
+    # Add the first batch
+    batch_size_1 = round(ideal_ratio)
+    batch_size_2 = 1
+    combined_list += list1[:batch_size_1]
+    combined_list += list2[:batch_size_2]
+    list1_num_added += batch_size_1
+    list2_num_added += batch_size_2
+
+    # Add until one or both lists are exhausted
+    while list1_num_added < len(larger_list) and list2_num_added < len(smaller_list):
+        # Fiddle with the number of items to add from each list
+        temp_batch_size_1 = batch_size_1
+        temp_batch_size_2 = batch_size_2
+        current_ratio = list1_num_added / list2_num_added
+        if current_ratio < ideal_ratio:
+            temp_batch_size_1 += 1
+        elif current_ratio > ideal_ratio:
+            temp_batch_size_2 += 1
+        temp_batch_size_1 = min(temp_batch_size_1, len(list1) - list1_num_added)
+        temp_batch_size_2 = min(temp_batch_size_2, len(list2) - list2_num_added)
+
+        # Add this batch of items
+        combined_list += list1[list1_num_added:list1_num_added+temp_batch_size_1]
+        combined_list += list2[list2_num_added:list2_num_added+temp_batch_size_2]
+        list1_num_added += temp_batch_size_1
+        list2_num_added += temp_batch_size_2
+    
+    # Add any remaining items
+    combined_list += list1[list1_num_added:]
+    combined_list += list2[list2_num_added:]
+
+    return combined_list
+
+
+def _interpolate_loop(grains1, grains2, interpolations=None):
+    """
+    The list-slicing version of `grain_assembler.interpolate`, from before it calculated an index array
+    :param grains1: A list of grains
+    :param grains2: A list of grains
+    :param interpolations: The number of interpolation chunk pairs. If None, will be determined automatically.
+    This parameter can be adjusted to change the smoothness of interpolation.
+    :return: An interpolated grains list
+    """
+    if interpolations is None:
+        smaller_area = min(len(grains1), len(grains2))
+        interpolations = int(np.ceil(np.sqrt(smaller_area * 2)))
+    
+    # Calculate the slope for linear interpolation
+    height1 = 2 * len(grains1) / interpolations
+    height2 = 2 * len(grains2) / interpolations
+    slope1 = -height1 / interpolations
+    slope2 = height2 / interpolations
+
+    # Generate the lists of alternating grains
+    grains1_new = []
+    grains2_new = []
+    start1 = 0
+    start2 = 0
+    for i in range(interpolations):
+        new1 = slope1 * i + height1
+        new2 = slope2 * i
+        end1 = int(min(start1 + new1, len(grains1)))
+        end2 = int(min(start2 + new2, len(grains2)))
+        grains1_new.append(grains1[start1:end1])
+        grains2_new.append(grains2[start2:end2])
+        start1 = end1
+        start2 = end2
+    i = 0
+
+    # If any grains remain, pad the existing lists
+    while start1 < len(grains1):
+        grains1_new[i].append(grains1[start1])
+        i = (i + 1) % len(grains1_new)
+        start1 += 1
+    i = 0
+    while start2 < len(grains2):
+        grains2_new[i].append(grains2[start2])
+        i = (i + 1) % len(grains2_new)
+        start2 += 1
+
+    # Merge the grains
+    newgrains = []
+    for i in range(len(grains1_new)):
+        if len(grains1_new[i]) > 0 and len(grains2_new[i]) > 0:
+            newgrains += _interleave_loop(grains1_new[i], grains2_new[i])
+        else:
+            newgrains += grains1_new[i] + grains2_new[i]
+    
+    return newgrains
+
+
+def benchmark_interpolate(sizes=(10_000, 100_000, 1_000_000)):
+    """
+    Compares the index-array `grain_assembler.interleave` and `grain_assembler.interpolate`
+    with the list-slicing versions (test_grain_assembler.py checks that the grain order is the same)
+    :param sizes: The numbers of grains in each list
+    """
+    rng = np.random.default_rng(0)
+    for num_grains in sizes:
+        for name, loop_fn, fn in (("interleave", _interleave_loop, grain_assembler.interleave),
+                                  ("interpolate", _interpolate_loop, grain_assembler.interpolate)):
+            list1 = list(range(num_grains))
+            list2 = list(range(num_grains, num_grains + int(num_grains * rng.uniform(0.3, 0.9))))
+            start = time.perf_counter()
+            loop_fn(list1, list2)
+            loop_time = time.perf_counter() - start
+            start = time.perf_counter()
+            fn(list1, list2)
+            list_time = time.perf_counter() - start
+            table1 = GrainTable([], np.array(list1))
+            table2 = GrainTable([], np.array(list2))
+            start = time.perf_counter()
+            fn(table1, table2)
+            table_time = time.perf_counter() - start
+            print(f"{name:>11}: {num_grains:>8} + {len(list2):>8} grains: loop {loop_time:8.3f} s, index array {list_time:8.3f} s "
+                  f"(GrainTable {table_time:8.3f} s), speedup {loop_time / list_time:6.1f}x")
+
+
+def _transform_loops(grains: list, swaps: np.ndarray, deviations: np.ndarray, n: int, m: int, delete: bool = True):
+    """
+    The list loops that the grain_assembler transforms used before they calculated index arrays. The random
+    swaps and deviations are passed in, so the result can be compared with `grain_transforms`.
+    :param grains: A list of grain dictionaries, which is changed in place
+    :param swaps: Whether to swap each adjacent pair (in order)
+    :param deviations: The deviation of each grain's distance_between_grains
+    :param n: Every nth grain is deleted, and every nth pair is swapped
+    :param m: The distance between the grains in each swapped pair
+    :param delete: Whether to delete grains. This loop is quadratic, so it is too slow for large lists.
+    """
+    for i in range(0, len(grains)-m, n):
+        temp = grains[i+m]
+        grains[i+m] = grains[i]
+        grains[i] = temp
+    for i in range(len(grains)-1):
+        if swaps[i]:
+            temp = grains[i+1]
+            grains[i+1] = grains[i]
+            grains[i] = temp
+    for grain, deviation in zip(grains, deviations):
+        grain["distance_between_grains"] += int(deviation)
+    if delete:
+        i = n
+        while i < len(grains):
+            del grains[i]
+            i += n-1
+
+
+def benchmark_transforms(sizes=(10_000, 100_000, 1_000_000), n: int = 8, m: int = 3, prob: float = 0.1, seed: int = 0,
+                         max_delete_loop: int = 100_000):
+    """
+    Compares the `grain_transforms` functions with the list loops, on lists of grain dictionaries and on GrainTables
+    (test_grain_transforms.py checks that the results are the same)
+    :param sizes: The numbers of grains
+    :param n: Every nth grain is deleted, and every nth pair is swapped
+    :param m: The distance between the grains in each swapped pair
+    :param prob: The probability of swapping each adjacent pair
+    :param seed: The random seed
+    :param max_delete_loop: The largest list to delete grains from with the quadratic loop
+    """
+    for num_grains in sizes:
+        grains = [{"grain": i, "channel": 0, "distance_between_grains": 0} for i in range(num_grains)]
+        rng = np.random.default_rng(seed)
+        swaps = rng.random(num_grains - 1) < prob
+        deviations = rng.integers(-40, 41, num_grains)
+        expected = [dict(grain) for grain in grains]
+        delete = num_grains <= max_delete_loop
+        start = time.perf_counter()
+        _transform_loops(expected, swaps, deviations, n, m, delete)
+        loop_time = time.perf_counter() - start
+
+        # The transforms draw from one generator, in the same order as above
+        rng = np.random.default_rng(seed)
+        table = GrainTable([], np.arange(num_grains))
+        times = []
+        for sequence in (grains, table):
+            start = time.perf_counter()
+            grain_transforms.swap_nth_m_pair(sequence, n, m)
+            grain_transforms.swap_random_pair(sequence, prob, rng)
+            grain_transforms.randomize_param(sequence, "distance_between_grains", 40, rng=rng)
+            if delete:
+                grain_transforms.delete_nth_grains(sequence, n)
+            times.append(time.perf_counter() - start)
+            rng = np.random.default_rng(seed)
+        print(f"transforms: {num_grains:>8} grains{' (no deletion)' if not delete else '':>14}: loop {loop_time:8.3f} s, "
+              f"list {times[0]:8.3f} s, GrainTable {times[1]:8.3f} s")
+
+
+def _make_grain_db(path: str, num_rows: int, seed: int = 0):
+    """
+    Makes a synthetic grain database with the original (version 0) schema, which has
+    no length or energy columns and no indexes
+    :param path: The database path
+    :param num_rows: The number of grain rows
+    :param seed: The random seed
+    """
+    rng = np.random.default_rng(seed)
+    table = "\n".join(line for line in migrate.GRAINS_TABLE.format(name="grains").split("\n") if "length" not in line and "energy" not in line)
+    db = sqlite3.connect(path)
+    cursor = db.cursor()
+    cursor.execute(table)
+    batch_size = 100_000
+    for batch_start in range(0, num_rows, batch_size):
+        n = min(batch_size, num_rows - batch_start)
+        length = rng.choice([2048, 4096, 8192, 16384], n)
+        start_frame = rng.integers(0, 44100 * 60, n)
+        pitched = rng.random(n) < 0.5
+        frequency = np.where(pitched, rng.uniform(27.5, 4186, n), np.nan)
+        midi = np.where(pitched, 69 + 12 * np.log2(frequency / 440), np.nan)
+        flatness = rng.beta(0.7, 3, n)
+        roll_offs = np.sort(rng.uniform(20, 8000, (n, 4)), axis=-1)
+        other = rng.standard_normal((n, 9))
+        rows = []
+        for i in range(n):
+            rows.append((f"/samples/file_{rng.integers(0, 5000)}.wav", int(start_frame[i]), int(start_frame[i] + length[i]), 44100, length[i] / 44100,
+                         None if np.isnan(frequency[i]) else float(frequency[i]), None if np.isnan(midi[i]) else float(midi[i]),
+                         float(other[i, 0]), float(other[i, 1]), float(flatness[i]), float(other[i, 2]), *roll_offs[i].tolist(), *other[i, 3:].tolist()))
+        cursor.executemany("INSERT INTO grains VALUES(NULL, " + "?, " * 20 + "?)", rows)
+        db.commit()
+    db.close()
+
+
+def benchmark_schema(num_rows: int = 1_000_000, repeats: int = 5):
+    """
+    Measures the latency of the common grain queries on a synthetic database,
+    before and after the feature indexes are added by migrate.py
+    :param num_rows: The number of grain rows
+    :param repeats: The number of times to run each query (the median time is reported)
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "grains.sqlite3")
+        print(f"schema: making a synthetic database with {num_rows} rows")
+        _make_grain_db(path, num_rows)
+        db = sqlite3.connect(path)
+        cursor = db.cursor()
+        for version in range(1, len(migrate.MIGRATIONS) + 1):
+            migrate.migrate(db, cursor, version)
+            for i, query in enumerate(migrate.QUERIES):
+                times = []
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    cursor.execute(query)
+                    num_results = len(cursor.fetchall())
+                    times.append(time.perf_counter() - start)
+                plan = migrate.explain(cursor, query)
+                print(f"version {version}, query {i}: {np.median(times) * 1000:9.2f} ms, {num_results:>7} rows, plan: {' / '.join(plan)}")
+        db.close()
+
+
+def benchmark_files(num_rows: int = 1_000_000):
+    """
+    Compares the grain database before and after the file paths are moved to the files table
+    (schema version 2 and 3): the database size, and the time to move the library to a new root
+    directory with one UPDATE per grain and with `grain_sql.update_grain_root`
+    :param num_rows: The number of grain rows in the synthetic database
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "grains.sqlite3")
+        normalized_path = os.path.join(temp_dir, "grains_normalized.sqlite3")
+        print(f"files: making a synthetic database with {num_rows} rows")
+        _make_grain_db(path, num_rows)
+        db = sqlite3.connect(path)
+        cursor = db.cursor()
+        migrate.migrate(db, cursor, 2)
+        db.close()
+        shutil.copyfile(path, normalized_path)
+        normalized_db = sqlite3.connect(normalized_path)
+        normalized_cursor = normalized_db.cursor()
+        migrate.migrate(normalized_db, normalized_cursor)
+        db = sqlite3.connect(path)
+        db.execute("VACUUM;")
+        db.close()
+        normalized_db.execute("VACUUM;")
+        sizes = [os.path.getsize(path), os.path.getsize(normalized_path)]
+
+        # Move the library with one UPDATE per grain (the grain_sql.update_grain_root of schema version 2)
+        db = sqlite3.connect(path)
+        cursor = db.cursor()
+        start = time.perf_counter()
+        cursor.execute("SELECT id, file FROM grains WHERE file LIKE ? OR file LIKE ?;", ("%samples/%", "%samples\\%"))
+        records = [(os.path.join("/new/samples", file.replace("\\", "/").split("samples/")[1]), grain_id) for grain_id, file in cursor.fetchall()]
+        cursor.executemany("UPDATE grains SET file = ? WHERE id = ?;", records)
+        db.commit()
+        per_grain_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        grain_sql.update_grain_root(normalized_cursor, "samples", "/new/samples")
+        normalized_db.commit()
+        normalized_time = time.perf_counter() - start
+
+        normalized_cursor.execute("SELECT COUNT(*) FROM files;")
+        num_files = normalized_cursor.fetchone()[0]
+        db.close()
+        normalized_db.close()
+    print(f"{num_rows:>10} grains, {num_files} files: size {sizes[0] / 2 ** 20:.0f} MiB -> {sizes[1] / 2 ** 20:.0f} MiB, "
+          f"move library {per_grain_time:8.3f} s -> {normalized_time:8.3f} s ({per_grain_time / max(normalized_time, 1e-9):.0f}x)")
+
+
+def benchmark_categories(num_rows: int = 1_000_000, num_categories: int = 14):
+    """
+    Compares loading grain categories as one dictionary per row (one query per category)
+    with `grain_sql.select_categories`
+    :param num_rows: The number of grain rows in the synthetic database
+    :param num_categories: The number of categories
+    """
+    predicates = []
+    for i in range(num_categories):
+        if i % 2 == 0:
+            predicates.append(f"(length = 8192) AND (spectral_flatness BETWEEN 0.00 AND 0.05) AND (spectral_roll_off_75 BETWEEN {100 - 5 * i} AND {2000 + 400 * i}) AND (frequency IS NULL)")
+        else:
+            predicates.append(f"(length = 8192) AND (spectral_flatness BETWEEN {0.05 * i} AND {0.05 * i + 0.3}) AND (spectral_roll_off_75 BETWEEN 100 AND {2000 + 400 * i})")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "grains.sqlite3")
+        print(f"categories: making a synthetic database with {num_rows} rows")
+        _make_grain_db(path, num_rows)
+        db = sqlite3.connect(path)
+        cursor = db.cursor()
+        migrate.migrate(db, cursor)
+
+        start = time.perf_counter()
+        dict_categories = []
+        for predicate in predicates:
+            cursor.execute(f"SELECT * FROM grains WHERE {predicate};")
+            dict_categories.append([{grain_sql.FIELDS[j]: record[j] for j in range(len(record))} for record in cursor.fetchall()])
+        dict_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        categories = grain_sql.select_categories(cursor, predicates)
+        array_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        grain_sql.select_categories(cursor, predicates, grain_sql.RENDER_FIELDS)
+        render_time = time.perf_counter() - start
+        db.close()
+
+    num_records = sum(len(category) for category in categories)
+    dict_bytes = sum(sys.getsizeof(grain) + sum(sys.getsizeof(value) for value in grain.values() if type(value) != str) for category in dict_categories for grain in category)
+    array_bytes = sum(category.nbytes for category in categories)
+    print(f"{num_records:>10} records: dicts {dict_time:8.3f} s ({dict_bytes / 2 ** 20:.0f} MiB), arrays {array_time:8.3f} s ({array_bytes / 2 ** 20:.0f} MiB), "
+          f"arrays with RENDER_FIELDS {render_time:8.3f} s")
+
+
+def benchmark_paths(num_dirs: int = 200, files_per_dir: int = 50, num_lookups: int = 200):
+    """
+    Compares resolving grain file names by walking the source directories (`grain_sql.find_path`)
+    with the persistent file index (path_index.py)
+    :param num_dirs: The number of source directories
+    :param files_per_dir: The number of files in each directory
+    :param num_lookups: The number of distinct files to resolve
+    """
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        source_dir = os.path.join(temp_dir, "samples")
+        for i in range(num_dirs):
+            directory = os.path.join(source_dir, f"group_{i % 10}", f"dir_{i}")
+            os.makedirs(directory)
+            for j in range(files_per_dir):
+                open(os.path.join(directory, f"sample_{i}_{j}.wav"), "w").close()
+        print(f"paths: {num_dirs} directories, {num_dirs * files_per_dir} files, {num_lookups} lookups")
+        files = [f"C:\\old\\samples\\sample_{i}_{j}.wav" for i, j in zip(rng.integers(0, num_dirs, num_lookups), rng.integers(0, files_per_dir, num_lookups))]
+
+        start = time.perf_counter()
+        for file in files:
+            grain_sql.find_path(file, source_dir)
+        walk_time = time.perf_counter() - start
+
+        db_path = os.path.join(temp_dir, "grains.sqlite3")
+        start = time.perf_counter()
+        index = path_index.PathIndex(path_index.index_path_for(db_path))
+        index.refresh(source_dir)
+        build_time = time.perf_counter() - start
+        start = time.perf_counter()
+        index.refresh(source_dir)
+        refresh_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for file in files:
+            grain_sql.find_path(file, index)
+        lookup_time = time.perf_counter() - start
+        index.close()
+    print(f"walk {walk_time:8.3f} s, index build {build_time:8.3f} s, refresh {refresh_time:8.3f} s, lookups {lookup_time:8.5f} s")
+
+
+def benchmark_features(num_rows: int = 1_000_000, num_targets: int = 14, k: int = 500):
+    """
+    Compares selecting grains with the nearest-neighbour feature index (feature_index.py)
+    with a range query over the same features
+    :param num_rows: The number of grain rows in the synthetic database
+    :param num_targets: The number of target feature vectors in the trajectory
+    :param k: The number of grains to select for each target
+    """
+    targets = np.stack((np.linspace(0.01, 0.5, num_targets), np.linspace(150, 1400, num_targets)), axis=-1)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "grains.sqlite3")
+        print(f"features: making a synthetic database with {num_rows} rows")
+        _make_grain_db(path, num_rows)
+        db = sqlite3.connect(path)
+        cursor = db.cursor()
+        migrate.migrate(db, cursor)
+        db.close()
+
+        start = time.perf_counter()
+        index = feature_index.load_feature_index(path, where="length = 8192")
+        build_time = time.perf_counter() - start
+        start = time.perf_counter()
+        index = feature_index.load_feature_index(path, where="length = 8192")
+        load_time = time.perf_counter() - start
+
+        db = sqlite3.connect(path)
+        cursor = db.cursor()
+        start = time.perf_counter()
+        for flatness, roll_off in targets:
+            cursor.execute(f"""SELECT id FROM grains WHERE (length = 8192) AND (spectral_flatness BETWEEN {flatness - 0.02} AND {flatness + 0.02})
+                           AND (spectral_roll_off_75 BETWEEN {roll_off - 50} AND {roll_off + 50});""")
+            cursor.fetchall()
+        sql_time = time.perf_counter() - start
+        db.close()
+
+    start = time.perf_counter()
+    index.query(targets, k)
+    query_time = time.perf_counter() - start
+    start = time.perf_counter()
+    index.query_radius(targets, 0.05)
+    radius_time = time.perf_counter() - start
+    print(f"{len(index):>10} grains: build {build_time:8.3f} s, load {load_time:8.3f} s, range queries {sql_time:8.4f} s, "
+          f"kNN queries {query_time:8.4f} s, radius queries {radius_time:8.4f} s")
+
+
+def _make_audio_files(directory: str, num_files: int, seconds: float, sample_rate: int = 44100, seed: int = 0):
+    """
+    Writes synthetic audio files (pitched tones, some with noise) for the analysis benchmarks
+    :param directory: The output directory
+    :param num_files: The number of files
+    :param seconds: The length of each file
+    :param sample_rate: The sample rate
+    :param seed: The random seed
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    for i in range(num_files):
+        audio = 0.5 * np.sin(2 * np.pi * rng.uniform(50, 1000) * t) + rng.uniform(0, 0.5) * rng.standard_normal(t.shape)
+        scipy.io.wavfile.write(os.path.join(directory, f"file_{i}.wav"), sample_rate, audio.astype(np.float32))
+
+
+def benchmark_ingest(num_files: int = 8, seconds: float = 10):
+    """
+    Measures the ingestion throughput (ingest.py) with one worker process and with one per CPU
+    :param num_files: The number of audio files
+    :param seconds: The length of each file
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        source_dir = os.path.join(temp_dir, "samples")
+        os.makedirs(source_dir)
+        _make_audio_files(source_dir, num_files, seconds)
+        print(f"ingest: {num_files} files of {seconds} s")
+        for num_workers in sorted(set([1, os.cpu_count()])):
+            db_path = os.path.join(temp_dir, f"grains_{num_workers}.sqlite3")
+            stats = ingest.ingest(db_path, source_dir, num_workers=num_workers)
+            print(f"{num_workers:>3} workers: {stats['grains']} grains in {stats['seconds']:8.3f} s, {stats['grains'] / stats['seconds']:8.0f} grains/s")
+
+
+def benchmark_grain_features(seconds: float = 30, grain_lengths=(2048, 8192), sample_rate: int = 44100):
+    """
+    Compares the batched feature kernel (`grain_features.analyze_file_grains`) with analyzing each grain separately
+    :param seconds: The length of the audio
+    :param grain_lengths: The grain lengths
+    :param sample_rate: The sample rate
+    """
+    rng = np.random.default_rng(0)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    samples = 0.5 * np.sin(2 * np.pi * 220 * t) * (t < seconds / 2) + 0.2 * rng.standard_normal(t.shape) * (t > seconds / 3)
+    print(f"grain features: {seconds} s of audio")
+    for grain_length in grain_lengths:
+        hop = grain_length // 2
+        start = time.perf_counter()
+        for grain_start in grain_features.slice_grains(samples.shape[-1], grain_length, hop):
+            grain_features.analyze_grain(samples[grain_start:grain_start + grain_length], sample_rate)
+        loop_time = time.perf_counter() - start
+        start = time.perf_counter()
+        starts, features = grain_features.analyze_file_grains(samples, sample_rate, grain_length, hop)
+        batch_time = time.perf_counter() - start
+        print(f"{grain_length:>6} samples, {len(starts):>5} grains: per grain {len(starts) / loop_time:8.0f} grains/s, "
+              f"batched {len(starts) / batch_time:8.0f} grains/s, speedup {loop_time / batch_time:6.1f}x")
+
+
+def benchmark_bank(num_files: int = 8, seconds: float = 10, num_grains: int = 1400):
+    """
+    Compares realizing grains from the source audio files with realizing them from a packed grain bank (grain_bank.py)
+    :param num_files: The number of audio files
+    :param seconds: The length of each file
+    :param num_grains: The number of grains to realize
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        source_dir = os.path.join(temp_dir, "samples")
+        os.makedirs(source_dir)
+        _make_audio_files(source_dir, num_files, seconds)
+        db_path = os.path.join(temp_dir, "grains.sqlite3")
+        ingest.ingest(db_path, source_dir, grain_lengths=[8192])
+        db, cursor = grain_sql.connect_to_db(db_path)
+        start = time.perf_counter()
+        bank = grain_bank.export_grain_bank(cursor, os.path.join(temp_dir, "grains.bank"), source_dir)
+        export_time = time.perf_counter() - start
+        records = grain_sql.select_categories(cursor, ["1"], grain_sql.RENDER_FIELDS)[0]
+        db.close()
+        selection = np.random.default_rng(0).integers(0, len(records), num_grains)
+        print(f"bank: {len(bank)} grains exported in {export_time:.3f} s, {num_grains} grains realized")
+
+        start = time.perf_counter()
+        grain_sql.realize_grains(grain_sql.record_dicts(records, selection), source_dir)
+        file_time = time.perf_counter() - start
+        start = time.perf_counter()
+        bank = grain_bank.GrainBank(os.path.join(temp_dir, "grains.bank"))
+        grains = grain_sql.realize_grains(grain_sql.record_dicts(records, selection), source_dir, bank=bank)
+        bank_time = time.perf_counter() - start
+        del bank, grains
+    print(f"source files {file_time:8.3f} s, grain bank {bank_time:8.3f} s, speedup {file_time / bank_time:6.1f}x")
+
+
+class _SlowSourceCache(source_cache.SourceCache):
+    """
+    A SourceCache that waits before each file is decoded, like a spinning disk or a network drive
+    """
+    def __init__(self, latency: float):
+        super().__init__(0)
+        self.latency = latency
+
+    def get(self, file: str, ranges: list, load) -> list:
+        def slow_load():
+            time.sleep(self.latency)
+            return load()
+        return super().get(file, ranges, slow_load)
+
+
+def benchmark_prefetch(num_files: int = 28, seconds: float = 10, num_categories: int = 14, latency: float = 0.05):
+    """
+    Compares rendering with the categories realized one at a time and with the next categories
+    prefetched in the background (`render_interpolator.realize_categories`), with simulated file latency
+    :param num_files: The number of audio files
+    :param seconds: The length of each file
+    :param num_categories: The number of grain categories
+    :param latency: The simulated latency of each file read, in seconds
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        source_dir = os.path.join(temp_dir, "samples")
+        os.makedirs(source_dir)
+        _make_audio_files(source_dir, num_files, seconds)
+        db_path = os.path.join(temp_dir, "grains.sqlite3")
+        ingest.ingest(db_path, source_dir, grain_lengths=[8192])
+        db, cursor = grain_sql.connect_to_db(db_path)
+        predicates = [f"file_id % {num_categories} = {i}" for i in range(num_categories)]
+        categories = grain_sql.select_categories(cursor, predicates, grain_sql.RENDER_FIELDS)
+        db.close()
+
+        times = []
+        for prefetch in (0, 2):
+            start = time.perf_counter()
+            render_interpolator.render(categories, 30, 4, -4050, 2, source_dir, temp_dir, f"prefetch_{prefetch}.wav",
+                                       block_size=44100 * 10, cache=_SlowSourceCache(latency), seed=0, prefetch=prefetch)
+            times.append(time.perf_counter() - start)
+    print(f"prefetch: {num_categories} categories, {latency * 1000:.0f} ms per file read: "
+          f"in order {times[0]:8.3f} s, prefetch {times[1]:8.3f} s, speedup {times[0] / times[1]:6.2f}x")
+
+
+def benchmark_sampling(num_rows: int = 1_000_000, k: int = 100, repeats: int = 5):
+    """
+    Compares drawing k random grains from a category after retrieving the whole category (as `render` does)
+    with drawing them in SQLite with `grain_sql.sample_grains`
+    :param num_rows: The number of grain rows in the synthetic database
+    :param k: The number of grains to draw from each category
+    :param repeats: The number of times to draw from each category (the median time is reported)
+    """
+    predicates = [
+        "length = 8192",
+        "(length = 8192) AND (spectral_flatness BETWEEN 0.1 AND 0.3) AND (spectral_roll_off_75 BETWEEN 100 AND 6000)",
+        "(length = 8192) AND (spectral_flatness BETWEEN 0.00 AND 0.05) AND (spectral_roll_off_75 BETWEEN 100 AND 2000) AND (frequency IS NULL)",
+        "(length = 8192) AND (spectral_flatness BETWEEN 0.00 AND 0.05) AND (midi BETWEEN 68.8 AND 69.2)",
+    ]
+    exclude = ["file LIKE '%file_1%'"]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "grains.sqlite3")
+        print(f"sampling: making a synthetic database with {num_rows} rows")
+        _make_grain_db(path, num_rows)
+        db = sqlite3.connect(path)
+        cursor = db.cursor()
+        migrate.migrate(db, cursor)
+        for i, predicate in enumerate(predicates):
+            full_times = []
+            sample_times = []
+            for seed in range(repeats):
+                start = time.perf_counter()
+                category = grain_sql.select_categories(cursor, [f"({predicate}) AND NOT ({exclude[0]})"], grain_sql.RENDER_FIELDS)[0]
+                category[np.random.default_rng(seed).choice(len(category), min(k, len(category)), replace=False)]
+                full_times.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                grain_sql.sample_grains(cursor, predicate, k, seed, exclude)
+                sample_times.append(time.perf_counter() - start)
+            print(f"category {i}: {len(category):>7} grains, whole category {np.median(full_times) * 1000:9.2f} ms, "
+                  f"sample_grains {np.median(sample_times) * 1000:9.2f} ms")
+        db.close()
+
+
+def benchmark_query_cache(num_rows: int = 1_000_000, num_categories: int = 14):
+    """
+    Compares loading grain categories from SQLite with loading them from the query cache (query_cache.py)
+    :param num_rows: The number of grain rows in the synthetic database
+    :param num_categories: The number of categories
+    """
+    predicates = [f"(length = 8192) AND (spectral_flatness BETWEEN {0.02 * i} AND {0.02 * i + 0.1}) AND (spectral_roll_off_75 BETWEEN 100 AND 6000)"
+                  for i in range(num_categories)]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "grains.sqlite3")
+        print(f"query_cache: making a synthetic database with {num_rows} rows")
+        _make_grain_db(path, num_rows)
+        db = sqlite3.connect(path)
+        cursor = db.cursor()
+        migrate.migrate(db, cursor)
+        db.close()
+
+        times = []
+        for _ in range(3):
+            # A new connection and cache each time, like a new run of render_interpolator.py
+            db, cursor = grain_sql.connect_to_db(path)
+            cache = query_cache.QueryCache(query_cache.cache_dir_for(path))
+            start = time.perf_counter()
+            grain_sql.select_categories(cursor, predicates, grain_sql.RENDER_FIELDS, cache=cache)
+            times.append(time.perf_counter() - start)
+            db.close()
+        start = time.perf_counter()
+        db, cursor = grain_sql.connect_to_db(path)
+        expected = grain_sql.select_categories(cursor, predicates, grain_sql.RENDER_FIELDS)
+        uncached_time = time.perf_counter() - start
+        db.close()
+    num_records = sum(len(category) for category in expected)
+    print(f"{num_records:>10} records: no cache {uncached_time:8.3f} s, cold cache {times[0]:8.3f} s, "
+          f"warm cache {times[1] * 1000:8.2f} ms, {times[2] * 1000:8.2f} ms")
+
+
+def benchmark_crossfade(num_sections: int = 50, seconds: float = 1, num_channels: int = 2, merge_fraction: float = 0.5):
+    """
+    Compares `grain_assembler.merge_crossfade` with calling `grain_tools.crossfade` once per section
+    :param num_sections: The number of sections to join
+    :param seconds: The average length of each section
+    :param num_channels: The number of channels
+    :param merge_fraction: The overlap fraction
+    """
+    rng = np.random.default_rng(0)
+    sections = [rng.uniform(-1, 1, (num_channels, int(44100 * seconds * rng.uniform(0.5, 1.5)))) for _ in range(num_sections)]
+    start = time.perf_counter()
+    expected = sections[0]
+    for section in sections[1:]:
+        expected = grain_tools.crossfade(expected, section, merge_fraction)
+    pairwise_time = time.perf_counter() - start
+    start = time.perf_counter()
+    audio = grain_assembler.merge_crossfade(sections, merge_fraction)
+    sections_time = time.perf_counter() - start
+    print(f"crossfade: {num_sections} sections, {audio.shape[-1]} frames, {num_channels} channels: "
+          f"pairwise {pairwise_time:8.3f} s, merge_crossfade {sections_time:8.3f} s, speedup {pairwise_time / sections_time:6.1f}x")
+
+
+def benchmark_grain_tools(num_grains: int = 100_000, grain_length: int = 512, num_sections: int = 200, seconds: float = 1):
+    """
+    Compares the NumPy, compiled single-thread and compiled multithreaded versions of the `grain_tools`
+    overlap-add and crossfade. The compiled versions are only available after building grain_tools
+    (`python setup.py build_ext --inplace`).
+    :param num_grains: The number of grains to overlap-add
+    :param grain_length: The grain length
+    :param num_sections: The number of sections to crossfade
+    :param seconds: The average length of each section
+    """
+    rng = np.random.default_rng(0)
+    grains = rng.uniform(-1, 1, (num_grains, grain_length))
+    start_indices = np.sort(rng.integers(0, num_grains * grain_length // 8, num_grains))
+    length = int(start_indices.max()) + grain_length
+    backends = {"numpy": lambda audio: grain_tools._merge_grains_numpy(audio, grains, start_indices)}
+    if grain_tools.COMPILED:
+        backends["compiled, 1 thread"] = lambda audio: grain_tools.merge_grains(audio, grains, start_indices, 1)
+        backends[f"compiled, {os.cpu_count()} CPUs"] = lambda audio: grain_tools.merge_grains(audio, grains, start_indices)
+    else:
+        print("grain_tools: not compiled, so only the NumPy versions are available")
+
+    for name, merge in backends.items():
+        audio = np.zeros((length))
+        start = time.perf_counter()
+        merge(audio)
+        elapsed = time.perf_counter() - start
+        print(f"grain_tools: merge {num_grains} grains of {grain_length} frames, {name:>20}: {elapsed:8.3f} s")
+
+    sections = [rng.uniform(-1, 1, (2, int(44100 * seconds * rng.uniform(0.5, 1.5)))) for _ in range(num_sections)]
+    start = time.perf_counter()
+    grain_tools.crossfade_sections(sections, 0.5)
+    elapsed = time.perf_counter() - start
+    print(f"grain_tools: crossfade {num_sections} sections, {'compiled' if grain_tools.COMPILED else 'numpy':>20}: {elapsed:8.3f} s")
+
+
+BENCHMARKS = {
+    "merge": benchmark_merge,
+    "crossfade": benchmark_crossfade,
+    "interpolate": benchmark_interpolate,
+    "transforms": benchmark_transforms,
+    "grain_tools": benchmark_grain_tools,
+    "schema": benchmark_schema,
+    "files": benchmark_files,
+    "categories": benchmark_categories,
+    "paths": benchmark_paths,
+    "features": benchmark_features,
+    "ingest": benchmark_ingest,
+    "grain_features": benchmark_grain_features,
+    "bank": benchmark_bank,
+    "prefetch": benchmark_prefetch,
+    "sampling": benchmark_sampling,
+    "query_cache": benchmark_query_cache,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] if len(sys.argv) > 1 else list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
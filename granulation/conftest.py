@@ -0,0 +1,49 @@
+"""
+File: conftest.py
+
+Description: Shared fixtures for the granulation tests. The synthetic databases and audio files
+are made once per test session, so tests that write to them should copy them first.
+"""
+
+from benchmarks import _make_audio_files, _make_grain_db
+import ingest
+import migrate
+import os
+import pytest
+import sqlite3
+
+
+# The number of grain rows in the synthetic grain database
+NUM_ROWS = 20_000
+# The number of synthetic audio files, and the length of each file in seconds
+NUM_FILES = 6
+SECONDS = 3
+
+
+@pytest.fixture(scope="session")
+def grain_db(tmp_path_factory) -> str:
+    """
+    A synthetic grain database (see `benchmarks._make_grain_db`), migrated to the latest schema version
+    :return: The database path
+    """
+    path = str(tmp_path_factory.mktemp("grain_db") / "grains.sqlite3")
+    _make_grain_db(path, NUM_ROWS)
+    db = sqlite3.connect(path)
+    migrate.migrate(db, db.cursor())
+    db.close()
+    return path
+
+
+@pytest.fixture(scope="session")
+def audio_library(tmp_path_factory) -> tuple:
+    """
+    Synthetic audio files (see `benchmarks._make_audio_files`), and a grain database of them with 8192-frame grains made by ingest.py
+    :return: The source directory and the database path
+    """
+    directory = tmp_path_factory.mktemp("audio_library")
+    source_dir = str(directory / "samples")
+    os.makedirs(source_dir)
+    _make_audio_files(source_dir, NUM_FILES, SECONDS)
+    db_path = str(directory / "grains.sqlite3")
+    ingest.ingest(db_path, source_dir, grain_lengths=[8192], num_workers=1)
+    return source_dir, db_path
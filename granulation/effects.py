@@ -1,7 +1,8 @@
 """
 File: effects.py
 
-This file contains audio effect definitions
+This file contains audio effect definitions. Each effect can be called on a single grain,
+or on a batch of equal-length grains (a 2D array with one grain per row) with `process_batch`.
 """
 
 import numpy as np
@@ -26,6 +27,7 @@ class AMEffect:
         self.muls = muls
         self.adds = adds
         self.sample_rate = sample_rate
+        self.mod_tables = {}
 
     def __call__(self, audio: np.ndarray) -> np.ndarray:
         """
@@ -33,13 +35,28 @@ class AMEffect:
         :param audio: The audio to apply the AM effect to
         :return: The modulated audio
         """
-        mod_arr = np.zeros((audio.shape[-1]))
-        for i in range(len(self.freqs)):
-            mod_arr += synthesis.sine(self.freqs[i], 0, audio.shape[-1], self.sample_rate)
-        if audio.ndim > 1:
-            mod_arr = mod_arr.reshape((1, mod_arr.shape[-1]))
-            mod_arr = mod_arr.repeat(audio.shape[0], 0)
-        return audio * mod_arr
+        return audio * self.mod_table(audio.shape[-1])
+
+    def process_batch(self, audio: np.ndarray) -> np.ndarray:
+        """
+        Applies the AM effect to a batch of grains. The modulation table is broadcast over the rows.
+        :param audio: A 2D array of grains, with shape (num_grains, grain_length)
+        :return: The modulated grains
+        """
+        return audio * self.mod_table(audio.shape[-1])
+
+    def mod_table(self, length: int) -> np.ndarray:
+        """
+        Gets the modulation table for a given length. Tables are cached by length.
+        :param length: The length of the table
+        :return: The modulation table
+        """
+        if length not in self.mod_tables:
+            mod_arr = np.zeros((length))
+            for i in range(len(self.freqs)):
+                mod_arr += synthesis.sine(self.freqs[i], 0, length, self.sample_rate)
+            self.mod_tables[length] = mod_arr
+        return self.mod_tables[length]
 
 
 class ButterworthFilterEffect:
@@ -68,6 +85,14 @@ class ButterworthFilterEffect:
         """
         return scipy.signal.sosfilt(self.filter, audio)
 
+    def process_batch(self, audio: np.ndarray) -> np.ndarray:
+        """
+        Applies the effect to a batch of grains in one call. Each row is filtered separately.
+        :param audio: A 2D array of grains, with shape (num_grains, grain_length)
+        :return: The new grains
+        """
+        return scipy.signal.sosfilt(self.filter, audio, axis=-1)
+
 
 class IdentityEffect:
     """
@@ -82,6 +107,13 @@ class IdentityEffect:
         :return: The audio
         """
         return audio
+
+    def process_batch(self, audio: np.ndarray) -> np.ndarray:
+        """
+        :param audio: A 2D array of grains
+        :return: The grains
+        """
+        return audio
     
 
 class CompressorEffect:
@@ -112,6 +144,21 @@ class CompressorEffect:
         """
         return self.compressor(audio, self.sample_rate)
 
+    @property
+    def plugin(self) -> pb.Plugin:
+        """
+        The pedalboard plugin for this effect
+        """
+        return self.compressor
+
+    def process_batch(self, audio: np.ndarray) -> np.ndarray:
+        """
+        Applies the effect to a batch of grains. The plugin state is reset for each row.
+        :param audio: A 2D array of grains, with shape (num_grains, grain_length)
+        :return: The new grains
+        """
+        return np.stack([self.compressor(grain, self.sample_rate) for grain in audio])
+
 
 class NoiseGateEffect:
     """
@@ -141,6 +188,21 @@ class NoiseGateEffect:
         """
         return self.noise_gate(audio, self.sample_rate)
 
+    @property
+    def plugin(self) -> pb.Plugin:
+        """
+        The pedalboard plugin for this effect
+        """
+        return self.noise_gate
+
+    def process_batch(self, audio: np.ndarray) -> np.ndarray:
+        """
+        Applies the effect to a batch of grains. The plugin state is reset for each row.
+        :param audio: A 2D array of grains, with shape (num_grains, grain_length)
+        :return: The new grains
+        """
+        return np.stack([self.noise_gate(grain, self.sample_rate) for grain in audio])
+
 
 class DelayEffect:
     """
@@ -168,6 +230,21 @@ class DelayEffect:
         """
         return self.delay(audio, self.sample_rate)
 
+    @property
+    def plugin(self) -> pb.Plugin:
+        """
+        The pedalboard plugin for this effect
+        """
+        return self.delay
+
+    def process_batch(self, audio: np.ndarray) -> np.ndarray:
+        """
+        Applies the effect to a batch of grains. The plugin state is reset for each row.
+        :param audio: A 2D array of grains, with shape (num_grains, grain_length)
+        :return: The new grains
+        """
+        return np.stack([self.delay(grain, self.sample_rate) for grain in audio])
+
 
 class ChorusEffect:
     """
@@ -198,3 +275,107 @@ class ChorusEffect:
         :return: The audio
         """
         return self.chorus(audio, self.sample_rate)
+
+    @property
+    def plugin(self) -> pb.Plugin:
+        """
+        The pedalboard plugin for this effect
+        """
+        return self.chorus
+
+    def process_batch(self, audio: np.ndarray) -> np.ndarray:
+        """
+        Applies the effect to a batch of grains. The plugin state is reset for each row.
+        :param audio: A 2D array of grains, with shape (num_grains, grain_length)
+        :return: The new grains
+        """
+        return np.stack([self.chorus(grain, self.sample_rate) for grain in audio])
+
+
+class PedalboardChainEffect:
+    """
+    Several pedalboard-backed effects fused into a single pedalboard, so that the
+    whole chain runs in one native call without intermediate NumPy copies.
+    Use `compile_chain` to make these from an effect chain.
+    """
+    def __init__(self, effects: list, sample_rate: int = 44100):
+        """
+        Initializes the PedalboardChainEffect.
+        :param effects: A list of pedalboard-backed effects (effects with a `plugin` property)
+        :param sample_rate: The sample rate
+        """
+        self.effects = effects
+        self.board = pb.Pedalboard([effect.plugin for effect in effects])
+        self.sample_rate = sample_rate
+
+    def __call__(self, audio: np.ndarray) -> np.ndarray:
+        """
+        Apply the effect chain
+        :param audio: The audio
+        :return: The audio
+        """
+        return self.board(audio, self.sample_rate)
+
+    def process_batch(self, audio: np.ndarray) -> np.ndarray:
+        """
+        Applies the effect chain to a batch of grains. The plugin state is reset for each row.
+        :param audio: A 2D array of grains, with shape (num_grains, grain_length)
+        :return: The new grains
+        """
+        return np.stack([self.board(grain, self.sample_rate) for grain in audio])
+
+
+def compile_chain(effect_chain: list) -> list:
+    """
+    Compiles an effect chain by fusing consecutive pedalboard-backed effects (with the same sample rate)
+    into a single PedalboardChainEffect. Other effects (such as Butterworth filters) stay as separate
+    stages between the fused segments, and IdentityEffects are removed.
+    :param effect_chain: A list of effects
+    :return: The compiled effect chain, which produces the same output as the original chain
+    """
+    compiled = []
+    segment = []
+    for effect in effect_chain + [None]:
+        if isinstance(effect, IdentityEffect):
+            continue
+        if effect is not None and hasattr(effect, "plugin") and (len(segment) == 0 or effect.sample_rate == segment[0].sample_rate):
+            segment.append(effect)
+            continue
+        # The current pedalboard segment (if any) ends here
+        if len(segment) == 1:
+            compiled.append(segment[0])
+        elif len(segment) > 1:
+            compiled.append(PedalboardChainEffect(segment, segment[0].sample_rate))
+        segment = []
+        if effect is not None:
+            if hasattr(effect, "plugin"):
+                segment.append(effect)
+            else:
+                compiled.append(effect)
+    return compiled
+
+
+def apply_batch(effect, audio: np.ndarray) -> np.ndarray:
+    """
+    Applies an effect to a batch of grains. Effects without a `process_batch` method
+    are applied to each grain separately.
+    :param effect: The effect
+    :param audio: A 2D array of grains, with shape (num_grains, grain_length)
+    :return: The new grains
+    """
+    if hasattr(effect, "process_batch"):
+        return effect.process_batch(audio)
+    return np.stack([effect(grain) for grain in audio])
+
+
+def adjust_level_batch(audio: np.ndarray, max_db: float) -> np.ndarray:
+    """
+    Adjusts the level of each grain in a batch so that its peak is at `max_db`
+    (like calling `operations.adjust_level` on each grain). Silent grains are left silent.
+    :param audio: A 2D array of grains, with shape (num_grains, grain_length)
+    :param max_db: The peak level of each grain
+    :return: The adjusted grains
+    """
+    peaks = np.max(np.abs(audio), axis=-1, keepdims=True)
+    gains = np.divide(10 ** (max_db / 20), peaks, out=np.zeros(peaks.shape), where=peaks > 0)
+    return audio * gains
@@ -0,0 +1,186 @@
+"""
+File: feature_index.py
+
+Description: A nearest-neighbour index over the spectral features of the grains in the
+grain database. Grains can be selected by describing the sound that is wanted (a target
+feature vector, or a trajectory of them) rather than with hand-written range queries.
+
+The features are normalized (and optionally weighted) before they are put in a KD-tree,
+so that distances are comparable across features with different units. The index is
+saved to disk and is only rebuilt when the grain database changes.
+"""
+
+import grain_sql
+import numpy as np
+import os
+import pickle
+from scipy.spatial import cKDTree
+import sys
+
+
+# The features that are indexed by default
+DEFAULT_FEATURES = ["spectral_flatness", "spectral_roll_off_75"]
+
+# Increment this when the saved format changes, so that old index files are rebuilt
+INDEX_VERSION = 1
+
+
+def database_signature(db_path: str) -> tuple:
+    """
+    Gets a signature of a SQLite database file that changes whenever the database is written to
+    :param db_path: The path of the database
+    :return: A tuple of the modification times and sizes of the database and its write-ahead log
+    """
+    signature = []
+    for path in (db_path, db_path + "-wal"):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            signature += [stat.st_mtime_ns, stat.st_size]
+    return tuple(signature)
+
+
+class FeatureIndex:
+    """
+    Represents a KD-tree over normalized grain features
+    """
+    def __init__(self, records: np.ndarray, features: np.ndarray, feature_names: list, weights=None):
+        """
+        Initializes the FeatureIndex. Use `FeatureIndex.build` or `load_feature_index` rather than calling this directly.
+        :param records: A structured array of grain records (see `grain_sql.select_categories`)
+        :param features: The feature values, with shape (num_records, num_features)
+        :param feature_names: The feature names
+        :param weights: The weight of each feature in the distance. If None, all features have the same weight.
+        """
+        self.records = records
+        self.feature_names = list(feature_names)
+        self.weights = np.ones((len(self.feature_names))) if weights is None else np.asarray(weights, dtype=np.float64)
+        # z-score normalization; constant features are not scaled
+        self.mean = features.mean(axis=0) if features.shape[0] > 0 else np.zeros((len(self.feature_names)))
+        self.scale = features.std(axis=0) if features.shape[0] > 0 else np.ones((len(self.feature_names)))
+        self.scale[self.scale == 0] = 1
+        self.tree = cKDTree(self.normalize(features))
+        self.signature = None
+
+    def __len__(self) -> int:
+        return self.records.shape[-1]
+
+    def normalize(self, features) -> np.ndarray:
+        """
+        Normalizes feature vectors for the tree
+        :param features: A feature vector, or an array of them with shape (num_vectors, num_features)
+        :return: The normalized and weighted feature vectors
+        """
+        return (np.asarray(features, dtype=np.float64) - self.mean) / self.scale * self.weights
+
+    def query(self, targets, k: int = 1, max_distance: float = np.inf) -> tuple:
+        """
+        Finds the k nearest grains to each target
+        :param targets: A target feature vector (in the original feature units), or a trajectory of them
+        with shape (num_targets, num_features)
+        :param k: The number of grains to find for each target
+        :param max_distance: The maximum distance (in normalized units). Missing neighbours have an infinite distance
+        and an index equal to `len(self)`.
+        :return: The distances and the indices of the grains in `self.records`, each with shape (num_targets, k)
+        (or (k,) for one target)
+        """
+        distances, indices = self.tree.query(self.normalize(targets), k=[i + 1 for i in range(k)], distance_upper_bound=max_distance)
+        return distances, indices
+
+    def query_radius(self, targets, radius: float) -> list:
+        """
+        Finds all grains within a radius of each target
+        :param targets: A target feature vector (in the original feature units), or a trajectory of them
+        with shape (num_targets, num_features)
+        :param radius: The radius (in normalized units)
+        :return: An array of indices into `self.records` for each target (or one array for one target)
+        """
+        targets = self.normalize(targets)
+        results = self.tree.query_ball_point(targets, radius, return_sorted=True)
+        if targets.ndim == 1:
+            return np.array(results, dtype=np.int64)
+        return [np.array(result, dtype=np.int64) for result in results]
+
+    def categories(self, targets, k: int) -> list:
+        """
+        Makes grain categories from a trajectory of target feature vectors, for use with the renderers
+        :param targets: An array of target feature vectors with shape (num_targets, num_features)
+        :param k: The number of grains in each category
+        :return: A list of grain record arrays, one for each target
+        """
+        _, indices = self.query(np.reshape(targets, (-1, len(self.feature_names))), k)
+        return [self.records[row[row < len(self)]] for row in indices]
+
+    def save(self, path: str):
+        """
+        Saves the index
+        :param path: The index file path
+        """
+        with open(path + ".tmp", "wb") as index_file:
+            pickle.dump((INDEX_VERSION, self), index_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def load(path: str):
+        """
+        Loads a saved index
+        :param path: The index file path
+        :return: The FeatureIndex, or None if the file doesn't exist or was saved by a different version
+        """
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as index_file:
+            version, index = pickle.load(index_file)
+        return index if version == INDEX_VERSION else None
+
+    @staticmethod
+    def build(cursor, feature_names: list = DEFAULT_FEATURES, where: str = None, weights=None, fields: list = grain_sql.RENDER_FIELDS):
+        """
+        Builds an index from the grains table. Grains with NULL values for any of the features are left out.
+        :param cursor: The cursor for executing SQL
+        :param feature_names: The features to index
+        :param where: A WHERE clause (without the WHERE keyword) to limit the grains, such as "length = 8192"
+        :param weights: The weight of each feature in the distance
+        :param fields: The record fields to keep in the index
+        :return: The FeatureIndex
+        """
+        predicate = " AND ".join(f"({feature} IS NOT NULL)" for feature in feature_names)
+        if where is not None:
+            predicate = f"({where}) AND {predicate}"
+        columns = list(fields) + [feature for feature in feature_names if feature not in fields]
+        table = grain_sql.select_categories(cursor, [predicate], columns)[0]
+        features = np.stack([table[feature].astype(np.float64) for feature in feature_names], axis=-1) if len(feature_names) > 0 else np.zeros((len(table), 0))
+        records = np.empty((len(table)), dtype=grain_sql.record_dtype(fields))
+        for field in fields:
+            records[field] = table[field]
+        return FeatureIndex(records, features, feature_names, weights)
+
+
+def load_feature_index(db_path: str, index_path: str = None, feature_names: list = DEFAULT_FEATURES, where: str = None, weights=None) -> FeatureIndex:
+    """
+    Loads the feature index for a grain database, rebuilding it if the database or the index parameters have changed
+    :param db_path: The path of the grain database
+    :param index_path: The index file path. If None, the index is stored next to the grain database.
+    :param feature_names: The features to index
+    :param where: A WHERE clause (without the WHERE keyword) to limit the grains
+    :param weights: The weight of each feature in the distance
+    :return: The FeatureIndex
+    """
+    if index_path is None:
+        index_path = os.path.splitext(db_path)[0] + ".features.pickle"
+    signature = (database_signature(db_path), tuple(feature_names), where, None if weights is None else tuple(weights))
+    index = FeatureIndex.load(index_path)
+    if index is None or index.signature != signature:
+        db, cursor = grain_sql.connect_to_db(db_path)
+        index = FeatureIndex.build(cursor, feature_names, where, weights)
+        db.close()
+        index.signature = signature
+        index.save(index_path)
+    return index
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python feature_index.py <grain database> [<feature> ...]")
+        sys.exit(1)
+    index = load_feature_index(sys.argv[1], feature_names=sys.argv[2:] if len(sys.argv) > 2 else DEFAULT_FEATURES)
+    print(f"Indexed {len(index)} grains on {', '.join(index.feature_names)}")
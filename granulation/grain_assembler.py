@@ -9,13 +9,15 @@ Description: Contains grain assembler tools. Workflow consists of
     3.) merging the grains to create an audio array using `merge`
 """
 
-import aus.operations as operations
+import effects
 import numpy as np
 import random
 import grain_tools
+import grain_transforms
+from grain_table import GrainTable
 
 
-def assemble_repeat(grain, n: int, distance_between_grains: int, max_db: float = -18.0, effect_chain: list = None, effect_cycle: list = None) -> np.ndarray:
+def assemble_repeat(grain, n: int, distance_between_grains: int, max_db: float = -18.0, effect_chain: list = None, effect_cycle: list = None, effect_cache: dict = None) -> GrainTable:
     """
     Repeats a grain or list of grains for n times.
     :param grain: A grain dictionary or list of grains
@@ -24,46 +26,18 @@ def assemble_repeat(grain, n: int, distance_between_grains: int, max_db: float =
     :param max_db: The db level of the final grains
     :param effect_chain: A sequence (list) of effects that will be applied to each grain individually. If None, no effects will be applied.
     :param effect_cycle: A cycle (list) of effects that will be applied to each grain in a repeating sequence. If None, no effects will be applied.
-    :return: A list of grain tuples, specifying where each grain should go
+    :param effect_cache: A dictionary for memoizing processed grains. Pass the same dictionary to several assemble calls
+    to reuse processed grains between them. If None, processed grains are only reused within this call.
+    :return: A GrainTable of the assembled grains
     """
     if type(grain) == dict:
         grains = [grain] * n
     elif type(grain) == list:
         grains = grain * n
-    
-    # Apply effects
-    if effect_chain is not None:
-        for effect in effect_chain:
-            grains[0]["grain"] = effect(grains[0]["grain"])
-    if effect_cycle is not None:
-        grains[0]["grain"] = effect_cycle[0](grains[0]["grain"])
-
-    # Add the grain to the audio sequence
-    grains[0]["grain"] = operations.adjust_level(grains[0]["grain"], max_db)
-    grain_pos_list = [{
-        "grain": grains[0]["grain"], 
-        "channel": 0,
-        "distance_between_grains": distance_between_grains
-    }]
-    
-    for i in range(1, len(grains)):
-        # Apply effects
-        if effect_chain is not None:
-            for effect in effect_chain:
-                grains[i]["grain"] = effect(grains[i]["grain"])
-        if effect_cycle is not None:
-            grains[i]["grain"] = effect_cycle[i % len(effect_cycle)](grains[i]["grain"])
-        grains[i]["grain"] = operations.adjust_level(grains[i]["grain"], max_db)
-        grain_pos_list.append({
-            "grain": grains[i]["grain"], 
-            "channel": 0,
-            "distance_between_grains": distance_between_grains
-            })
+    return _assemble(grains, distance_between_grains, max_db, effect_chain, effect_cycle, effect_cache)
 
-    return grain_pos_list
 
-
-def assemble_single(grains: list, features: list, distance_between_grains: int, max_db: float = -18.0, effect_chain: list = None, effect_cycle: list = None) -> np.ndarray:
+def assemble_single(grains: list, features: list, distance_between_grains: int, max_db: float = -18.0, effect_chain: list = None, effect_cycle: list = None, effect_cache: dict = None) -> GrainTable:
     """
     Assembles grains. Each grain is only used once. 
     Grains are sorted by features provided in the `features` list: first by feature 0, then by feature 1, etc.
@@ -75,44 +49,17 @@ def assemble_single(grains: list, features: list, distance_between_grains: int,
     :param max_db: The db level of the final grains
     :param effect_chain: A sequence (list) of effects that will be applied to each grain individually. If None, no effects will be applied.
     :param effect_cycle: A cycle (list) of effects that will be applied to each grain in a repeating sequence. If None, no effects will be applied.
-    :return: The assembled grains as an array
+    :param effect_cache: A dictionary for memoizing processed grains. Pass the same dictionary to several assemble calls
+    to reuse processed grains between them. If None, processed grains are only reused within this call.
+    :return: A GrainTable of the assembled grains
     """
     # Organize the grains
     for feature in features:
         grains = sorted(grains, key=lambda x: x[feature])
-
-    # Apply effects
-    if effect_chain is not None:
-        for effect in effect_chain:
-            grains[0]["grain"] = effect(grains[0]["grain"])
-    if effect_cycle is not None:
-        grains[0]["grain"] = effect_cycle[0](grains[0]["grain"])
-
-    # Add the grain to the audio sequence
-    grains[0]["grain"] = operations.adjust_level(grains[0]["grain"], max_db)
-    grain_pos_list = [{
-        "grain": grains[0]["grain"], 
-        "channel": 0,
-        "distance_between_grains": distance_between_grains
-    }]
-    for i in range(1, len(grains)):
-        # Apply effects
-        if effect_chain is not None:
-            for effect in effect_chain:
-                grains[i]["grain"] = effect(grains[i]["grain"])
-        if effect_cycle is not None:
-            grains[i]["grain"] = effect_cycle[i % len(effect_cycle)](grains[i]["grain"])
-        grains[i]["grain"] = operations.adjust_level(grains[i]["grain"], max_db)
-        grain_pos_list.append({
-            "grain": grains[i]["grain"], 
-            "channel": 0,
-            "distance_between_grains": distance_between_grains
-            })
-    
-    return grain_pos_list
+    return _assemble(grains, distance_between_grains, max_db, effect_chain, effect_cycle, effect_cache)
 
 
-def assemble_stochastic(grains: list, n: int, distance_between_grains: int, rng: random.Random, max_db: float =-18.0, effect_chain: list = None, effect_cycle: list = None) -> np.ndarray:
+def assemble_stochastic(grains: list, n: int, distance_between_grains: int, rng: random.Random, max_db: float =-18.0, effect_chain: list = None, effect_cycle: list = None, effect_cache: dict = None) -> GrainTable:
     """
     Assembles grains stochastically. Each grain is used n times.
     :param grains: A list of grain dictionaries to choose from
@@ -122,52 +69,134 @@ def assemble_stochastic(grains: list, n: int, distance_between_grains: int, rng:
     :param max_db: The db level of the final grains
     :param effect_chain: A sequence (list) of effects that will be applied to each grain individually. If None, no effects will be applied.
     :param effect_cycle: A cycle (list) of effects that will be applied to each grain in a repeating sequence. If None, no effects will be applied.
-    :return: The assembled grains as an array
+    :param effect_cache: A dictionary for memoizing processed grains. Pass the same dictionary to several assemble calls
+    to reuse processed grains between them. If None, processed grains are only reused within this call.
+    :return: A GrainTable of the assembled grains
     """
     grains = grains * n
     for i in range(n):
         rng.shuffle(grains)
+    return _assemble(grains, distance_between_grains, max_db, effect_chain, effect_cycle, effect_cache)
+
+
+def _assemble(grains: list, distance_between_grains: int, max_db: float, effect_chain: list, effect_cycle: list, effect_cache: dict = None) -> GrainTable:
+    """
+    Applies effects to a sequence of grains and adds them to a GrainTable.
+    The effects are applied to the original grain audio (the grain dictionaries are not modified).
+    Each combination of source grain and effect cycle position is only processed once,
+    and every grain that uses it refers to the same audio in the bank.
+    :param grains: A list of grain dictionaries, in order
+    :param distance_between_grains: The distance between each grain, in frames
+    :param max_db: The db level of the final grains
+    :param effect_chain: A sequence (list) of effects that will be applied to each grain individually. If None, no effects will be applied.
+    :param effect_cycle: A cycle (list) of effects that will be applied to each grain in a repeating sequence. If None, no effects will be applied.
+    :param effect_cache: A dictionary for memoizing processed grains, or None
+    :return: A GrainTable of the assembled grains
+    """
+    if effect_cache is None:
+        effect_cache = {}
+    signature = _effect_signature(effect_chain, effect_cycle, max_db)
+
+    # Find the unique combinations of source grain and effect cycle position
+    keys = []
+    sources = []
+    key_ids = {}
+    grain_ids = np.zeros((len(grains)), dtype=np.int32)
+    for i in range(len(grains)):
+        audio = grains[i]["grain"]
+        cycle_pos = i % len(effect_cycle) if effect_cycle is not None else 0
+        key = (id(audio), signature, cycle_pos)
+        if key not in key_ids:
+            key_ids[key] = len(keys)
+            keys.append(key)
+            sources.append(audio)
+        grain_ids[i] = key_ids[key]
 
-    # Apply effects
+    pending = [k for k in range(len(keys)) if keys[k] not in effect_cache]
+    if len(pending) > 0:
+        _process_grains([keys[k] for k in pending], [sources[k] for k in pending], max_db, effect_chain, effect_cycle, effect_cache)
+    bank = [effect_cache[key][1] for key in keys]
+
+    return GrainTable(bank, grain_ids, None, np.full((len(grains)), distance_between_grains))
+
+
+def _process_grains(keys: list, sources: list, max_db: float, effect_chain: list, effect_cycle: list, effect_cache: dict):
+    """
+    Applies effects and level adjustment to grains, and stores the results in the effect cache.
+    Equal-length grains are stacked into 2D arrays, so that each effect is applied once per group.
+    :param keys: The effect cache key of each grain
+    :param sources: The source audio of each grain
+    :param max_db: The db level of the final grains
+    :param effect_chain: A sequence (list) of effects that will be applied to each grain individually. If None, no effects will be applied.
+    :param effect_cycle: A cycle (list) of effects that will be applied to each grain in a repeating sequence. If None, no effects will be applied.
+    :param effect_cache: A dictionary for memoizing processed grains
+    """
+    # The effects are kept in the cache entries (like the source audio) so that their ids can't be reused
+    # while the entries are in the cache. The ids are part of the cache key (see `_effect_signature`).
+    effect_objects = (tuple(effect_chain) if effect_chain is not None else None, tuple(effect_cycle) if effect_cycle is not None else None)
+
+    # Apply the effect chain once to each unique source grain, in groups of equal length.
+    # Consecutive pedalboard effects in the chain are fused into one native call.
     if effect_chain is not None:
-        for effect in effect_chain:
-            grains[0]["grain"] = effect(grains[0]["grain"])
-    if effect_cycle is not None:
-        grains[0]["grain"] = effect_cycle[0](grains[0]["grain"])
-
-    # Add the grain to the audio sequence
-    grains[0]["grain"] = operations.adjust_level(grains[0]["grain"], max_db)
-    grain_pos_list = [{
-        "grain": grains[0]["grain"], 
-        "channel": 0,
-        "distance_between_grains": distance_between_grains
-    }]
-    for i in range(1, len(grains)):
-        # Apply effects
+        effect_chain = effects.compile_chain(effect_chain)
+    chained = {}
+    groups = {}
+    for audio in sources:
+        if id(audio) not in chained:
+            chained[id(audio)] = None
+            groups.setdefault(audio.shape[-1], []).append(audio)
+    for group in groups.values():
+        batch = np.stack(group)
         if effect_chain is not None:
             for effect in effect_chain:
-                grains[i]["grain"] = effect(grains[i]["grain"])
+                batch = effects.apply_batch(effect, batch)
+        for audio, processed in zip(group, batch):
+            chained[id(audio)] = processed
+
+    # Apply the cycle effects and adjust the level, in groups of equal length and cycle position
+    groups = {}
+    for i, (key, audio) in enumerate(zip(keys, sources)):
+        groups.setdefault((audio.shape[-1], key[2]), []).append(i)
+    for (_, cycle_pos), group in groups.items():
+        batch = np.stack([chained[id(sources[i])] for i in group])
         if effect_cycle is not None:
-            grains[i]["grain"] = effect_cycle[i % len(effect_cycle)](grains[i]["grain"])
-        grains[i]["grain"] = operations.adjust_level(grains[i]["grain"], max_db)
-        grain_pos_list.append({
-            "grain": grains[i]["grain"], 
-            "channel": 0,
-            "distance_between_grains": distance_between_grains
-            })
-    
-    return grain_pos_list
+            batch = effects.apply_batch(effect_cycle[cycle_pos], batch)
+        batch = effects.adjust_level_batch(batch, max_db)
+        for i, processed in zip(group, batch):
+            # The source audio and the effects are kept in the cache entry so that their ids can't be reused
+            effect_cache[keys[i]] = (sources[i], processed, effect_objects)
 
 
-def calculate_grain_positions(grains: list):
+def _effect_signature(effect_chain: list, effect_cycle: list, max_db: float) -> tuple:
+    """
+    Makes a hashable signature for an effect configuration, for memoizing processed grains. The signature uses the ids
+    of the effects, so the cache entries keep references to the effects (see `_process_grains`).
+    :param effect_chain: The effect chain, or None
+    :param effect_cycle: The effect cycle, or None
+    :param max_db: The db level of the final grains
+    :return: The signature
+    """
+    chain_ids = tuple(id(effect) for effect in effect_chain) if effect_chain is not None else None
+    cycle_ids = tuple(id(effect) for effect in effect_cycle) if effect_cycle is not None else None
+    return (chain_ids, cycle_ids, max_db)
+
+
+def calculate_grain_positions(grains):
     """
     Calculates the actual onset position for each grain in a list of grains.
     Each grain should be a dictionary with keys (grain, distance_between_grains),
     and this function will add keys (start_idx, end_idx) to each grain.
+    If `grains` is a GrainTable, its `start_idx` column is calculated instead.
     After this function is run, you can use the `merge_grains` function to merge
     the grains into an audio array.
-    :param grains: A list of grain dictionaries
+    :param grains: A list of grain dictionaries, or a GrainTable
     """
+    if isinstance(grains, GrainTable):
+        lengths = grains.lengths
+        steps = lengths + grains.distance_between_grains
+        steps[0] = lengths[0]
+        grains.start_idx = np.cumsum(steps) - lengths
+        return
     end_idx = grains[0]["grain"].shape[-1]
     grains[0]["start_idx"] = 0
     grains[0]["end_idx"] = end_idx
@@ -178,139 +207,216 @@ def calculate_grain_positions(grains: list):
         grains[i]["end_idx"] = end_idx
 
 
-def delete_nth_grains(grains: list, n: int):
+def delete_nth_grains(grains, n: int):
     """
     Deletes every nth grain.
-    :param grains: A list of grains
+    :param grains: A list of grains, or a GrainTable
     :param n: Every nth grain will be deleted
     """
-    i = n
-    while i < len(grains):
-        del grains[i]
-        i += n-1
+    grain_transforms.delete_nth_grains(grains, n)
 
 
-def interleave(list1: list, list2: list) -> list:
+def interleave(list1, list2):
     """
     Interleaves two lists of possibly different length. The goal is to interleave as evenly as possible.
-    :param list1: A list
-    :param list2: A list
-    :return: A combined list
-    """
-    # Determine which list is larger and which is smaller. Also determine the size ratio between the two lists.
-    if len(list1) < len(list2):
-        larger_list = list2
-        smaller_list = list1
-    else:
-        larger_list = list1
-        smaller_list = list2
-    ideal_ratio = len(larger_list) / len(smaller_list)
-
-    # The number added from each list
-    list1_num_added = 0
-    list2_num_added = 0
-
-    combined_list = []
-
-    # Add the first batch
-    batch_size_1 = round(ideal_ratio)
-    batch_size_2 = 1
-    combined_list += list1[:batch_size_1]
-    combined_list += list2[:batch_size_2]
-    list1_num_added += batch_size_1
-    list2_num_added += batch_size_2
-
-    # Add until one or both lists are exhausted
-    while list1_num_added < len(larger_list) and list2_num_added < len(smaller_list):
-        # Fiddle with the number of items to add from each list
-        temp_batch_size_1 = batch_size_1
-        temp_batch_size_2 = batch_size_2
-        current_ratio = list1_num_added / list2_num_added
-        if current_ratio < ideal_ratio:
-            temp_batch_size_1 += 1
-        elif current_ratio > ideal_ratio:
-            temp_batch_size_2 += 1
-        temp_batch_size_1 = min(temp_batch_size_1, len(list1) - list1_num_added)
-        temp_batch_size_2 = min(temp_batch_size_2, len(list2) - list2_num_added)
-
-        # Add this batch of items
-        combined_list += list1[list1_num_added:list1_num_added+temp_batch_size_1]
-        combined_list += list2[list2_num_added:list2_num_added+temp_batch_size_2]
-        list1_num_added += temp_batch_size_1
-        list2_num_added += temp_batch_size_2
-    
-    # Add any remaining items
-    combined_list += list1[list1_num_added:]
-    combined_list += list2[list2_num_added:]
-
-    return combined_list
-    
-
-def interpolate(grains1: list, grains2: list, interpolations=None) -> list:
+    :param list1: A list, or a GrainTable
+    :param list2: A list, or a GrainTable
+    :return: A combined list (or GrainTable, if GrainTables were provided)
+    """
+    return _apply_order(list1, list2, _interleave_order(np.array([len(list1)]), np.array([len(list2)])))
+
+
+def _interleave_order(len1: np.ndarray, len2: np.ndarray) -> np.ndarray:
+    """
+    Calculates the order of `interleave` for several pairs of lists at once. Batches are taken alternately from
+    the two lists: round(ratio) items from the first list and one from the second, plus one more from the first list
+    if the ratio of the items added so far is too small, or one more from the second list if it is too large.
+    Whether the ratio is too small or too large only depends on the sign of n1 * smaller - n2 * larger, which changes
+    by a fixed amount after each kind of batch, so all of the batches can be calculated at once. (This is the same
+    as comparing the ratios as floats while smaller * larger < 2 ** 52.)
+    :param len1: The length of the first list of each pair
+    :param len2: The length of the second list of each pair
+    :return: An index array into the concatenated lists (the first list of the first pair, the second list
+    of the first pair, the first list of the second pair, and so on)
+    """
+    len1 = np.asarray(len1, dtype=np.int64)
+    len2 = np.asarray(len2, dtype=np.int64)
+    num_pairs = len1.shape[-1]
+    larger = np.maximum(len1, len2)
+    smaller = np.minimum(len1, len2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        batch_size_1 = np.where(smaller > 0, np.round(larger / np.maximum(smaller, 1)), 0).astype(np.int64)
+
+    # The error n1 * smaller - n2 * larger after each batch. A negative error adds (batch_size_1 + 1, 1) items next,
+    # a positive error adds (batch_size_1, 2) items, and zero adds (batch_size_1, 1) items. Away from zero this is a
+    # rotation of the error in [-step_down, step_up), and zero returns the error to its first value, so the errors
+    # repeat after the first zero. The second list gets at least one item per batch, so one of the lists runs out
+    # within `smaller` batches.
+    step_up = (batch_size_1 + 1) * smaller - larger
+    step_down = 2 * larger - batch_size_1 * smaller
+    first_error = batch_size_1 * smaller - larger
+    batch_offsets = np.cumsum(smaller) - smaller
+    pair = np.repeat(np.arange(num_pairs), smaller)
+    batch = np.arange(pair.shape[-1]) - batch_offsets[pair]
+    errors = (first_error[pair] + step_down[pair] + batch * step_up[pair]) % np.maximum(step_up + step_down, 1)[pair] - step_down[pair]
+    zeros = np.flatnonzero(errors == 0)
+    zero_pairs, first_zeros = np.unique(pair[zeros], return_index=True)
+    cycle = smaller.copy()
+    cycle[zero_pairs] = batch[zeros[first_zeros]] + 1
+    errors = errors[batch_offsets[pair] + batch % cycle[pair]]
+
+    # The number added from each list after each batch
+    first_batch = batch == 0
+    previous_errors = np.zeros_like(errors)
+    previous_errors[1:] = errors[:-1]
+    sizes1 = batch_size_1[pair] + (previous_errors < 0)
+    sizes2 = 1 + (previous_errors > 0)
+    sizes1[first_batch] = batch_size_1[pair[first_batch]]
+    sizes2[first_batch] = 1
+    ends1 = np.cumsum(sizes1)
+    ends2 = np.cumsum(sizes2)
+    ends1 -= (ends1 - sizes1)[batch_offsets[pair]]
+    ends2 -= (ends2 - sizes2)[batch_offsets[pair]]
+
+    # Keep the batches up to the one where a list runs out. After that, the rest of the first list is added,
+    # then the rest of the second list.
+    done = np.flatnonzero((ends1 >= len1[pair]) | (ends2 >= smaller[pair]))
+    done_pairs, first_done = np.unique(pair[done], return_index=True)
+    num_batches = np.zeros((num_pairs), dtype=np.int64)
+    num_batches[done_pairs] = batch[done[first_done]] + 1
+    kept = batch < num_batches[pair]
+    pair = pair[kept]
+    ends1 = np.minimum(ends1[kept], len1[pair])
+    ends2 = np.minimum(ends2[kept], len2[pair])
+    last_end1 = np.zeros((num_pairs), dtype=np.int64)
+    last_end2 = np.zeros((num_pairs), dtype=np.int64)
+    last_end1[pair] = ends1
+    last_end2[pair] = ends2
+    first_batch = batch[kept] == 0
+    starts1 = np.zeros_like(ends1)
+    starts2 = np.zeros_like(ends2)
+    starts1[1:] = ends1[:-1]
+    starts2[1:] = ends2[:-1]
+    starts1[first_batch] = 0
+    starts2[first_batch] = 0
+
+    # Each pair is a sequence of runs: two per batch, then the rest of each list
+    item_offsets = np.cumsum(len1 + len2) - len1 - len2
+    run_offsets = np.cumsum(2 * num_batches + 2) - 2 * num_batches - 2
+    run_starts = np.empty((run_offsets[-1] + 2 * num_batches[-1] + 2 if num_pairs > 0 else 0), dtype=np.int64)
+    run_lengths = np.empty_like(run_starts)
+    batch_runs = run_offsets[pair] + 2 * (np.arange(pair.shape[-1]) - (np.cumsum(num_batches) - num_batches)[pair])
+    run_starts[batch_runs] = item_offsets[pair] + starts1
+    run_lengths[batch_runs] = ends1 - starts1
+    run_starts[batch_runs + 1] = item_offsets[pair] + len1[pair] + starts2
+    run_lengths[batch_runs + 1] = ends2 - starts2
+    rest_runs = run_offsets + 2 * num_batches
+    run_starts[rest_runs] = item_offsets + last_end1
+    run_lengths[rest_runs] = len1 - last_end1
+    run_starts[rest_runs + 1] = item_offsets + len1 + last_end2
+    run_lengths[rest_runs + 1] = len2 - last_end2
+    return np.repeat(run_starts - (np.cumsum(run_lengths) - run_lengths), run_lengths) + np.arange(run_lengths.sum())
+
+
+def _apply_order(list1, list2, order: np.ndarray):
+    """
+    Selects items from two concatenated lists
+    :param list1: A list, or a GrainTable
+    :param list2: A list, or a GrainTable
+    :param order: An index array into the concatenated lists (list1 + list2)
+    :return: A combined list (or GrainTable, if GrainTables were provided)
+    """
+    if isinstance(list1, GrainTable):
+        return (list1 + list2).take(order)
+    combined_list = list(list1) + list(list2)
+    return [combined_list[i] for i in order.tolist()]
+
+
+def interpolate(grains1, grains2, interpolations=None):
     """
     Creates a new list of grains that interpolates linearly between two existing grain lists.
-    :param grains1: A list of grains
-    :param grains2: A list of grains
+    :param grains1: A list of grains, or a GrainTable
+    :param grains2: A list of grains, or a GrainTable
     :param interpolations: The number of interpolation chunk pairs. If None, will be determined automatically.
     This parameter can be adjusted to change the smoothness of interpolation.
-    :return: An interpolated grains list
+    :return: An interpolated grains list (or GrainTable, if GrainTables were provided)
+    """
+    return _apply_order(grains1, grains2, _interpolate_order(len(grains1), len(grains2), interpolations))
+
+
+def _interpolate_order(len1: int, len2: int, interpolations=None) -> np.ndarray:
+    """
+    Calculates the order of `interpolate`
+    :param len1: The length of the first grain list
+    :param len2: The length of the second grain list
+    :param interpolations: The number of interpolation chunk pairs. If None, will be determined automatically.
+    :return: An index array into the concatenated grain lists (grains1 + grains2)
     """
     if interpolations is None:
-        smaller_area = min(len(grains1), len(grains2))
+        smaller_area = min(len1, len2)
         interpolations = int(np.ceil(np.sqrt(smaller_area * 2)))
-    
+
     # Calculate the slope for linear interpolation
-    height1 = 2 * len(grains1) / interpolations
-    height2 = 2 * len(grains2) / interpolations
+    height1 = 2 * len1 / interpolations
+    height2 = 2 * len2 / interpolations
     slope1 = -height1 / interpolations
     slope2 = height2 / interpolations
 
-    # Generate the lists of alternating grains
-    grains1_new = []
-    grains2_new = []
+    # Calculate the chunk boundaries (there are only about sqrt(n) chunks)
+    ends1 = []
+    ends2 = []
     start1 = 0
     start2 = 0
     for i in range(interpolations):
         new1 = slope1 * i + height1
         new2 = slope2 * i
-        end1 = int(min(start1 + new1, len(grains1)))
-        end2 = int(min(start2 + new2, len(grains2)))
-        grains1_new.append(grains1[start1:end1])
-        grains2_new.append(grains2[start2:end2])
-        start1 = end1
-        start2 = end2
-    i = 0
-
-    # If any grains remain, pad the existing lists
-    while start1 < len(grains1):
-        grains1_new[i].append(grains1[start1])
-        i = (i + 1) % len(grains1_new)
-        start1 += 1
-    i = 0
-    while start2 < len(grains2):
-        grains2_new[i].append(grains2[start2])
-        i = (i + 1) % len(grains2_new)
-        start2 += 1
-
-    # Merge the grains
-    newgrains = []
-    for i in range(len(grains1_new)):
-        if len(grains1_new[i]) > 0 and len(grains2[i]) > 0:
-            newgrains += interleave(grains1_new[i], grains2_new[i])
-        else:
-            newgrains += grains1_new[i] + grains2_new[i]
-    
-    return newgrains
-
-
-def merge(grains: list, num_channels: int = 1, window_fn=np.hanning) -> np.ndarray:
+        start1 = int(min(start1 + new1, len1))
+        start2 = int(min(start2 + new2, len2))
+        ends1.append(start1)
+        ends2.append(start2)
+
+    # The chunk of each grain. Any remaining grains are added to the ends of the chunks in turn,
+    # so the grains in each chunk are still in their original order.
+    chunks1 = np.searchsorted(ends1, np.arange(len1), side="right")
+    chunks1[start1:] = np.arange(len1 - start1) % interpolations
+    chunks2 = np.searchsorted(ends2, np.arange(len2), side="right")
+    chunks2[start2:] = np.arange(len2 - start2) % interpolations
+    chunk_len1 = np.bincount(chunks1, minlength=interpolations)
+    chunk_len2 = np.bincount(chunks2, minlength=interpolations)
+
+    # Lay out the grains chunk by chunk (the first list, then the second list) and interleave each chunk pair.
+    # If one of the chunks is empty, interleaving just concatenates them.
+    chunk_offsets = np.cumsum(chunk_len1 + chunk_len2) - chunk_len1 - chunk_len2
+    sorted1 = np.argsort(chunks1, kind="stable")
+    sorted2 = np.argsort(chunks2, kind="stable")
+    layout = np.empty((len1 + len2), dtype=np.int64)
+    layout[chunk_offsets[chunks1[sorted1]] + np.arange(len1) - (np.cumsum(chunk_len1) - chunk_len1)[chunks1[sorted1]]] = sorted1
+    layout[chunk_offsets[chunks2[sorted2]] + chunk_len1[chunks2[sorted2]] + np.arange(len2) - (np.cumsum(chunk_len2) - chunk_len2)[chunks2[sorted2]]] = sorted2 + len1
+    return layout[_interleave_order(chunk_len1, chunk_len2)]
+
+
+def merge(grains, num_channels: int = 1, window_fn=np.hanning) -> np.ndarray:
     """
-    Merges a list of grain dictionaries into an audio array
-    :param grains: A list of grain dictionaries {grain: , start_idx: , end_idx: , channel: }
+    Merges a list of grain dictionaries into an audio array.
+    The grains are grouped by length and channel, and each group is windowed
+    as a 2D array and overlap-added in a few NumPy calls.
+    :param grains: A list of grain dictionaries {grain: , start_idx: , end_idx: , channel: }, or a GrainTable
     :param num_channels: The number of channels
     :param window_fn: The window function
     :return: The merged array of grains
     """
+    if isinstance(grains, GrainTable):
+        max_idx = int(grains.end_idx.max()) if len(grains) > 0 else 0
+        if num_channels > 1:
+            audio = np.zeros((num_channels, max_idx))
+            channels = grains.channel.astype(np.int64)
+        else:
+            audio = np.zeros((max_idx))
+            channels = np.zeros((len(grains)), dtype=np.int64)
+        _overlap_add(audio.reshape((num_channels, max_idx)), grains.bank, grains.grain, grains.start_idx, channels, window_fn)
+        audio = np.nan_to_num(audio, copy=False)
+        return audio
+
     max_idx = 0
     for tup in grains:
         max_idx = max(max_idx, tup["end_idx"])
@@ -319,15 +425,99 @@ def merge(grains: list, num_channels: int = 1, window_fn=np.hanning) -> np.ndarr
     else:
         audio = np.zeros((max_idx))
     # window_norm = np.zeros((num_channels, max_idx))
-    for i in range(len(grains)):
-        window = window_fn(grains[i]["grain"].shape[-1])
-        grain = grains[i]["grain"] * window
-        grain_tools.merge_grain(audio, grain, grains[i]["start_idx"], grains[i]["end_idx"], grains[i]["channel"])
-        # grain_tools.merge(window_norm, window, tup[2], end_idx, tup[1])
-    audio = np.nan_to_num(audio)
+    bank = [grain["grain"] for grain in grains]
+    grain_ids = np.arange(len(grains))
+    start_indices = np.array([grain["start_idx"] for grain in grains], dtype=np.int64)
+    if num_channels > 1:
+        channels = np.array([grain["channel"] for grain in grains], dtype=np.int64)
+    else:
+        channels = np.zeros((len(grains)), dtype=np.int64)
+    _overlap_add(audio.reshape((num_channels, max_idx)), bank, grain_ids, start_indices, channels, window_fn)
+    audio = np.nan_to_num(audio, copy=False)
     return audio
 
 
+def merge_stream(grains, num_channels: int = 1, window_fn=np.hanning, block_size: int = 65536):
+    """
+    Merges grains into audio blocks, in order. This produces the same audio as `merge`,
+    but only the output blocks that grains are currently being added to are kept in memory,
+    so peak memory depends on the block size and grain length rather than the length of the audio.
+    :param grains: A list of grain dictionaries {grain: , start_idx: , end_idx: , channel: }, or a GrainTable
+    :param num_channels: The number of channels
+    :param window_fn: The window function
+    :param block_size: The number of frames in each block
+    :return: A generator of audio blocks. Each block has block_size frames, except the last block.
+    """
+    if not isinstance(grains, GrainTable):
+        grains = GrainTable.from_list(grains)
+    if len(grains) == 0:
+        return
+    lengths = grains.lengths
+    order = np.argsort(grains.start_idx, kind="stable")
+    start_indices = grains.start_idx[order]
+    grain_ids = grains.grain[order]
+    if num_channels > 1:
+        channels = grains.channel[order].astype(np.int64)
+    else:
+        channels = np.zeros((len(grains)), dtype=np.int64)
+    num_frames = int((start_indices + lengths[order]).max())
+
+    # The accumulator holds the current block, and the tails of grains that extend past it
+    accumulator = np.zeros((num_channels, block_size + int(lengths.max())))
+    windows = {}
+    next_grain = 0
+    for block_start in range(0, num_frames, block_size):
+        block_end = min(block_start + block_size, num_frames)
+        last_grain = int(np.searchsorted(start_indices, block_end, side="left"))
+        if last_grain > next_grain:
+            _overlap_add(accumulator, grains.bank, grain_ids[next_grain:last_grain], start_indices[next_grain:last_grain] - block_start, 
+                         channels[next_grain:last_grain], window_fn, windows=windows)
+            next_grain = last_grain
+        block = np.nan_to_num(accumulator[:, :block_end - block_start])
+        accumulator[:, :-block_size] = accumulator[:, block_size:]
+        accumulator[:, -block_size:] = 0
+        yield block if num_channels > 1 else block[0]
+
+
+def _overlap_add(audio: np.ndarray, bank: list, grain_ids: np.ndarray, start_indices: np.ndarray, channels: np.ndarray, window_fn, block_frames: int = 2 ** 20, windows: dict = None):
+    """
+    Overlap-adds grains into a 2D audio array. Grains are grouped by length and channel.
+    Each group is windowed as a 2D array and scatter-added with `grain_tools.merge_grains`.
+    :param audio: The audio array, with shape (num_channels, num_frames)
+    :param bank: A list of grain arrays
+    :param grain_ids: The index in the bank of the audio for each grain
+    :param start_indices: The start index of each grain
+    :param channels: The channel index of each grain
+    :param window_fn: The window function
+    :param block_frames: The (approximate) number of frames to process in one NumPy call
+    :param windows: A dictionary of windows, keyed by length. If provided, it is used as a cache between calls.
+    """
+    if len(grain_ids) == 0:
+        return
+    lengths = np.array([grain.shape[-1] for grain in bank], dtype=np.int64)[grain_ids]
+
+    # Sort by length, then channel, then start index, and find the group boundaries
+    order = np.lexsort((start_indices, channels, lengths))
+    boundaries = np.flatnonzero((np.diff(lengths[order]) != 0) | (np.diff(channels[order]) != 0)) + 1
+    boundaries = np.concatenate(([0], boundaries, [len(order)]))
+
+    if windows is None:
+        windows = {}
+    for i in range(len(boundaries) - 1):
+        group = order[boundaries[i]:boundaries[i+1]]
+        grain_len = int(lengths[group[0]])
+        channel = int(channels[group[0]])
+        if grain_len not in windows:
+            windows[grain_len] = window_fn(grain_len)
+        chunk_size = max(1, block_frames // max(grain_len, 1))
+        for j in range(0, len(group), chunk_size):
+            chunk = group[j:j+chunk_size]
+            # Each unique grain is only windowed once per chunk
+            unique_ids, inverse = np.unique(grain_ids[chunk], return_inverse=True)
+            windowed = np.stack([bank[k] for k in unique_ids]) * windows[grain_len]
+            grain_tools.merge_grains(audio[channel], windowed[inverse], start_indices[chunk])
+
+
 def merge_crossfade(grains: list, merge_fraction: float = 0.5) -> np.ndarray:
     """
     Merges several grain arrays and crossfades between them
@@ -335,72 +525,65 @@ def merge_crossfade(grains: list, merge_fraction: float = 0.5) -> np.ndarray:
     :param merge_fraction: The fraction of each array that should overlap with the next array (or vice versa, depending on which array is smaller)
     :return: The merged array of grains
     """
-    audio = grains[0]
-    for i in range(1, len(grains)):
-        audio = grain_tools.crossfade(audio, grains[i], merge_fraction)
-    return audio
+    return grain_tools.crossfade_sections(grains, merge_fraction)
 
 
-def randomize_param(grains: list, param: str, rng: random.Random, max_deviation: int, only_positive: bool = False):
+def randomize_param(grains, param: str, rng: random.Random, max_deviation: int, only_positive: bool = False):
     """
     Randomizes a grain parameter
-    :param grains: A list of grain dictionaries
-    :param param: The key to randomize
+    :param grains: A list of grain dictionaries, or a GrainTable
+    :param param: The key (or GrainTable column) to randomize
     :param rng: The random number generator to use
     :param max_deviation: The maximum deviation allowed
     :param only_positive: Whether or not only positive deviation is allowed
     """
-    min_deviation = 0 if only_positive else -max_deviation
-    for grain in grains:
-        grain[param] += rng.randrange(min_deviation, max_deviation + 1)
+    grain_transforms.randomize_param(grains, param, max_deviation, only_positive, _numpy_rng(rng))
 
 
-def swap_nth_adjacent_pair(grains: list, n: int):
+def swap_nth_adjacent_pair(grains, n: int):
     """
     Swaps every n adjacent grain pairs.
-    :param grains: A list of grains
+    :param grains: A list of grains, or a GrainTable
     :param n: Every nth pair will be swapped
     """
-    for i in range(0, len(grains)-1, n):
-        temp = grains[i+1]
-        grains[i+1] = grains[i]
-        grains[i] = temp
+    swap_nth_m_pair(grains, n, 1)
 
 
-def swap_nth_m_pair(grains: list, n: int, m: int):
+def swap_nth_m_pair(grains, n: int, m: int):
     """
     Swaps every n grain pairs of grains spaced n apart
-    :param grains: A list of grains
+    :param grains: A list of grains, or a GrainTable
     :param n: Every nth pair will be swapped
     """
-    for i in range(0, len(grains)-m, n):
-        temp = grains[i+m]
-        grains[i+m] = grains[i]
-        grains[i] = temp
+    grain_transforms.swap_nth_m_pair(grains, n, m)
 
 
-def swap_random_pair(grains: list, prob: float, rng: random.Random):
+def swap_random_pair(grains, prob: float, rng: random.Random):
     """
     Randomly swaps adjacent grain pairs, based on the probability value provided.
     If the grains list is a list of lists, the swap will take place with the next adjacent list,
     mod the number of lists present.
-    :param grains: A list of grains
+    :param grains: A list of grains, or a GrainTable
     :param prob: The probability that any given pair of adjacent grains will be swapped
     :param rng: The random number generator to use
     """
-    if type(grains[0]) == list:
-        for i in range(len(grains)-1):
-            next_idx = (i + 1) % len(grains)
-            for j in range(len(grains[i])):
-                swaps = rng.choices((True, False), weights=(prob, 1-prob), k=10)
-                if rng.choice(swaps):
-                    temp = grains[next_idx][j]
-                    grains[next_idx][j] = grains[i]
-                    grains[i] = temp
-    else:
-        for i in range(len(grains)-1):
-            swaps = rng.choices((True, False), weights=(prob, 1-prob), k=10)
-            if rng.choice(swaps):
-                temp = grains[i]
-                grains[i+1] = grains[i]
+    if isinstance(grains, GrainTable) or len(grains) == 0 or type(grains[0]) != list:
+        grain_transforms.swap_random_pair(grains, prob, _numpy_rng(rng))
+        return
+    for i in range(len(grains)-1):
+        next_idx = (i + 1) % len(grains)
+        for j in range(len(grains[i])):
+            if rng.random() < prob:
+                temp = grains[next_idx][j]
+                grains[next_idx][j] = grains[i]
                 grains[i] = temp
+
+
+def _numpy_rng(rng: random.Random) -> np.random.Generator:
+    """
+    Makes a NumPy generator seeded from a random.Random object, so that vectorized
+    randomization stays reproducible from the same seed
+    :param rng: A random number generator
+    :return: A NumPy random generator
+    """
+    return np.random.default_rng(rng.getrandbits(64))
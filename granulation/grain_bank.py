@@ -0,0 +1,201 @@
+"""
+File: grain_bank.py
+
+Description: A packed grain bank file. The audio of every grain in the grain database
+(or of the grains that match a set of WHERE clauses) is written as float32 samples into one
+file, followed by an index of grain id, offset and length. The bank is memory-mapped when it
+is loaded, so grains can be used without the source audio files, without decoding, and
+without searching for files. The index also holds the file id and frame range of each grain,
+so that grains whose database rows have changed since the export (for example, rowids reused
+after a re-ingest) are not taken from the bank.
+
+File layout (little-endian):
+    header: magic (8 bytes), version (uint64), number of grains (uint64), index offset (uint64)
+    samples: float32 samples of all grains, packed back to back
+    index: grain ids (int64, sorted), sample offsets (int64), lengths (int64), file ids (int64),
+        start frames (int64), end frames (int64)
+"""
+
+import grain_sql
+import numpy as np
+import os
+import sqlite3
+import sys
+
+
+MAGIC = b"GRAINBNK"
+VERSION = 2
+HEADER = np.dtype([("magic", "S8"), ("version", "<u8"), ("num_grains", "<u8"), ("index_offset", "<u8")])
+
+
+class GrainBank:
+    """
+    Represents a memory-mapped grain bank file
+    """
+    def __init__(self, path: str):
+        """
+        Initializes the GrainBank.
+        :param path: The bank file path (made with `export_grain_bank`)
+        """
+        self.path = path
+        header = np.fromfile(path, dtype=HEADER, count=1)[0]
+        if header["magic"] != MAGIC or header["version"] != VERSION:
+            raise Exception(f"{path} is not a version {VERSION} grain bank")
+        num_grains = int(header["num_grains"])
+        index_offset = int(header["index_offset"])
+        # A plain ndarray view of the memory map, because slicing a np.memmap is much slower
+        self.samples = np.memmap(path, dtype="<f4", mode="r", offset=HEADER.itemsize, shape=((index_offset - HEADER.itemsize) // 4,)).view(np.ndarray) \
+            if index_offset > HEADER.itemsize else np.zeros((0), dtype=np.float32)
+        index = np.fromfile(path, dtype="<i8", count=6 * num_grains, offset=index_offset).reshape((6, num_grains))
+        self.ids = index[0]
+        self.offsets = index[1]
+        self.lengths = index[2]
+        self.file_ids = index[3]
+        self.start_frames = index[4]
+        self.end_frames = index[5]
+
+    def __len__(self) -> int:
+        return self.ids.shape[-1]
+
+    def __contains__(self, grain_id) -> bool:
+        position = np.searchsorted(self.ids, grain_id)
+        return bool(position < self.ids.shape[-1] and self.ids[position] == grain_id)
+
+    def __getitem__(self, grain_id) -> np.ndarray:
+        """
+        Gets the audio of a grain
+        :param grain_id: The grain id
+        :return: A read-only view of the grain in the memory-mapped file
+        """
+        position = self.positions([grain_id])[0]
+        if position < 0:
+            raise KeyError(grain_id)
+        return self.samples[self.offsets[position]:self.offsets[position] + self.lengths[position]]
+
+    def positions(self, grain_ids) -> np.ndarray:
+        """
+        Finds grains in the index
+        :param grain_ids: The grain ids
+        :return: The position of each grain in the index, or -1 if the grain is not in the bank
+        """
+        grain_ids = np.asarray(grain_ids, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.ids, grain_ids), max(self.ids.shape[-1] - 1, 0))
+        found = self.ids[positions] == grain_ids if self.ids.shape[-1] > 0 else np.zeros(grain_ids.shape, dtype=bool)
+        return np.where(found, positions, -1)
+
+    def matching_positions(self, grain_entries: list) -> np.ndarray:
+        """
+        Finds grain records in the index, and checks that the bank grains still have the same source
+        :param grain_entries: A list of grain dictionaries, with id, start_frame and end_frame (and file_id, if available)
+        :return: The position of each grain in the index, or -1 if the grain is not in the bank or its
+        file id or frame range is different
+        """
+        positions = self.positions([grain["id"] for grain in grain_entries])
+        found = np.flatnonzero(positions >= 0)
+        if len(found) == 0:
+            return positions
+        entries = [grain_entries[i] for i in found.tolist()]
+        matches = (self.start_frames[positions[found]] == np.array([grain["start_frame"] for grain in entries], dtype=np.int64)) & \
+            (self.end_frames[positions[found]] == np.array([grain["end_frame"] for grain in entries], dtype=np.int64))
+        if "file_id" in entries[0]:
+            matches &= self.file_ids[positions[found]] == np.array([grain["file_id"] for grain in entries], dtype=np.int64)
+        positions[found[~matches]] = -1
+        return positions
+
+    def grains(self, grain_ids) -> list:
+        """
+        Gets the audio of several grains
+        :param grain_ids: The grain ids
+        :return: A list of views of the grains (or None for grains that are not in the bank)
+        """
+        positions = self.positions(grain_ids)
+        if self.ids.shape[-1] == 0:
+            return [None for _ in positions]
+        found = np.maximum(positions, 0)
+        return [None if position < 0 else self.samples[offset:offset + length] for position, offset, length in
+                zip(positions.tolist(), self.offsets[found].tolist(), self.lengths[found].tolist())]
+
+
+def export_grain_bank(cursor: sqlite3.Cursor, bank_path: str, source_dir, predicates: list = None, store=None, cache=None) -> GrainBank:
+    """
+    Writes the audio of grains to a grain bank file. Each source file is read once.
+    :param cursor: The cursor for executing SQL
+    :param bank_path: The bank file path
+    :param source_dir: The directory (or list of directories, or PathIndex) that contains the audio files
+    :param predicates: A list of WHERE clauses (see `grain_sql.select_categories`). The grains that match any of
+    them are exported. If None, every grain in the database is exported.
+    :param store: A SourceStore, or None
+    :param cache: A SourceCache, or None
+    :return: The GrainBank
+    """
+    categories = grain_sql.select_categories(cursor, predicates if predicates is not None else ["1"], grain_sql.RENDER_FIELDS)
+    records = np.concatenate(categories) if len(categories) > 0 else np.zeros((0), dtype=grain_sql.record_dtype(grain_sql.RENDER_FIELDS))
+    records = records[np.unique(records["id"], return_index=True)[1]]
+
+    # Group the grains by source file
+    grain_groups = {}
+    for i, (file_id, file) in enumerate(zip(records["file_id"].tolist(), records["file"].tolist())):
+        if file_id not in grain_groups:
+            grain_groups[file_id] = (file, [])
+        grain_groups[file_id][1].append(i)
+
+    ids = []
+    offsets = []
+    lengths = []
+    sources = []
+    offset = 0
+    with open(bank_path + ".tmp", "wb") as bank_file:
+        np.zeros((1), dtype=HEADER).tofile(bank_file)
+        for i, (file_id, (file, group)) in enumerate(grain_groups.items()):
+            ranges = list(zip(records["start_frame"][group].tolist(), records["end_frame"][group].tolist()))
+            audio_grains = grain_sql.read_grains(file, ranges, source_dir, store, cache, file_id)
+            if audio_grains is None:
+                continue
+            for idx, audio_grain in zip(group, audio_grains):
+                audio_grain = np.asarray(audio_grain, dtype="<f4")
+                if not np.isfinite(audio_grain).all():
+                    continue
+                audio_grain.tofile(bank_file)
+                ids.append(int(records["id"][idx]))
+                offsets.append(offset)
+                lengths.append(audio_grain.shape[-1])
+                sources.append((int(records["file_id"][idx]), int(records["start_frame"][idx]), int(records["end_frame"][idx])))
+                offset += audio_grain.shape[-1]
+            print(f"Exported file {i+1} of {len(grain_groups)}: {file}")
+
+        # Write the index, sorted by grain id
+        order = np.argsort(np.array(ids, dtype=np.int64), kind="stable")
+        sources = np.array(sources, dtype="<i8").reshape((-1, 3))[order]
+        index = np.stack((np.array(ids, dtype="<i8")[order], np.array(offsets, dtype="<i8")[order], np.array(lengths, dtype="<i8")[order],
+                          sources[:, 0], sources[:, 1], sources[:, 2]))
+        index_offset = bank_file.tell()
+        index.tofile(bank_file)
+        bank_file.seek(0)
+        np.array([(MAGIC, VERSION, len(ids), index_offset)], dtype=HEADER).tofile(bank_file)
+    os.replace(bank_path + ".tmp", bank_path)
+    return GrainBank(bank_path)
+
+
+def open_grain_bank(path: str) -> GrainBank:
+    """
+    Opens a grain bank file if it exists and has the current version
+    :param path: The bank file path
+    :return: The GrainBank, or None if there is no usable bank file (it needs to be exported again)
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        return GrainBank(path)
+    except Exception as e:
+        print(f"Not using the grain bank: {e}")
+        return None
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        print("Usage: python grain_bank.py <grain database> <bank file> <source directory> [<source directory> ...]")
+        sys.exit(1)
+    db, cursor = grain_sql.connect_to_db(sys.argv[1])
+    bank = export_grain_bank(cursor, sys.argv[2], sys.argv[3:])
+    db.close()
+    print(f"Exported {len(bank)} grains ({bank.samples.nbytes / 2 ** 20:.1f} MiB)")
@@ -0,0 +1,296 @@
+"""
+File: grain_features.py
+
+Description: Computes the grain features that are stored in the grains table. The spectral
+features are computed from the magnitude spectrum of the Hanning-windowed grain; the features
+that are weighted by spectral power (entropy, flatness and roll-off) use the squared magnitudes.
+"""
+
+import grain_sql
+import numpy as np
+import scipy.fft
+
+
+# The fields of a grain record that are computed from the grain audio
+FEATURE_FIELDS = grain_sql.FIELDS[grain_sql.FIELDS.index("frequency"):]
+
+# The spectral roll-off points, as fractions of the total spectral power
+ROLL_OFFS = {"spectral_roll_off_50": 0.5, "spectral_roll_off_75": 0.75, "spectral_roll_off_90": 0.9, "spectral_roll_off_95": 0.95}
+
+# The frequency bands for the band-limited spectral slopes, in Hz
+SLOPE_BANDS = {"spectral_slope_0_1_khz": (0, 1000), "spectral_slope_1_5_khz": (1000, 5000), "spectral_slope_0_5_khz": (0, 5000)}
+
+# Grains with less power than this are treated as silent and are not analyzed
+SILENCE = 1e-12
+
+# The pitch estimator settings
+MIN_FREQUENCY = 40
+MAX_FREQUENCY = 2000
+PITCH_THRESHOLD = 0.8
+
+_EPSILON = 1e-20
+
+
+def estimate_pitch(grain: np.ndarray, sample_rate: int) -> float:
+    """
+    Estimates the fundamental frequency of a grain from the peak of its normalized autocorrelation
+    :param grain: The grain audio
+    :param sample_rate: The sample rate
+    :return: The frequency in Hz, or None if the grain is not clearly pitched
+    """
+    grain = grain - grain.mean()
+    n = grain.shape[-1]
+    spectrum = np.fft.rfft(grain, 2 * n)
+    autocorrelation = np.fft.irfft(spectrum * np.conj(spectrum))[:n]
+    if autocorrelation[0] <= 0:
+        return None
+    # Normalize for the number of overlapping samples at each lag
+    autocorrelation = autocorrelation / autocorrelation[0] * n / (n - np.arange(n))
+    min_lag = max(int(sample_rate / MAX_FREQUENCY), 1)
+    max_lag = min(int(sample_rate / MIN_FREQUENCY), n // 2)
+    if max_lag <= min_lag:
+        return None
+    # Skip the main lobe around lag 0, then take the first peak above the threshold
+    # (the highest peak is often at a multiple of the period)
+    lag = min_lag
+    while lag < max_lag - 1 and autocorrelation[lag + 1] <= autocorrelation[lag]:
+        lag += 1
+    above = np.nonzero(autocorrelation[lag:max_lag] >= PITCH_THRESHOLD)[0]
+    if above.shape[-1] == 0:
+        return None
+    lag += int(above[0])
+    while lag < max_lag - 1 and autocorrelation[lag + 1] > autocorrelation[lag]:
+        lag += 1
+    # Parabolic interpolation of the peak
+    if min_lag < lag < max_lag - 1:
+        a, b, c = autocorrelation[lag - 1], autocorrelation[lag], autocorrelation[lag + 1]
+        denominator = a - 2 * b + c
+        if denominator != 0:
+            lag = lag + 0.5 * (a - c) / denominator
+    return sample_rate / lag
+
+
+def _slope(freqs: np.ndarray, magnitudes: np.ndarray) -> float:
+    """
+    Fits a line to a magnitude spectrum
+    :param freqs: The bin frequencies
+    :param magnitudes: The bin magnitudes
+    :return: The slope (magnitude per Hz)
+    """
+    if freqs.shape[-1] < 2:
+        return 0.0
+    freq_deviation = freqs - freqs.mean()
+    return float(np.sum(freq_deviation * (magnitudes - magnitudes.mean())) / np.sum(freq_deviation ** 2))
+
+
+def analyze_grain(grain: np.ndarray, sample_rate: int) -> dict:
+    """
+    Computes the features of a grain
+    :param grain: The grain audio (1D)
+    :param sample_rate: The sample rate
+    :return: A dictionary with a value for each of FEATURE_FIELDS, or None if the grain is silent
+    """
+    energy = float(np.mean(grain ** 2))
+    if energy < SILENCE:
+        return None
+    features = {"frequency": estimate_pitch(grain, sample_rate)}
+    features["midi"] = None if features["frequency"] is None else 69 + 12 * np.log2(features["frequency"] / 440)
+    features["energy"] = energy
+
+    magnitudes = np.abs(np.fft.rfft(grain * np.hanning(grain.shape[-1])))
+    freqs = np.fft.rfftfreq(grain.shape[-1], 1 / sample_rate)
+    power = magnitudes ** 2
+    total_magnitude = magnitudes.sum()
+    total_power = power.sum()
+
+    # Spectral moments, weighted by magnitude
+    centroid = np.sum(freqs * magnitudes) / total_magnitude
+    deviation = freqs - centroid
+    variance = np.sum(deviation ** 2 * magnitudes) / total_magnitude
+    features["spectral_centroid"] = centroid
+    features["spectral_variance"] = variance
+    features["spectral_skewness"] = np.sum(deviation ** 3 * magnitudes) / total_magnitude / max(variance ** 1.5, _EPSILON)
+    features["spectral_kurtosis"] = np.sum(deviation ** 4 * magnitudes) / total_magnitude / max(variance ** 2, _EPSILON)
+
+    # Power distribution features
+    distribution = power / total_power
+    features["spectral_entropy"] = -np.sum(distribution * np.log2(distribution + _EPSILON)) / np.log2(power.shape[-1])
+    features["spectral_flatness"] = np.exp(np.mean(np.log(power + _EPSILON))) / (np.mean(power) + _EPSILON)
+    cumulative_power = np.cumsum(power)
+    for field, fraction in ROLL_OFFS.items():
+        features[field] = freqs[min(int(np.searchsorted(cumulative_power, fraction * total_power)), freqs.shape[-1] - 1)]
+
+    # Slopes
+    features["spectral_slope"] = _slope(freqs, magnitudes)
+    for field, (low, high) in SLOPE_BANDS.items():
+        band = (freqs >= low) & (freqs < high)
+        features[field] = _slope(freqs[band], magnitudes[band])
+
+    return {field: None if features[field] is None else float(features[field]) for field in FEATURE_FIELDS}
+
+
+def slice_grains(num_frames: int, grain_length: int, hop: int) -> np.ndarray:
+    """
+    Gets the frame ranges of the grains in an audio file
+    :param num_frames: The number of frames in the file
+    :param grain_length: The grain length
+    :param hop: The distance between grain starts
+    :return: An array of start frames. Each grain ends at start + grain_length.
+    """
+    if num_frames < grain_length:
+        return np.zeros((0), dtype=np.int64)
+    return np.arange(0, num_frames - grain_length + 1, hop, dtype=np.int64)
+
+
+def _batch_slope(freqs: np.ndarray, magnitudes: np.ndarray) -> np.ndarray:
+    """
+    Fits a line to each row of magnitude spectra
+    :param freqs: The bin frequencies
+    :param magnitudes: The bin magnitudes, with shape (num_grains, num_bins)
+    :return: The slope of each row
+    """
+    if freqs.shape[-1] < 2:
+        return np.zeros((magnitudes.shape[0]))
+    freq_deviation = freqs - freqs.mean()
+    return np.sum(freq_deviation * (magnitudes - magnitudes.mean(axis=-1, keepdims=True)), axis=-1) / np.sum(freq_deviation ** 2)
+
+
+def _batch_pitch(grains: np.ndarray, sample_rate: int) -> np.ndarray:
+    """
+    Estimates the fundamental frequency of each grain (see `estimate_pitch`)
+    :param grains: The grains, with shape (num_grains, grain_length)
+    :param sample_rate: The sample rate
+    :return: The frequency of each grain in Hz, or NaN if the grain is not clearly pitched
+    """
+    num_grains, n = grains.shape
+    frequencies = np.full((num_grains), np.nan)
+    min_lag = max(int(sample_rate / MAX_FREQUENCY), 1)
+    max_lag = min(int(sample_rate / MIN_FREQUENCY), n // 2)
+    if max_lag <= min_lag:
+        return frequencies
+    grains = grains - grains.mean(axis=-1, keepdims=True)
+    # Only lags up to max_lag are needed, so the FFT only needs enough padding to avoid wrapping those lags
+    fft_size = scipy.fft.next_fast_len(n + max_lag + 1, real=True)
+    spectrum = scipy.fft.rfft(grains, fft_size, axis=-1)
+    autocorrelation = scipy.fft.irfft(spectrum * np.conj(spectrum), fft_size, axis=-1)[:, :max_lag + 1]
+    energy = autocorrelation[:, :1]
+    valid = energy[:, 0] > 0
+    autocorrelation = autocorrelation / np.where(energy > 0, energy, 1) * n / (n - np.arange(max_lag + 1))
+
+    # Skip the main lobe, take the first peak above the threshold, then climb to the top of the peak
+    lags = np.arange(min_lag, max_lag)
+    window = autocorrelation[:, min_lag:max_lag]
+    rising = np.zeros(window.shape, dtype=bool)
+    rising[:, :-1] = autocorrelation[:, min_lag + 1:max_lag] > window[:, :-1]
+    main_lobe_end = np.where(rising.any(axis=-1), np.argmax(rising, axis=-1), max_lag - 1 - min_lag)
+    above = (window >= PITCH_THRESHOLD) & (lags - min_lag >= main_lobe_end[:, None])
+    valid &= above.any(axis=-1)
+    first = np.argmax(above, axis=-1)
+    falling = ~rising & (lags - min_lag >= first[:, None])
+    falling[:, -1] = True
+    lag = min_lag + np.argmax(falling, axis=-1)
+
+    # Parabolic interpolation of the peak
+    rows = np.arange(num_grains)
+    inner = (lag > min_lag) & (lag < max_lag - 1)
+    a = autocorrelation[rows, np.maximum(lag - 1, 0)]
+    b = autocorrelation[rows, lag]
+    c = autocorrelation[rows, np.minimum(lag + 1, max_lag)]
+    denominator = a - 2 * b + c
+    interpolate = inner & (denominator != 0)
+    lag = np.where(interpolate, lag + 0.5 * (a - c) / np.where(interpolate, denominator, 1), lag)
+    frequencies[valid] = sample_rate / lag[valid]
+    return frequencies
+
+
+def analyze_grains(grains: np.ndarray, sample_rate: int) -> tuple:
+    """
+    Computes the features of many grains of the same length at once. One magnitude spectrum is computed
+    for each grain, and every spectral feature is derived from it with batched reductions.
+    The results match `analyze_grain`.
+    :param grains: The grains, with shape (num_grains, grain_length). This can be a strided view (see `frame_grains`).
+    :param sample_rate: The sample rate
+    :return: A boolean array that is False for silent grains, and an array of features with shape
+    (num_grains, len(FEATURE_FIELDS)). Missing values (the pitch of unpitched grains, and all features of silent grains) are NaN.
+    """
+    num_grains, grain_length = grains.shape
+    features = np.full((num_grains, len(FEATURE_FIELDS)), np.nan)
+    column = {field: i for i, field in enumerate(FEATURE_FIELDS)}
+    energy = np.mean(np.square(grains), axis=-1)
+    sounding = energy >= SILENCE
+    if not sounding.any():
+        return sounding, features
+    grains = grains[sounding]
+    out = features[sounding]
+
+    frequency = _batch_pitch(grains, sample_rate)
+    out[:, column["frequency"]] = frequency
+    with np.errstate(invalid="ignore"):
+        out[:, column["midi"]] = 69 + 12 * np.log2(frequency / 440)
+    out[:, column["energy"]] = energy[sounding]
+
+    magnitudes = np.abs(scipy.fft.rfft(grains * np.hanning(grain_length), axis=-1))
+    freqs = np.fft.rfftfreq(grain_length, 1 / sample_rate)
+    power = np.square(magnitudes)
+    total_magnitude = magnitudes.sum(axis=-1)
+    total_power = power.sum(axis=-1)
+
+    # Spectral moments, weighted by magnitude
+    centroid = magnitudes @ freqs / total_magnitude
+    deviation = freqs - centroid[:, None]
+    deviation_squared = np.square(deviation)
+    variance = np.sum(deviation_squared * magnitudes, axis=-1) / total_magnitude
+    out[:, column["spectral_centroid"]] = centroid
+    out[:, column["spectral_variance"]] = variance
+    out[:, column["spectral_skewness"]] = np.sum(deviation_squared * deviation * magnitudes, axis=-1) / total_magnitude / np.maximum(variance ** 1.5, _EPSILON)
+    out[:, column["spectral_kurtosis"]] = np.sum(np.square(deviation_squared) * magnitudes, axis=-1) / total_magnitude / np.maximum(variance ** 2, _EPSILON)
+
+    # Power distribution features
+    distribution = power / total_power[:, None]
+    out[:, column["spectral_entropy"]] = -np.sum(distribution * np.log2(distribution + _EPSILON), axis=-1) / np.log2(power.shape[-1])
+    out[:, column["spectral_flatness"]] = np.exp(np.mean(np.log(power + _EPSILON), axis=-1)) / (np.mean(power, axis=-1) + _EPSILON)
+    cumulative_power = np.cumsum(power, axis=-1)
+    for field, fraction in ROLL_OFFS.items():
+        idx = np.sum(cumulative_power < fraction * total_power[:, None], axis=-1)
+        out[:, column[field]] = freqs[np.minimum(idx, freqs.shape[-1] - 1)]
+
+    # Slopes
+    out[:, column["spectral_slope"]] = _batch_slope(freqs, magnitudes)
+    for field, (low, high) in SLOPE_BANDS.items():
+        band = (freqs >= low) & (freqs < high)
+        out[:, column[field]] = _batch_slope(freqs[band], magnitudes[:, band])
+
+    features[sounding] = out
+    return sounding, features
+
+
+def frame_grains(samples: np.ndarray, grain_length: int, hop: int) -> np.ndarray:
+    """
+    Frames audio into grains without copying it
+    :param samples: The audio (1D)
+    :param grain_length: The grain length
+    :param hop: The distance between grain starts
+    :return: A read-only strided view with shape (num_grains, grain_length). The grain starts are `slice_grains(...)`.
+    """
+    if samples.shape[-1] < grain_length:
+        return np.zeros((0, grain_length), dtype=samples.dtype)
+    return np.lib.stride_tricks.sliding_window_view(samples, grain_length)[::hop]
+
+
+def analyze_file_grains(samples: np.ndarray, sample_rate: int, grain_length: int, hop: int, chunk_size: int = 256) -> tuple:
+    """
+    Slices audio into grains and computes their features, in chunks of grains
+    :param samples: The audio (1D)
+    :param sample_rate: The sample rate
+    :param grain_length: The grain length
+    :param hop: The distance between grain starts
+    :param chunk_size: The number of grains to analyze at a time (this limits the memory use)
+    :return: The start frames of the grains that are not silent, and their features (see `analyze_grains`)
+    """
+    starts = slice_grains(samples.shape[-1], grain_length, hop)
+    grains = frame_grains(samples, grain_length, hop)
+    sounding = np.zeros((starts.shape[-1]), dtype=bool)
+    features = np.zeros((starts.shape[-1], len(FEATURE_FIELDS)))
+    for i in range(0, starts.shape[-1], chunk_size):
+        sounding[i:i + chunk_size], features[i:i + chunk_size] = analyze_grains(grains[i:i + chunk_size], sample_rate)
+    return starts[sounding], features[sounding]
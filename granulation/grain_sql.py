@@ -6,12 +6,15 @@ Description: Works with SQL database for granulation
 
 import sqlite3
 import aus.audiofile as audiofile
+import json
 import numpy as np
 import os
+from path_index import PathIndex, basename
 
 
+# The columns of the grains view (see migrate.py)
 FIELDS = [
-    "id", "file", "start_frame", "end_frame", "length", "sample_rate", "grain_duration",
+    "id", "file", "file_id", "start_frame", "end_frame", "length", "sample_rate", "grain_duration",
     "frequency", "midi", "energy", "spectral_centroid", "spectral_entropy", "spectral_flatness",
     "spectral_kurtosis", "spectral_roll_off_50", "spectral_roll_off_75",
     "spectral_roll_off_90", "spectral_roll_off_95", "spectral_skewness", "spectral_slope",
@@ -19,6 +22,24 @@ FIELDS = [
     "spectral_variance"
 ]
 
+# The fields that realize_grains and the renderers use
+RENDER_FIELDS = ["id", "file", "file_id", "start_frame", "end_frame"]
+
+# The NumPy types of the integer and text fields. All other fields are float64 (NULL becomes NaN).
+FIELD_TYPES = {
+    "id": np.int64, "file": object, "file_id": np.int64, "start_frame": np.int64, "end_frame": np.int64,
+    "length": np.int64, "sample_rate": np.int64
+}
+
+
+def record_dtype(fields: list = FIELDS) -> np.dtype:
+    """
+    Gets the structured array type for grain records
+    :param fields: The field names
+    :return: The structured dtype
+    """
+    return np.dtype([(field, FIELD_TYPES.get(field, np.float64)) for field in fields])
+
 
 def connect_to_db(path):
     """
@@ -41,17 +62,14 @@ def find_path(database_path, parent_directory) -> str:
     - If there are multiple files located somewhere under the provided parent directory, this function might
       not find the right file. Don't have duplicate file names in the database.
     :param database_path: The path of the file in the database
-    :param parent_directory: The directory containing the file
+    :param parent_directory: The directory containing the file, a list of directories, or a PathIndex
+    (see path_index.py). A PathIndex resolves the path with a dictionary lookup rather than walking the directories.
     :return: The actual file path on this machine
     """
+    if isinstance(parent_directory, PathIndex):
+        return parent_directory.find(database_path)
     # Need to compensate for os.path.split() not working properly on paths for other platform
-    idx = len(database_path) - 1
-    while idx >= 0:
-        if database_path[idx] == "\\" or database_path[idx] == "/":
-            break
-        idx -= 1
-    if idx >= 0:
-        database_path = database_path[idx+1:]
+    database_path = basename(database_path)
     # print(f"Trying to find file {database_path}")
     if type(parent_directory) == list:
         for dir in parent_directory:
@@ -68,75 +86,338 @@ def find_path(database_path, parent_directory) -> str:
     return ""
 
 
-def realize_grains(grain_entries: list, source_dir):
+def select_categories(cursor: sqlite3.Cursor, predicates: list, fields: list = FIELDS, chunk_size: int = 65536, cache=None) -> list:
+    """
+    Retrieves the grain records for several categories with one query. Each category is a WHERE clause;
+    the clauses are combined into one tagged UNION ALL query, so the table is only visited once per
+    distinct clause and no per-row dictionaries are made.
+    :param cursor: The cursor for executing SQL
+    :param predicates: A list of WHERE clauses (without the WHERE keyword), or (clause, parameters) tuples
+    :param fields: The fields to retrieve. Retrieving only the fields that are needed (such as RENDER_FIELDS) is much faster.
+    :param chunk_size: The number of rows to convert at a time
+    :param cache: A QueryCache (see query_cache.py). If provided, the result of each predicate is loaded from the cache
+    if the database hasn't changed since it was stored, and only the other predicates are queried.
+    :return: A list of structured arrays (see `record_dtype`), one for each predicate. Identical predicates
+    share the same array.
+    """
+    # Each distinct predicate is only queried once
+    predicates = [(predicate, ()) if type(predicate) == str else (predicate[0], tuple(predicate[1])) for predicate in predicates]
+    distinct = list(dict.fromkeys(predicates))
+    columns = ", ".join(fields)
+    if cache is not None:
+        keys = {predicate: cache.key(cursor, f"SELECT {columns} FROM grains WHERE ({predicate[0]})", predicate[1], fields) for predicate in distinct}
+        categories = {predicate: cache.get(keys[predicate]) for predicate in distinct}
+        missing = [predicate for predicate in distinct if categories[predicate] is None]
+        if len(missing) > 0:
+            for predicate, category in zip(missing, select_categories(cursor, missing, fields, chunk_size)):
+                cache.put(keys[predicate], category)
+                categories[predicate] = category
+        return [categories[predicate] for predicate in predicates]
+    sql = " UNION ALL ".join(f"SELECT {i} AS category, {columns} FROM grains WHERE ({clause})" for i, (clause, _) in enumerate(distinct))
+    params = [param for _, clause_params in distinct for param in clause_params]
+    cursor.execute(sql + ";", params)
+
+    # Convert the rows to structured arrays in chunks, so that only one chunk of row tuples exists at a time
+    dtype = record_dtype(fields)
+    tagged_dtype = np.dtype([("category", np.int64)] + [(field, dtype[field]) for field in fields])
+    chunks = []
+    while True:
+        records = cursor.fetchmany(chunk_size)
+        if len(records) == 0:
+            break
+        chunks.append(np.array(records, dtype=tagged_dtype))
+        del records
+
+    # Group the records by category. The returned arrays are views without the category field.
+    tagged = np.concatenate(chunks) if len(chunks) > 0 else np.zeros((0), dtype=tagged_dtype)
+    del chunks
+    tags = tagged["category"]
+    table = tagged[np.argsort(tags, kind="stable")][fields]
+    boundaries = np.cumsum(np.bincount(tags, minlength=len(distinct)))[:-1]
+    categories = dict(zip(distinct, np.split(table, boundaries)))
+    return [categories[predicate] for predicate in predicates]
+
+
+def sample_grains(cursor: sqlite3.Cursor, predicate, k: int, seed=None, exclude: list = None, fields: list = RENDER_FIELDS,
+                  min_acceptance: float = 0.02, cache=None) -> np.ndarray:
+    """
+    Draws k uniform random grains (without replacement) that match a WHERE clause, without retrieving the whole category.
+    Random ids are drawn from the id range and looked up by primary key, and the ids that don't match are rejected,
+    so the cost scales with k (divided by the fraction of the table that matches). If too few of the drawn ids match,
+    the ids that match the predicate are read from the index (without the other fields) and looked up in a random order.
+    :param cursor: The cursor for executing SQL
+    :param predicate: A WHERE clause (without the WHERE keyword), or a (clause, parameters) tuple
+    :param k: The number of grains to draw. If fewer grains match, all of them are returned.
+    :param seed: The random seed (or a numpy Generator). The same seed draws the same grains from the same database.
+    :param exclude: A list of WHERE clauses (or (clause, parameters) tuples) for grains to leave out,
+    for example "file LIKE '%church-bell%'"
+    :param fields: The fields to retrieve
+    :param min_acceptance: If the fraction of drawn ids that match is lower than this, the ids that match the predicate
+    are read instead
+    :param cache: A QueryCache (see query_cache.py). If provided and the seed is an integer (or a sequence of integers),
+    the sample is loaded from the cache if the database hasn't changed since it was stored. Only the k grains drawn
+    are stored, not the category.
+    :return: A structured array (see `record_dtype`) of the grains, in the order they were drawn
+    """
+    rng = np.random.default_rng(seed)
+    clauses = [predicate if type(predicate) != str else (predicate, ())]
+    for clause in exclude if exclude is not None else []:
+        clause = clause if type(clause) != str else (clause, ())
+        clauses.append((f"NOT ({clause[0]})", clause[1]))
+    where = " AND ".join(f"({clause})" for clause, _ in clauses)
+    params = [param for _, clause_params in clauses for param in clause_params]
+    select = f"SELECT id, {', '.join(fields)} FROM grains WHERE id IN (SELECT value FROM json_each(?)) AND {where};"
+    if cache is not None and seed is not None and not isinstance(seed, np.random.Generator):
+        # The same query, seed and k draw the same grains, so the sample is keyed by all of them
+        key = cache.key(cursor, f"SAMPLE {k} SEED {np.asarray(seed).tolist()} ACCEPTANCE {min_acceptance} FROM grains WHERE {where}", params, fields)
+        sample = cache.get(key)
+        if sample is None:
+            sample = sample_grains(cursor, predicate, k, seed, exclude, fields, min_acceptance)
+            cache.put(key, sample)
+        return sample
+
+    # Separate subqueries, so that SQLite reads the ends of the primary key instead of scanning the table
+    cursor.execute("SELECT (SELECT MIN(id) FROM grains), (SELECT MAX(id) FROM grains);")
+    min_id, max_id = cursor.fetchone()
+    if min_id is None or k <= 0:
+        return np.zeros((0), dtype=record_dtype(fields))
+    span = max_id - min_id + 1
+
+    # Rejection sampling on the id range. Every round looks up ids that haven't been drawn yet, so the
+    # accepted grains (in the order they were drawn) are a uniform sample of the matching grains.
+    records = {}
+    order = []
+    drawn = np.zeros((0), dtype=np.int64)
+
+    def look_up(ids: np.ndarray):
+        cursor.execute(select, [json.dumps(ids.tolist())] + params)
+        for record in cursor.fetchall():
+            records[record[0]] = record[1:]
+        order.extend(grain_id for grain_id in ids.tolist() if grain_id in records)
+        del order[k:]
+
+    while len(order) < k and drawn.shape[-1] < span:
+        acceptance = len(order) / drawn.shape[-1] if drawn.shape[-1] > 0 else 1.0
+        if acceptance < min_acceptance:
+            break
+        candidates = _draw_new(rng, span, drawn, min(int((k - len(order)) / acceptance * 1.25) + 16, span - drawn.shape[-1]))
+        drawn = np.concatenate((drawn, candidates))
+        look_up(candidates + min_id)
+
+    if len(order) < k and drawn.shape[-1] < span:
+        # Too few ids match, so read the ids that match the predicate (from the index) and look them up in a random order.
+        # The exclusions are checked in the lookups, because they might not be covered by an index.
+        predicate_clause, predicate_params = clauses[0]
+        cursor.execute(f"SELECT id FROM grains WHERE ({predicate_clause});", predicate_params)
+        ids = np.sort(np.array([record[0] for record in cursor.fetchall()], dtype=np.int64))
+        ids = rng.permutation(ids[~np.isin(ids, drawn + min_id)])
+        position = 0
+        while len(order) < k and position < ids.shape[-1]:
+            batch_size = int((k - len(order)) * 1.25) + 16
+            look_up(ids[position:position + batch_size])
+            position += batch_size
+    return np.array([records[grain_id] for grain_id in order], dtype=record_dtype(fields))
+
+
+def _draw_new(rng: np.random.Generator, span: int, drawn: np.ndarray, n: int) -> np.ndarray:
+    """
+    Draws distinct random integers in [0, span) that have not been drawn yet
+    :param rng: The random number generator
+    :param span: The size of the range
+    :param drawn: The integers that have been drawn already
+    :param n: The number of integers to draw (at most span - len(drawn))
+    :return: The integers, in the order they were drawn
+    """
+    if 4 * (drawn.shape[-1] + n) >= span:
+        # Most of the range is needed, so draw from the integers that are left
+        return rng.choice(np.setdiff1d(np.arange(span), drawn), size=n, replace=False)
+    new = np.zeros((0), dtype=np.int64)
+    while new.shape[-1] < n:
+        candidates = np.concatenate((new, rng.integers(0, span, 2 * (n - new.shape[-1]))))
+        candidates = candidates[~np.isin(candidates, drawn)]
+        _, first = np.unique(candidates, return_index=True)
+        new = candidates[np.sort(first)]
+    return new[:n]
+
+
+def record_dicts(records, indices=None) -> list:
+    """
+    Makes grain dictionaries from grain records, for use with `realize_grains`
+    :param records: A structured array from `select_categories`, or a list of grain dictionaries
+    :param indices: The indices of the records to use. If None, all records are used.
+    :return: A list of new grain dictionaries
+    """
+    if isinstance(records, np.ndarray):
+        if indices is not None:
+            records = records[np.asarray(indices, dtype=np.int64)]
+        return [dict(zip(records.dtype.names, record)) for record in records.tolist()]
+    if indices is None:
+        indices = range(len(records))
+    return [dict(records[idx]) for idx in indices]
+
+
+def realize_grains(grain_entries: list, source_dir, store=None, cache=None, bank=None):
     """
     Extracts the corresponding grains from database records.
     :param grain_entries: The grain records to use
     :param source_dir: The directory that contains the audio files to extract grains from.
     This is needed because this might not be the directory the audio files were contained
-    in when the granulation analysis was performed.
+    in when the granulation analysis was performed. This can also be a PathIndex (see path_index.py),
+    which finds the files without walking the directories.
+    :param store: A SourceStore (see source_store.py). If provided, grains from files in the store are
+    zero-copy views into memory-mapped files, and only files that are not in the store are decoded.
+    :param cache: A SourceCache (see source_cache.py). If provided, decoded files are kept in the cache
+    and reused by later calls.
+    :param bank: A GrainBank (see grain_bank.py). If provided, grains in the bank are views into the
+    memory-mapped bank file, and only the grains that are not in the bank (or whose file or frame range
+    has changed since the bank was exported) are read from the source files.
     :return: A list of audio grain dictionaries
     """
-    # Group the grains by source file
+    # Group the grains by source file (by file_id if the records have it, which is cheaper than hashing paths)
     grain_groups = {}
+    bank_grains = []
+    in_bank = bank.matching_positions(grain_entries) >= 0 if bank is not None else np.zeros((len(grain_entries)), dtype=bool)
     for i, grain in enumerate(grain_entries):
-        if grain["file"] not in grain_groups:
-            grain_groups[grain["file"]] = []
-        grain_groups[grain["file"]].append((i, grain))
+        if in_bank[i]:
+            bank_grains.append((i, grain))
+            continue
+        key = grain["file_id"] if "file_id" in grain else grain["file"]
+        if key not in grain_groups:
+            grain_groups[key] = []
+        grain_groups[key].append((i, grain))
     
     # A list of realized grain dictionaries
     realized_grains = [0 for _ in range(len(grain_entries))]  
 
-    for audio_file, grain_list in grain_groups.items():
-        path = find_path(audio_file, source_dir)
-        if not os.path.exists(path):
-            print(f"Could not find path {path} for file {grain['file']}")
-            print(f"The source directory was {source_dir}")
-        else:
-            audio = audiofile.read(path)
-            for grain_tup in grain_list:
-                idx = grain_tup[0]
-                grain = grain_tup[1]
-                grain["spectral_roll_off_50"] = round(grain["spectral_roll_off_50"], 2)
-                grain["spectral_centroid"] = round(grain["spectral_centroid"], -1)
-                grain["grain"] = audio.samples[0][grain["start_frame"]:grain["end_frame"]]
-                if not (np.isnan(grain["grain"]).any() or np.isinf(grain["grain"]).any() or np.isneginf(grain["grain"]).any()):
-                    realized_grains[idx] = grain
-            del audio.samples
+    if len(bank_grains) > 0:
+        # Grains with NaN or infinite samples are not exported to the bank, so they don't need to be checked again
+        _attach_grains(bank_grains, bank.grains([grain["id"] for _, grain in bank_grains]), realized_grains, False)
+    for grain_list in grain_groups.values():
+        ranges = [(grain["start_frame"], grain["end_frame"]) for _, grain in grain_list]
+        audio_grains = read_grains(grain_list[0][1]["file"], ranges, source_dir, store, cache, grain_list[0][1].get("file_id"))
+        if audio_grains is None:
+            continue
+        _attach_grains(grain_list, audio_grains, realized_grains)
                     
     return realized_grains
 
 
+def _attach_grains(grain_list: list, audio_grains: list, realized_grains: list, check: bool = True):
+    """
+    Adds grain audio to grain dictionaries. Grains with NaN or infinite samples are left out.
+    :param grain_list: A list of (index, grain dictionary) tuples
+    :param audio_grains: The audio of each grain
+    :param realized_grains: The list of realized grains, which is updated at the grain indices
+    :param check: Whether to check the audio for NaN and infinite samples
+    """
+    for grain_tup, audio_grain in zip(grain_list, audio_grains):
+        idx = grain_tup[0]
+        grain = grain_tup[1]
+        if "spectral_roll_off_50" in grain:
+            grain["spectral_roll_off_50"] = round(grain["spectral_roll_off_50"], 2)
+        if "spectral_centroid" in grain:
+            grain["spectral_centroid"] = round(grain["spectral_centroid"], -1)
+        grain["grain"] = audio_grain
+        if not check or not (np.isnan(grain["grain"]).any() or np.isinf(grain["grain"]).any() or np.isneginf(grain["grain"]).any()):
+            realized_grains[idx] = grain
+
+
+def read_grains(audio_file: str, ranges: list, source_dir, store=None, cache=None, file_id: int = None) -> list:
+    """
+    Reads grain audio from a source file
+    :param audio_file: The file name as stored in the database
+    :param ranges: A list of (start_frame, end_frame) tuples
+    :param source_dir: The directory (or list of directories, or PathIndex) that contains the audio files
+    :param store: A SourceStore, or None
+    :param cache: A SourceCache, or None
+    :param file_id: The file id, which is used to find the file in the store. If None, the store is searched by file name.
+    :return: A list of grain arrays (from channel 0), or None if the file could not be found
+    """
+    if store is not None and file_id is None:
+        file_id = store.file_ids.get(audio_file)
+    if store is not None and file_id is not None and file_id in store:
+        samples = store.samples(file_id)[0]
+        return [samples[start:end] for start, end in ranges]
+    if cache is not None:
+        return cache.get(audio_file, ranges, lambda: _decode(audio_file, source_dir))
+    samples = _decode(audio_file, source_dir)
+    if samples is None:
+        return None
+    return [samples[start:end] for start, end in ranges]
+
+
+def _decode(audio_file: str, source_dir) -> np.ndarray:
+    """
+    Finds and decodes a source file
+    :param audio_file: The file name as stored in the database
+    :param source_dir: The directory (or list of directories, or PathIndex) that contains the audio files
+    :return: The channel 0 samples, or None if the file could not be found
+    """
+    path = find_path(audio_file, source_dir)
+    if not os.path.exists(path):
+        print(f"Could not find path {path} for file {audio_file}")
+        print(f"The source directory was {source_dir}")
+        return None
+    return audiofile.read(path).samples[0]
+
+
 def store_grains(grains, db, cursor):
     """
-    Stores grains in the database
-    :param grains: A list of grain dictionaries
+    Stores grains in the database. The grains view adds new files to the files table.
+    :param grains: A list of grain tuples, with the fields in FIELDS order without the id and file_id
     :param db: A connection to a SQLite database
     :param cursor: The cursor for executing SQL
     """
-    SQL = "INSERT INTO grains VALUES(NULL, " + "?, " * 20 + "?)"
+    columns = [field for field in FIELDS[1:] if field != "file_id"]
+    SQL = f"INSERT INTO grains ({', '.join(columns)}) VALUES(" + "?, " * (len(columns) - 1) + "?)"
     cursor.executemany(SQL, grains)
     db.commit()
 
 
-def update_grain_root(cursor: sqlite3.Cursor, root_dir: str, root_dir_path: str):
+def update_grain_root(cursor: sqlite3.Cursor, root_dir: str, root_dir_path: str, index: PathIndex = None):
     """
-    Updates the path of all grains with `root_dir` in their paths.
+    Updates the path of all files with `root_dir` in their paths. Only the files table is updated,
+    so the grain rows are not touched. The part of each path after `root_dir/` is kept, relative to
+    `root_dir_path`. Files that would end up with the same path as another file are reported and skipped.
     :param root_dir: The root directory
     :param root_dir_path: The new path to this root directory
+    :param index: A PathIndex (see path_index.py). If provided, a file that is not in the index at its
+    new path is looked up by name, and moved to the path in the index if that path is under `root_dir_path`.
     """
-    SQL = "SELECT id, file FROM grains WHERE file LIKE ? OR file LIKE ?;"
-    cursor.execute(SQL, (f"%{root_dir}/%", f"%{root_dir}\\%"))
+    new_root = os.path.join(root_dir_path, "")
+    new_root_slashes = new_root.replace("\\", "/")
+    cursor.execute("SELECT id, replace(root || path, '\\', '/') FROM files;")
     records = cursor.fetchall()
-    newrecords = []
-    for record in records:
-        path = record[1].replace("\\", "/")
-        path = path.split(f"{root_dir}/")[1]
-        path = os.path.join(root_dir_path, path)
-        newrecords.append((path, record[0]))
-    print(f"Updating {len(records)} records")
-    SQL = "UPDATE grains SET file = ? WHERE id = ?;"
-    cursor.executemany(SQL, newrecords)
+    moves = {}
+    for file_id, file in records:
+        _, found, relative_path = file.partition(f"{root_dir}/")
+        if not found:
+            continue
+        root, path = new_root, relative_path
+        if index is not None and not index.contains(root + path):
+            # This is one lookup per file, not per grain
+            indexed_path = index.find(file)
+            if indexed_path.replace("\\", "/").startswith(new_root_slashes):
+                path = basename(indexed_path)
+                root = indexed_path[:len(indexed_path) - len(path)]
+        moves[file_id] = (root, path)
+
+    # Find the files that would collide with each other or with a file that is not moved
+    owners = {file: [file_id] for file_id, file in records if file_id not in moves}
+    for file_id, (root, path) in moves.items():
+        owners.setdefault((root + path).replace("\\", "/"), []).append(file_id)
+    skipped = set()
+    for file, file_ids in owners.items():
+        moved_ids = [file_id for file_id in file_ids if file_id in moves]
+        if len(file_ids) > 1 and len(moved_ids) > 0:
+            print(f"Skipping {len(moved_ids)} files that would move to {file}")
+            skipped.update(moved_ids)
+    updates = [(root, path, file_id) for file_id, (root, path) in moves.items() if file_id not in skipped]
+
+    # Move the files out of the way first, so files can take each other's old paths
+    print(f"Updating {len(updates)} files")
+    cursor.executemany("UPDATE files SET root = ?, path = id WHERE id = ?;", [("\0", update[2]) for update in updates])
+    cursor.executemany("UPDATE files SET root = ?, path = ? WHERE id = ?;", updates)
 
 
 if __name__ == "__main__":
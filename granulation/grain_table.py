@@ -0,0 +1,165 @@
+"""
+File: grain_table.py
+
+Description: A compact, columnar alternative to lists of grain dictionaries.
+Per-grain values (grain, channel, distance_between_grains, start_idx) are stored in
+contiguous NumPy arrays, and the grain audio is stored once in a grain bank
+(a list of audio arrays) that the table refers to by index.
+"""
+
+import numpy as np
+
+
+class GrainTable:
+    """
+    A table of grains. The columns have the same names as the keys of a grain dictionary,
+    except that `grain` holds an index into `bank` rather than the audio itself.
+    """
+    def __init__(self, bank: list, grain, channel=None, distance_between_grains=None, start_idx=None):
+        """
+        Initializes the GrainTable.
+        :param bank: A list of grain audio arrays
+        :param grain: The index in the bank of the audio for each grain
+        :param channel: The channel index of each grain. If None, all grains will be in channel 0.
+        :param distance_between_grains: The distance between each grain and the previous grain, in frames. If None, this will be 0.
+        :param start_idx: The start index of each grain. If None, this will be 0. Use `grain_assembler.calculate_grain_positions` to calculate it.
+        """
+        self.bank = bank
+        self.grain = np.asarray(grain, dtype=np.int32)
+        num_grains = self.grain.shape[-1]
+        self.channel = np.zeros((num_grains), dtype=np.int16) if channel is None else np.asarray(channel, dtype=np.int16)
+        self.distance_between_grains = np.zeros((num_grains), dtype=np.int32) if distance_between_grains is None else np.asarray(distance_between_grains, dtype=np.int32)
+        self.start_idx = np.zeros((num_grains), dtype=np.int64) if start_idx is None else np.asarray(start_idx, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return self.grain.shape[-1]
+
+    def __getitem__(self, key):
+        """
+        Selects grains by slice, index, index array or boolean mask
+        :param key: The selection
+        :return: A new GrainTable that shares this table's bank
+        """
+        if isinstance(key, (int, np.integer)):
+            key = slice(key, key + 1 if key != -1 else None)
+        return self.take(key)
+
+    def __add__(self, other):
+        return GrainTable.concatenate([self, other])
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """
+        The length of each grain, in frames
+        """
+        bank_lengths = np.array([audio.shape[-1] for audio in self.bank], dtype=np.int64)
+        return bank_lengths[self.grain]
+
+    @property
+    def end_idx(self) -> np.ndarray:
+        """
+        The end index of each grain
+        """
+        return self.start_idx + self.lengths
+
+    @property
+    def nbytes(self) -> int:
+        """
+        The number of bytes used by the per-grain columns (not including the bank)
+        """
+        return self.grain.nbytes + self.channel.nbytes + self.distance_between_grains.nbytes + self.start_idx.nbytes
+
+    def audio(self, i: int) -> np.ndarray:
+        """
+        Gets the audio of a grain
+        :param i: The index of the grain in the table
+        :return: The grain audio
+        """
+        return self.bank[self.grain[i]]
+
+    def take(self, indices):
+        """
+        Selects grains
+        :param indices: A slice, index array or boolean mask
+        :return: A new GrainTable that shares this table's bank
+        """
+        return GrainTable(self.bank, self.grain[indices], self.channel[indices], self.distance_between_grains[indices], self.start_idx[indices])
+
+    def reorder(self, indices):
+        """
+        Reorders (or selects) the grains in this table, in place
+        :param indices: An index array or boolean mask
+        """
+        self.grain = self.grain[indices]
+        self.channel = self.channel[indices]
+        self.distance_between_grains = self.distance_between_grains[indices]
+        self.start_idx = self.start_idx[indices]
+
+    @staticmethod
+    def concatenate(tables: list):
+        """
+        Concatenates grain tables. If the tables do not share a bank, their banks are combined.
+        :param tables: A list of GrainTables
+        :return: A new GrainTable
+        """
+        if len(tables) == 0:
+            return GrainTable([], [])
+        bank = tables[0].bank
+        if all(table.bank is bank for table in tables):
+            grain = np.concatenate([table.grain for table in tables])
+        else:
+            # Combine the banks, and shift the grain indices of each table by the bank offset
+            bank = []
+            bank_ids = {}
+            grain = []
+            for table in tables:
+                if id(table.bank) not in bank_ids:
+                    bank_ids[id(table.bank)] = len(bank)
+                    bank += table.bank
+                grain.append(table.grain + bank_ids[id(table.bank)])
+            grain = np.concatenate(grain)
+        return GrainTable(
+            bank,
+            grain,
+            np.concatenate([table.channel for table in tables]),
+            np.concatenate([table.distance_between_grains for table in tables]),
+            np.concatenate([table.start_idx for table in tables])
+        )
+
+    @staticmethod
+    def from_list(grains: list):
+        """
+        Makes a GrainTable from a list of grain dictionaries. Grain dictionaries
+        that share the same audio array share the same bank entry.
+        :param grains: A list of grain dictionaries
+        :return: A new GrainTable
+        """
+        bank = []
+        bank_ids = {}
+        grain = np.zeros((len(grains)), dtype=np.int32)
+        for i, grain_dict in enumerate(grains):
+            if id(grain_dict["grain"]) not in bank_ids:
+                bank_ids[id(grain_dict["grain"])] = len(bank)
+                bank.append(grain_dict["grain"])
+            grain[i] = bank_ids[id(grain_dict["grain"])]
+        return GrainTable(
+            bank,
+            grain,
+            [grain_dict.get("channel", 0) for grain_dict in grains],
+            [grain_dict.get("distance_between_grains", 0) for grain_dict in grains],
+            [grain_dict.get("start_idx", 0) for grain_dict in grains]
+        )
+
+    def to_list(self) -> list:
+        """
+        Makes a list of grain dictionaries from this table
+        :return: A list of grain dictionaries
+        """
+        lengths = self.lengths
+        return [{
+            "grain": self.bank[self.grain[i]],
+            "channel": int(self.channel[i]),
+            "distance_between_grains": int(self.distance_between_grains[i]),
+            "start_idx": int(self.start_idx[i]),
+            "end_idx": int(self.start_idx[i] + lengths[i])
+        } for i in range(len(self))]
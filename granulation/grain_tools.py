@@ -1,12 +1,23 @@
 """
 File: grain_tools.py
 
-This file is for granulation tools. You need to build it before using it:
-`python setup.py build_ext --inplace
+This file is for granulation tools. It is written in Cython's pure Python mode, so it can be
+used without building it, but it is much faster if you build it first:
+`python setup.py build_ext --inplace`
+
+When the module is compiled, the loops run in typed-memoryview kernels without the GIL, and
+`merge_grains` splits the output into time tiles that are merged by several threads (OpenMP).
+When it is not compiled, the same functions use vectorized NumPy code instead.
 """
 
 import cython
+from cython.parallel import prange
 import numpy as np
+import os
+
+
+# Whether the compiled extension is being used
+COMPILED = cython.compiled
 
 
 def crossfade(audio1: np.ndarray, audio2: np.ndarray, merge_fraction: cython.double):
@@ -17,32 +28,95 @@ def crossfade(audio1: np.ndarray, audio2: np.ndarray, merge_fraction: cython.dou
     :param merge_fraction: The percentage of overlap for merging. The smallest audio array will be chosen for calculating this percentage.
     :return: The merged audio
     """
-    i: cython.int
-    j: cython.int
-    start_idx: cython.int
     overlap_len = int(min(audio1.shape[-1], audio2.shape[-1]) * merge_fraction)
-    x = np.linspace(0, np.pi / 2, overlap_len, False)
-    sin_arr = np.sin(x)
-    cos_arr = np.cos(x)
     if audio1.ndim == 2:
         new_audio = np.hstack((audio1, np.zeros((audio1.shape[0], audio2.shape[-1] - overlap_len))))
-        start_idx = audio1.shape[-1] - overlap_len
-        for i in range(audio1.shape[0]):
-            for j in range(0, overlap_len):
-                new_audio[i, j + start_idx] = new_audio[i, j + start_idx] * cos_arr[j] + audio2[i, j] * sin_arr[j]
-            for j in range(overlap_len, audio2.shape[-1]):
-                new_audio[i, j + start_idx] = audio2[i, j]
-    elif audio1.ndim == 1:
+    else:
         new_audio = np.hstack((audio1, np.zeros((audio2.shape[-1] - overlap_len))))
-        start_idx = audio1.shape[-1] - overlap_len
-        for j in range(0, overlap_len):
-            new_audio[j + start_idx] = new_audio[j + start_idx] * cos_arr[j] + audio2[j] * sin_arr[j]
-        for j in range(overlap_len, audio2.shape[-1]):
-            new_audio[j + start_idx] = audio2[j]
+    _fade_in(new_audio, audio2, audio1.shape[-1] - overlap_len, overlap_len)
     return new_audio
-   
 
-def merge_grain(audio: np.ndarray, grain: np.ndarray, start_idx: cython.int, end_idx: cython.int, channel: cython.int):
+
+def crossfade_sections(sections: list, merge_fraction: cython.double):
+    """
+    Crossfades a sequence of audio arrays, with the same result as calling `crossfade` on each array in turn
+    (audio = crossfade(audio, section, merge_fraction)). The offsets of all sections are calculated first,
+    the output is allocated once, and each overlap is faded in place,
+    so the cost is linear in the length of the output rather than quadratic in the number of sections.
+    :param sections: A list of audio arrays (all 1D, or all 2D with the same number of channels)
+    :param merge_fraction: The percentage of overlap for merging. For each section, the smaller of the section
+    and the audio merged so far is used for calculating this percentage.
+    :return: The merged audio
+    """
+    i: cython.int
+    if len(sections) == 1:
+        return sections[0]
+
+    # The start of each section and the length of its overlap with the audio before it
+    starts = [0]
+    overlaps = [0]
+    length = sections[0].shape[-1]
+    for i in range(1, len(sections)):
+        overlap_len = int(min(length, sections[i].shape[-1]) * merge_fraction)
+        starts.append(length - overlap_len)
+        overlaps.append(overlap_len)
+        length += sections[i].shape[-1] - overlap_len
+
+    new_audio = np.zeros(sections[0].shape[:-1] + (length,), dtype=np.result_type(np.float64, *sections))
+    new_audio[..., :sections[0].shape[-1]] = sections[0]
+    for i in range(1, len(sections)):
+        _fade_in(new_audio, sections[i], starts[i], overlaps[i])
+    return new_audio
+
+
+def _fade_in(new_audio: np.ndarray, audio2: np.ndarray, start_idx: cython.Py_ssize_t, overlap_len: cython.Py_ssize_t):
+    """
+    Fades audio2 into new_audio at start_idx (equal-power sine and cosine curves over the overlap),
+    and copies the rest of audio2 after the overlap
+    :param new_audio: The audio array, which is long enough for audio2 and is updated in place
+    :param audio2: The audio to fade in, with the same number of dimensions as new_audio
+    :param start_idx: The start of audio2 in new_audio
+    :param overlap_len: The length of the overlap
+    """
+    out_view: cython.double[:, ::1]
+    in_view: cython.double[:, ::1]
+    sin_view: cython.double[::1]
+    cos_view: cython.double[::1]
+    x = np.linspace(0, np.pi / 2, overlap_len, False)
+    sin_arr = np.sin(x)
+    cos_arr = np.cos(x)
+    if cython.compiled and new_audio.dtype == np.float64 and new_audio.flags.c_contiguous:
+        out_view = new_audio.reshape((-1, new_audio.shape[-1]))
+        in_view = np.ascontiguousarray(audio2.reshape((-1, audio2.shape[-1])), dtype=np.float64)
+        sin_view = sin_arr
+        cos_view = cos_arr
+        with cython.nogil:
+            _fade_in_kernel(out_view, in_view, start_idx, overlap_len, sin_view, cos_view)
+        return
+    new_audio[..., start_idx:start_idx + overlap_len] = new_audio[..., start_idx:start_idx + overlap_len] * cos_arr + audio2[..., :overlap_len] * sin_arr
+    new_audio[..., start_idx + overlap_len:start_idx + audio2.shape[-1]] = audio2[..., overlap_len:]
+
+
+@cython.cfunc
+@cython.nogil
+@cython.exceptval(check=False)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _fade_in_kernel(new_audio: cython.double[:, ::1], audio2: cython.double[:, ::1], start_idx: cython.Py_ssize_t, overlap_len: cython.Py_ssize_t,
+                    sin_arr: cython.double[::1], cos_arr: cython.double[::1]) -> cython.void:
+    """
+    The compiled loop of `_fade_in`
+    """
+    i: cython.Py_ssize_t
+    j: cython.Py_ssize_t
+    for i in range(new_audio.shape[0]):
+        for j in range(overlap_len):
+            new_audio[i, j + start_idx] = new_audio[i, j + start_idx] * cos_arr[j] + audio2[i, j] * sin_arr[j]
+        for j in range(overlap_len, audio2.shape[1]):
+            new_audio[i, j + start_idx] = audio2[i, j]
+
+
+def merge_grain(audio: np.ndarray, grain: np.ndarray, start_idx: cython.Py_ssize_t, end_idx: cython.Py_ssize_t, channel: cython.Py_ssize_t):
     """
     Merges a grain array into an audio array
     :param audio: The audio array
@@ -51,15 +125,143 @@ def merge_grain(audio: np.ndarray, grain: np.ndarray, start_idx: cython.int, end
     :param end_idx: The end index for merging
     :param channel: The channel in which to merge
     """
-    i: cython.int
-    j: cython.int
-    i = 0
-    j = 0
-    if channel == 0 and audio.ndim == 1:
-        for i in range(start_idx, end_idx):
-            audio[i] += grain[j]
-            j += 1
-    else:
-        for i in range(start_idx, end_idx):
-            audio[channel, i] += grain[j]
-            j += 1
+    audio_view: cython.double[::1]
+    grain_view: cython.double[::1]
+    row = audio if channel == 0 and audio.ndim == 1 else audio[channel]
+    if cython.compiled and row.dtype == np.float64 and row.flags.c_contiguous:
+        audio_view = row
+        grain_view = np.ascontiguousarray(grain, dtype=np.float64)
+        with cython.nogil:
+            _merge_grain_kernel(audio_view, grain_view, start_idx, end_idx)
+        return
+    row[start_idx:end_idx] += grain[:end_idx - start_idx]
+
+
+@cython.cfunc
+@cython.nogil
+@cython.exceptval(check=False)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _merge_grain_kernel(audio: cython.double[::1], grain: cython.double[::1], start_idx: cython.Py_ssize_t, end_idx: cython.Py_ssize_t) -> cython.void:
+    """
+    The compiled loop of `merge_grain`
+    """
+    i: cython.Py_ssize_t
+    for i in range(start_idx, end_idx):
+        audio[i] += grain[i - start_idx]
+
+
+def merge_grains(audio: np.ndarray, grains: np.ndarray, start_indices: np.ndarray, num_threads: cython.int = 0):
+    """
+    Merges a block of equal-length grains into a 1D audio array (overlap-add).
+    The grains are summed first and then added to the audio, so this is much faster than
+    calling `merge_grain` once per grain. When the module is compiled, the output is split into
+    time tiles, and each tile is summed by one thread (so no two threads write the same samples).
+    :param audio: The audio array (1D, for example one channel of a multichannel array)
+    :param grains: A 2D array of grains, with shape (num_grains, grain_length)
+    :param start_indices: The start index of each grain. Every grain must fit in the audio: the start indices
+    are checked rather than clipped, because a grain that runs off either end of the audio is a bug in the caller
+    (negative indices would otherwise wrap around, and the compiled kernel does not check bounds).
+    :param num_threads: The number of threads. If 0, one thread per CPU is used.
+    """
+    if len(start_indices) == 0:
+        return
+    if start_indices.min() < 0 or start_indices.max() + grains.shape[-1] > audio.shape[-1]:
+        raise ValueError(f"The grains must be inside the audio (start indices from {start_indices.min()} to "
+                         f"{start_indices.max()}, grain length {grains.shape[-1]}, audio length {audio.shape[-1]})")
+    if not cython.compiled or audio.dtype != np.float64 or not audio.flags.c_contiguous:
+        _merge_grains_numpy(audio, grains, start_indices)
+        return
+    _merge_grains_tiled(audio, np.ascontiguousarray(grains, dtype=np.float64), np.asarray(start_indices, dtype=np.intp),
+                        num_threads if num_threads > 0 else os.cpu_count())
+
+
+def _merge_grains_numpy(audio: np.ndarray, grains: np.ndarray, start_indices: np.ndarray):
+    """
+    The NumPy version of `merge_grains`: all grains are added in a single scatter-add
+    """
+    grain_len = grains.shape[-1]
+    lower = start_indices.min()
+    upper = start_indices.max() + grain_len
+    idx = (start_indices[:, np.newaxis] - lower) + np.arange(grain_len)
+    audio[lower:upper] += np.bincount(idx.ravel(), grains.ravel(), upper - lower)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _merge_grains_tiled(audio: np.ndarray, grains: np.ndarray, start_indices: np.ndarray, num_threads: cython.int):
+    """
+    The compiled version of `merge_grains`. The grains are summed into a scratch array in order of their start indices,
+    so the result is the same as `_merge_grains_numpy` (which sums them in the order given) if the start indices are sorted.
+    """
+    audio_view: cython.double[::1]
+    scratch_view: cython.double[::1]
+    grains_view: cython.double[:, ::1]
+    offsets_view: cython.Py_ssize_t[::1]
+    order_view: cython.Py_ssize_t[::1]
+    first_view: cython.Py_ssize_t[::1]
+    last_view: cython.Py_ssize_t[::1]
+    tile: cython.Py_ssize_t
+    tile_size: cython.Py_ssize_t
+    num_tiles: cython.Py_ssize_t
+    lower: cython.Py_ssize_t
+    grain_len: cython.Py_ssize_t = grains.shape[1]
+
+    lower = start_indices.min()
+    scratch = np.zeros((start_indices.max() + grain_len - lower))
+    # The grains that overlap each tile, found by binary search on the sorted start indices
+    order = np.argsort(start_indices, kind="stable").astype(np.intp)
+    offsets = (start_indices - lower).astype(np.intp)
+    sorted_offsets = offsets[order]
+    tile_size = max(grain_len, -(-scratch.shape[0] // (4 * num_threads)))
+    num_tiles = -(-scratch.shape[0] // tile_size)
+    tile_starts = np.arange(num_tiles, dtype=np.intp) * tile_size
+    first = np.searchsorted(sorted_offsets, tile_starts - grain_len, side="right").astype(np.intp)
+    last = np.searchsorted(sorted_offsets, tile_starts + tile_size, side="left").astype(np.intp)
+
+    audio_view = audio[lower:lower + scratch.shape[0]]
+    scratch_view = scratch
+    grains_view = grains
+    offsets_view = offsets
+    order_view = order
+    first_view = first
+    last_view = last
+    for tile in prange(num_tiles, nogil=True, num_threads=num_threads, schedule="dynamic"):
+        _merge_tile(audio_view, scratch_view, grains_view, offsets_view, order_view, first_view[tile], last_view[tile],
+                    tile * tile_size, min((tile + 1) * tile_size, scratch_view.shape[0]))
+
+
+@cython.cfunc
+@cython.nogil
+@cython.exceptval(check=False)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _merge_tile(audio: cython.double[::1], scratch: cython.double[::1], grains: cython.double[:, ::1], offsets: cython.Py_ssize_t[::1],
+                order: cython.Py_ssize_t[::1], first: cython.Py_ssize_t, last: cython.Py_ssize_t, tile_start: cython.Py_ssize_t,
+                tile_end: cython.Py_ssize_t) -> cython.void:
+    """
+    Sums the grains that overlap one tile of the output, then adds the sum to the audio
+    :param audio: The audio, from the start of the first grain
+    :param scratch: The scratch array for the sums (the same length as the audio)
+    :param grains: The grains
+    :param offsets: The start of each grain in the audio
+    :param order: The grain indices, sorted by start
+    :param first: The first sorted grain that might overlap the tile
+    :param last: The sorted grain after the last one that might overlap the tile
+    :param tile_start: The start of the tile
+    :param tile_end: The end of the tile
+    """
+    g: cython.Py_ssize_t
+    k: cython.Py_ssize_t
+    i: cython.Py_ssize_t
+    lo: cython.Py_ssize_t
+    hi: cython.Py_ssize_t
+    # The grains are summed in order of their start indices
+    for g in range(first, last):
+        k = order[g]
+        lo = max(offsets[k], tile_start)
+        hi = min(offsets[k] + grains.shape[1], tile_end)
+        for i in range(lo, hi):
+            scratch[i] += grains[k, i - offsets[k]]
+    for i in range(tile_start, tile_end):
+        audio[i] += scratch[i]
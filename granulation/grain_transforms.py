@@ -0,0 +1,125 @@
+"""
+File: grain_transforms.py
+
+Description: Transforms for grain sequences (lists of grain dictionaries, or GrainTables).
+Each transform calculates an index array (or an array of parameter changes) with NumPy and
+applies it once, so they run in milliseconds on sequences of millions of grains. Random transforms
+use a `numpy.random.Generator` (or a seed for one), so the results are reproducible from the same seed.
+"""
+
+import numpy as np
+from grain_table import GrainTable
+
+
+def delete_nth_grains(grains, n: int):
+    """
+    Deletes every nth grain (the grains at indices n, 2n, 3n, ...)
+    :param grains: A list of grains, or a GrainTable
+    :param n: Every nth grain will be deleted
+    """
+    idx = np.arange(len(grains))
+    reorder(grains, np.flatnonzero((idx % n != 0) | (idx == 0)))
+
+
+def swap_nth_adjacent_pair(grains, n: int):
+    """
+    Swaps every n adjacent grain pairs
+    :param grains: A list of grains, or a GrainTable
+    :param n: Every nth pair will be swapped
+    """
+    swap_nth_m_pair(grains, n, 1)
+
+
+def swap_nth_m_pair(grains, n: int, m: int):
+    """
+    Swaps grains i and i+m, in order, for i in range(0, len(grains)-m, n)
+    :param grains: A list of grains, or a GrainTable
+    :param n: Every nth pair will be swapped
+    :param m: The distance between the grains in each pair
+    """
+    reorder(grains, swap_order(len(grains), n, m))
+
+
+def swap_random_pair(grains, prob: float, rng=None):
+    """
+    Goes through the adjacent grain pairs in order and swaps each pair with a probability. A grain
+    that has just been swapped forward can be swapped again with the next grain.
+    :param grains: A list of grains, or a GrainTable
+    :param prob: The probability that any given pair of adjacent grains will be swapped
+    :param rng: A numpy.random.Generator, or a seed for one
+    """
+    if len(grains) > 1:
+        reorder(grains, random_swap_order(np.random.default_rng(rng).random(len(grains) - 1) < prob))
+
+
+def randomize_param(grains, param: str, max_deviation: int, only_positive: bool = False, rng=None):
+    """
+    Adds a random integer deviation to a grain parameter
+    :param grains: A list of grain dictionaries, or a GrainTable
+    :param param: The key (or GrainTable column) to randomize
+    :param max_deviation: The maximum deviation allowed
+    :param only_positive: Whether or not only positive deviation is allowed
+    :param rng: A numpy.random.Generator, or a seed for one
+    """
+    min_deviation = 0 if only_positive else -max_deviation
+    rng = np.random.default_rng(rng)
+    if isinstance(grains, GrainTable):
+        column = getattr(grains, param)
+        column += rng.integers(min_deviation, max_deviation + 1, len(grains), dtype=column.dtype)
+        return
+    for grain, deviation in zip(grains, rng.integers(min_deviation, max_deviation + 1, len(grains)).tolist()):
+        grain[param] += deviation
+
+
+def reorder(grains, order: np.ndarray):
+    """
+    Reorders (or selects) grains in place
+    :param grains: A list of grains, or a GrainTable
+    :param order: An index array with the new grain order
+    """
+    if isinstance(grains, GrainTable):
+        grains.reorder(order)
+    else:
+        grains[:] = [grains[i] for i in order.tolist()]
+
+
+def swap_order(num_grains: int, n: int, m: int) -> np.ndarray:
+    """
+    Calculates the grain order produced by swapping grains i and i+m, for i in range(0, num_grains-m, n)
+    :param num_grains: The number of grains
+    :param n: Every nth pair will be swapped
+    :param m: The distance between the grains in each pair
+    :return: An index array with the new grain order
+    """
+    order = np.arange(num_grains)
+    first = np.arange(0, max(num_grains - m, 0), n)
+    if len(first) == 0:
+        return order
+    if m % n != 0:
+        # The pairs don't overlap, so they can all be swapped at once
+        order[first] = first + m
+        order[first + m] = first
+    else:
+        # The pairs form chains i, i+m, i+2m, ... and swapping them in order moves
+        # the first grain in each chain to the end of the chain
+        order[first] = first + m
+        last = np.setdiff1d(first + m, first)
+        order[last] = last % m
+    return order
+
+
+def random_swap_order(swaps: np.ndarray) -> np.ndarray:
+    """
+    Calculates the grain order produced by swapping grains i and i+1 (in order) wherever swaps[i] is True
+    :param swaps: A boolean array with one entry per adjacent pair
+    :return: An index array with the new grain order
+    """
+    num_grains = swaps.shape[-1] + 1
+    idx = np.arange(num_grains)
+    # A run of swaps from i to j moves grain i to position j+1 and shifts the rest back by one
+    run_start = np.maximum.accumulate(np.where(swaps, -1, idx[:-1])) + 1
+    order = idx.copy()
+    order[:-1][swaps] = idx[1:][swaps]
+    run_end = np.flatnonzero(swaps & ~np.append(swaps[1:], False)) + 1
+    order[run_end] = run_start[run_end - 1]
+    return order
@@ -0,0 +1,176 @@
+"""
+File: ingest.py
+
+Description: Fills the grain database from a tree of audio files. Each file is sliced into
+grains of the configured lengths and analyzed in a worker process with the batched feature
+kernel (see `grain_features.analyze_file_grains`).
+The results are written by a single writer with large `executemany` batches, one transaction
+per batch, in WAL mode. A file's grains are committed in the same transaction as its row in
+the `files` table, so an interrupted ingestion can be run again and will continue
+with the files that were not finished.
+
+Run `python ingest.py <database> <source directory> [<source directory> ...]`.
+"""
+
+import aus.audiofile as audiofile
+import concurrent.futures
+import grain_features
+import grain_sql
+import migrate
+import numpy as np
+import os
+import sqlite3
+import sys
+import time
+
+
+GRAIN_LENGTHS = [2048, 4096, 8192, 16384]
+
+
+def prepare_db(db: sqlite3.Connection, cursor: sqlite3.Cursor):
+    """
+    Prepares a grain database for ingestion. A new database gets the grain schema, and an existing
+    database is migrated to the latest schema version.
+    :param db: A connection to a SQLite database
+    :param cursor: The cursor for executing SQL
+    """
+    cursor.execute("PRAGMA journal_mode = WAL;")
+    cursor.execute("PRAGMA synchronous = NORMAL;")
+    cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'grains';")
+    if cursor.fetchone()[0] == 0:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema.sql"), "r") as schema_file:
+            cursor.executescript(schema_file.read())
+    migrate.migrate(db, cursor)
+    db.commit()
+
+
+def split_path(path: str, source_dir: str) -> tuple:
+    """
+    Splits a file path into the root and the path relative to it, for the files table
+    :param path: The file path
+    :param source_dir: The source directory that contains the file
+    :return: A (root, relative path) tuple. root + relative path is the file path.
+    """
+    root = os.path.join(source_dir, "")
+    if not path.startswith(root):
+        root = path[:len(path) - len(os.path.basename(path))]
+    return root, path[len(root):]
+
+
+def analyze_file(path: str, grain_lengths: list, hop_fraction: float) -> tuple:
+    """
+    Slices an audio file into grains and analyzes them. This runs in a worker process.
+    :param path: The audio file path
+    :param grain_lengths: The grain lengths
+    :param hop_fraction: The distance between grain starts, as a fraction of the grain length
+    :return: The sample rate, the number of frames, and a list of grain records, with the fields
+    in grain_sql.FIELDS order (without the id, file and file_id)
+    """
+    audio = audiofile.read(path)
+    samples = audio.samples.reshape((-1, audio.samples.shape[-1]))[0]
+    records = []
+    for grain_length in grain_lengths:
+        starts, features = grain_features.analyze_file_grains(samples, audio.sample_rate, grain_length, max(int(grain_length * hop_fraction), 1))
+        for start, row in zip(starts.tolist(), features.tolist()):
+            records.append((start, start + grain_length, grain_length, audio.sample_rate, grain_length / audio.sample_rate,
+                            *[None if np.isnan(value) else value for value in row]))
+    return audio.sample_rate, samples.shape[-1], records
+
+
+def _analyze_file(path: str, grain_lengths: list, hop_fraction: float) -> tuple:
+    """
+    Analyzes a file in a worker process, catching errors so that one bad file doesn't stop the ingestion
+    :return: A tuple of the path, the result of `analyze_file` (or None), and the error message (or None)
+    """
+    try:
+        return path, analyze_file(path, grain_lengths, hop_fraction), None
+    except Exception as e:
+        return path, None, str(e)
+
+
+def ingest(db_path: str, source_dirs, grain_lengths: list = GRAIN_LENGTHS, hop_fraction: float = 0.5,
+           num_workers: int = None, batch_size: int = 50000) -> dict:
+    """
+    Adds the grains of all audio files under the source directories to the grain database.
+    Files that have already been ingested are skipped.
+    :param db_path: The path of the grain database (it will be made if it doesn't exist)
+    :param source_dirs: The directory (or list of directories) that contains the audio files
+    :param grain_lengths: The grain lengths
+    :param hop_fraction: The distance between grain starts, as a fraction of the grain length
+    :param num_workers: The number of analysis processes. If None, one process per CPU is used.
+    :param batch_size: The minimum number of grains to write in each transaction
+    :return: A dictionary with the numbers of files and grains ingested, and the elapsed time
+    """
+    if type(source_dirs) == str:
+        source_dirs = [source_dirs]
+    db, cursor = grain_sql.connect_to_db(db_path)
+    prepare_db(db, cursor)
+    cursor.execute("SELECT root || path FROM files;")
+    ingested = set(record[0] for record in cursor.fetchall())
+    roots = {}
+    for source_dir in source_dirs:
+        for file in audiofile.find_files(source_dir):
+            if file not in ingested:
+                roots[file] = source_dir
+    files = list(roots)
+    print(f"Ingesting {len(files)} files ({len(ingested)} already ingested)")
+
+    # The grains are written to the grain_data table directly, with the file_id of their row in the files table
+    insert_sql = f"INSERT INTO grain_data ({', '.join(grain_sql.FIELDS[2:])}) VALUES({', '.join('?' for _ in grain_sql.FIELDS[2:])});"
+    stats = {"files": 0, "grains": 0, "failed": 0, "seconds": 0.0}
+    pending_files = []
+    num_pending_grains = 0
+    start_time = time.perf_counter()
+
+    def write_batch():
+        for file, sample_rate, num_frames, records in pending_files:
+            cursor.execute("INSERT INTO files (root, path, sample_rate, num_frames) VALUES(?, ?, ?, ?);",
+                           (*split_path(file, roots[file]), sample_rate, num_frames))
+            file_id = cursor.lastrowid
+            cursor.executemany(insert_sql, ((file_id, *record) for record in records))
+            stats["grains"] += len(records)
+        db.commit()
+        stats["files"] += len(pending_files)
+        stats["seconds"] = time.perf_counter() - start_time
+        print(f"Ingested {stats['files']} of {len(files)} files, {stats['grains']} grains ({stats['grains'] / stats['seconds']:.0f} grains/s)")
+        pending_files.clear()
+
+    num_workers = num_workers if num_workers is not None else os.cpu_count()
+    with concurrent.futures.ProcessPoolExecutor(num_workers) as executor:
+        # Keep a bounded number of files in flight, so that finished results don't pile up in memory
+        remaining = iter(files)
+        futures = set()
+        while True:
+            while len(futures) < 2 * num_workers:
+                file = next(remaining, None)
+                if file is None:
+                    break
+                futures.add(executor.submit(_analyze_file, file, grain_lengths, hop_fraction))
+            if len(futures) == 0:
+                break
+            done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                file, result, error = future.result()
+                if result is None:
+                    print(f"Could not analyze file {file}: {error}")
+                    stats["failed"] += 1
+                    continue
+                pending_files.append((file, *result))
+                num_pending_grains += len(result[2])
+            if num_pending_grains >= batch_size:
+                write_batch()
+                num_pending_grains = 0
+    if len(pending_files) > 0:
+        write_batch()
+    db.close()
+    stats["seconds"] = time.perf_counter() - start_time
+    return stats
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python ingest.py <database> <source directory> [<source directory> ...]")
+        sys.exit(1)
+    stats = ingest(sys.argv[1], sys.argv[2:])
+    print(f"Ingested {stats['grains']} grains from {stats['files']} files in {stats['seconds']:.1f} s "
+          f"({stats['grains'] / max(stats['seconds'], 1e-9):.0f} grains/s, {stats['failed']} files failed)")
@@ -0,0 +1,248 @@
+"""
+File: migrate.py
+
+Description: Versioned schema migrations for the grain database. The schema version is
+stored in `PRAGMA user_version`, and each migration brings the database up one version.
+Since version 3, grain rows are stored in the `grain_data` table with a `file_id` that refers
+to the `files` table, and `grains` is a view that joins them (with the columns in grain_sql.FIELDS order).
+Run `python migrate.py <database>` to migrate a database and show the query plans of
+the common grain queries.
+"""
+
+import grain_sql
+import sqlite3
+import sys
+
+
+# The columns of the version 1 and 2 grains table
+GRAINS_COLUMNS = [field for field in grain_sql.FIELDS if field != "file_id"]
+
+# The version 1 and 2 grains table, with the columns in the same order as GRAINS_COLUMNS
+GRAINS_TABLE = """CREATE TABLE {name} (
+    id INTEGER PRIMARY KEY,
+    file TEXT NOT NULL,
+    start_frame INTEGER NOT NULL,
+    end_frame INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    sample_rate INTEGER NOT NULL,
+    grain_duration REAL NOT NULL,
+    frequency REAL,
+    midi REAL,
+    energy REAL,
+    spectral_centroid REAL NULL,
+    spectral_entropy REAL NOT NULL,
+    spectral_flatness REAL NOT NULL,
+    spectral_kurtosis REAL NOT NULL,
+    spectral_roll_off_50 REAL NOT NULL,
+    spectral_roll_off_75 REAL NOT NULL,
+    spectral_roll_off_90 REAL NOT NULL,
+    spectral_roll_off_95 REAL NOT NULL,
+    spectral_skewness REAL NOT NULL,
+    spectral_slope REAL NOT NULL,
+    spectral_slope_0_1_khz REAL NOT NULL,
+    spectral_slope_1_5_khz REAL NOT NULL,
+    spectral_slope_0_5_khz REAL NOT NULL,
+    spectral_variance REAL NOT NULL
+);"""
+
+# The source files. A file's path is root || path, so a library is moved by changing the roots.
+FILES_TABLE = """CREATE TABLE files (
+    id INTEGER PRIMARY KEY,
+    root TEXT NOT NULL,
+    path TEXT NOT NULL,
+    sample_rate INTEGER,
+    num_frames INTEGER,
+    UNIQUE (root, path)
+);"""
+
+# The grain rows (version 3), with the columns in grain_sql.FIELDS order without the file path
+GRAIN_DATA_TABLE = GRAINS_TABLE.format(name="grain_data").replace("file TEXT NOT NULL", "file_id INTEGER NOT NULL REFERENCES files (id)")
+
+# The grains view. The LEFT JOIN lets SQLite leave out the files table when no file column is used.
+GRAINS_VIEW = f"""CREATE VIEW grains AS SELECT grain_data.id AS id, files.root || files.path AS file, {", ".join(
+    "grain_data." + field for field in grain_sql.FIELDS[2:])}
+    FROM grain_data LEFT JOIN files ON files.id = grain_data.file_id;"""
+
+# The directory (with the trailing separator) and the file name of a full path in SQL
+ROOT_SQL = "rtrim({path}, replace(replace({path}, '/', ''), '\\', ''))"
+NAME_SQL = f"substr({{path}}, length({ROOT_SQL}) + 1)"
+
+# Inserting into and deleting from the grains view. An inserted grain gets the file_id of its file
+# (the file is added to the files table if needed), or the file_id that was inserted if the file is NULL.
+GRAINS_TRIGGERS = [
+    f"""CREATE TRIGGER grains_insert INSTEAD OF INSERT ON grains BEGIN
+    INSERT OR IGNORE INTO files (root, path, sample_rate) VALUES ({ROOT_SQL.format(path="NEW.file")}, {NAME_SQL.format(path="NEW.file")}, NEW.sample_rate);
+    INSERT INTO grain_data ({", ".join(grain_sql.FIELDS[:1] + grain_sql.FIELDS[2:])}) VALUES (NEW.id, COALESCE((SELECT id FROM files
+        WHERE root = {ROOT_SQL.format(path="NEW.file")} AND path = {NAME_SQL.format(path="NEW.file")}), NEW.file_id), {", ".join(
+        "NEW." + field for field in grain_sql.FIELDS[3:])});
+END;""",
+    """CREATE TRIGGER grains_delete INSTEAD OF DELETE ON grains BEGIN
+    DELETE FROM grain_data WHERE id = OLD.id;
+END;""",
+]
+
+# Representative queries, for checking the query plans
+QUERIES = [
+    """SELECT * FROM grains
+    WHERE (length = 8192)
+        AND (spectral_flatness BETWEEN 0.00 AND 0.05)
+        AND (spectral_roll_off_75 BETWEEN 100 AND 200)
+        AND (frequency IS NULL);""",
+    """SELECT * FROM grains
+    WHERE (length = 8192)
+        AND (spectral_flatness BETWEEN 0.1 AND 0.3)
+        AND (spectral_roll_off_75 BETWEEN 100 AND 300);""",
+    """SELECT * FROM grains
+    WHERE (length = 8192)
+        AND (spectral_flatness BETWEEN 0.00 AND 0.05)
+        AND (midi BETWEEN 68.8 AND 69.2);""",
+]
+
+
+def columns(cursor: sqlite3.Cursor, table: str) -> list:
+    """
+    Gets the column names of a table
+    :param cursor: The cursor for executing SQL
+    :param table: The table name
+    :return: A list of column names
+    """
+    cursor.execute(f"PRAGMA table_info({table});")
+    return [record[1] for record in cursor.fetchall()]
+
+
+def _add_length_and_energy(cursor: sqlite3.Cursor):
+    """
+    Migration 1: Adds the length and energy columns. The table is rebuilt so that the columns
+    are in the same order as GRAINS_COLUMNS (ALTER TABLE would add them at the end).
+    """
+    existing = columns(cursor, "grains")
+    if "length" in existing and "energy" in existing:
+        return
+    cursor.execute(GRAINS_TABLE.format(name="grains_new"))
+    select = []
+    for field in GRAINS_COLUMNS:
+        if field in existing:
+            select.append(field)
+        elif field == "length":
+            select.append("end_frame - start_frame")
+        else:
+            select.append("NULL")
+    cursor.execute(f"INSERT INTO grains_new ({', '.join(GRAINS_COLUMNS)}) SELECT {', '.join(select)} FROM grains;")
+    cursor.execute("DROP TABLE grains;")
+    cursor.execute("ALTER TABLE grains_new RENAME TO grains;")
+
+
+def _add_feature_indexes(cursor: sqlite3.Cursor):
+    """
+    Migration 2: Adds indexes for the common range predicates. Queries filter on an exact length,
+    then on spectral flatness and roll-off (or MIDI) ranges. The partial index covers the
+    unpitched (frequency IS NULL) queries.
+    """
+    cursor.execute("CREATE INDEX IF NOT EXISTS grains_length_flatness_roll_off_75 ON grains (length, spectral_flatness, spectral_roll_off_75);")
+    cursor.execute("""CREATE INDEX IF NOT EXISTS grains_unpitched_length_flatness_roll_off_75 ON grains (length, spectral_flatness, spectral_roll_off_75)
+                   WHERE frequency IS NULL;""")
+    cursor.execute("CREATE INDEX IF NOT EXISTS grains_length_midi ON grains (length, midi);")
+    cursor.execute("ANALYZE;")
+
+
+def _normalize_files(cursor: sqlite3.Cursor):
+    """
+    Migration 3: Moves the file paths to a files table. Each grain row stores a file_id instead of the
+    full path, and the grains view joins the tables so that queries on grains keep working.
+    Existing paths are split into the directory (the root) and the file name.
+    """
+    cursor.execute(FILES_TABLE)
+    cursor.execute(f"""INSERT INTO files (root, path, sample_rate)
+                   SELECT root, substr(file, length(root) + 1), sample_rate
+                   FROM (SELECT file, {ROOT_SQL.format(path="file")} AS root, MAX(sample_rate) AS sample_rate FROM grains GROUP BY file)
+                   ORDER BY root, file;""")
+    cursor.execute(GRAIN_DATA_TABLE)
+    cursor.execute(f"""INSERT INTO grain_data ({", ".join(grain_sql.FIELDS[:1] + grain_sql.FIELDS[2:])})
+                   SELECT grains.id, files.id, {", ".join("grains." + field for field in grain_sql.FIELDS[3:])}
+                   FROM grains JOIN files ON files.root = {ROOT_SQL.format(path="grains.file")} AND files.path = {NAME_SQL.format(path="grains.file")};""")
+    cursor.execute("DROP TABLE grains;")
+    cursor.execute(GRAINS_VIEW)
+    for trigger in GRAINS_TRIGGERS:
+        cursor.execute(trigger)
+    cursor.execute("CREATE INDEX grain_data_length_flatness_roll_off_75 ON grain_data (length, spectral_flatness, spectral_roll_off_75);")
+    cursor.execute("""CREATE INDEX grain_data_unpitched_length_flatness_roll_off_75 ON grain_data (length, spectral_flatness, spectral_roll_off_75)
+                   WHERE frequency IS NULL;""")
+    cursor.execute("CREATE INDEX grain_data_length_midi ON grain_data (length, midi);")
+    cursor.execute("ANALYZE;")
+
+
+# The migrations, in order. Migration i brings the database to version i+1.
+MIGRATIONS = [
+    _add_length_and_energy,
+    _add_feature_indexes,
+    _normalize_files,
+]
+
+
+def get_version(cursor: sqlite3.Cursor) -> int:
+    """
+    Gets the schema version of a database
+    :param cursor: The cursor for executing SQL
+    :return: The schema version
+    """
+    cursor.execute("PRAGMA user_version;")
+    return cursor.fetchone()[0]
+
+
+def migrate(db: sqlite3.Connection, cursor: sqlite3.Cursor, target_version: int = None):
+    """
+    Migrates a grain database to a schema version. Each migration runs in its own transaction.
+    :param db: A connection to a SQLite database
+    :param cursor: The cursor for executing SQL
+    :param target_version: The version to migrate to. If None, the database is migrated to the latest version.
+    """
+    if target_version is None:
+        target_version = len(MIGRATIONS)
+    db.commit()
+    version = get_version(cursor)
+    while version < target_version:
+        print(MIGRATIONS[version].__doc__.strip().splitlines()[0])
+        cursor.execute("BEGIN;")
+        try:
+            MIGRATIONS[version](cursor)
+            cursor.execute(f"PRAGMA user_version = {version + 1};")
+            cursor.execute("COMMIT;")
+        except Exception:
+            cursor.execute("ROLLBACK;")
+            raise
+        version += 1
+
+
+def explain(cursor: sqlite3.Cursor, sql: str, params: tuple = ()) -> list:
+    """
+    Gets the query plan of a SQL query
+    :param cursor: The cursor for executing SQL
+    :param sql: The query
+    :param params: The query parameters
+    :return: A list of query plan steps
+    """
+    cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+    return [record[-1] for record in cursor.fetchall()]
+
+
+def uses_index(plan: list) -> bool:
+    """
+    Checks if a query plan searches the grains table (or the grain_data table) with an index rather than scanning it
+    :param plan: The query plan (from `explain`)
+    :return: True if no step of the plan is a full scan of the grains table
+    """
+    return not any(step.startswith("SCAN") and ("grains" in step or "grain_data" in step) and "INDEX" not in step for step in plan)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python migrate.py <database>")
+        sys.exit(1)
+    db = sqlite3.connect(sys.argv[1], isolation_level=None)
+    cursor = db.cursor()
+    migrate(db, cursor)
+    print(f"Schema version {get_version(cursor)}")
+    for query in QUERIES:
+        plan = explain(cursor, query)
+        print(f"{'OK  ' if uses_index(plan) else 'SCAN'} {' / '.join(plan)}")
+    db.close()
@@ -0,0 +1,226 @@
+"""
+File: path_index.py
+
+Description: A persistent index of the audio files under the source directories, stored in
+a SQLite database next to the grain database. File names stored in the grain database are
+resolved with a dictionary lookup rather than a walk of the source directories.
+
+The index is refreshed incrementally: a directory is only listed again if its modification
+time has changed (which happens when files are added, removed or renamed in it). Unchanged
+directories are not listed, and their subdirectories are found from the index.
+"""
+
+import os
+import sqlite3
+import sys
+
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS directories (
+        path TEXT PRIMARY KEY,
+        parent TEXT,
+        root TEXT NOT NULL,
+        mtime_ns INTEGER NOT NULL
+    );""",
+    """CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY,
+        directory TEXT NOT NULL,
+        name TEXT NOT NULL
+    );""",
+    "CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent);",
+    "CREATE INDEX IF NOT EXISTS directories_root ON directories (root);",
+    "CREATE INDEX IF NOT EXISTS files_directory ON files (directory);",
+    "CREATE INDEX IF NOT EXISTS files_name ON files (name);",
+]
+
+
+def basename(path: str) -> str:
+    """
+    Gets the file name of a path. This works for Windows and POSIX paths on any platform
+    (os.path.split() doesn't work properly on paths for other platforms).
+    :param path: The path
+    :return: The file name
+    """
+    idx = len(path) - 1
+    while idx >= 0:
+        if path[idx] == "\\" or path[idx] == "/":
+            break
+        idx -= 1
+    return path[idx+1:]
+
+
+def index_path_for(db_path: str) -> str:
+    """
+    Gets the path of the file index that belongs to a grain database
+    :param db_path: The path of the grain database
+    :return: The path of the index database (next to the grain database)
+    """
+    return os.path.splitext(db_path)[0] + ".paths.sqlite3"
+
+
+class PathIndex:
+    """
+    Represents a persistent index from file name to file path
+    """
+    def __init__(self, index_path: str):
+        """
+        Initializes the PathIndex. Call `refresh` to bring the index up to date with the source directories.
+        :param index_path: The path of the index database (see `index_path_for`)
+        """
+        self.index_path = index_path
+        self.db = sqlite3.connect(index_path)
+        self.cursor = self.db.cursor()
+        for sql in SCHEMA:
+            self.cursor.execute(sql)
+        self.db.commit()
+        self.names = None
+        self.paths = None
+
+    def close(self):
+        """
+        Closes the index database
+        """
+        self.db.close()
+
+    def refresh(self, source_dirs) -> dict:
+        """
+        Brings the index up to date with the source directories. Only directories whose modification time
+        has changed since the last refresh are listed.
+        :param source_dirs: The directory (or list of directories) that contains the audio files
+        :return: A dictionary with the numbers of directories checked and listed, and the number of files indexed
+        """
+        if type(source_dirs) == str:
+            source_dirs = [source_dirs]
+        stats = {"directories": 0, "listed": 0, "files": 0}
+        for root in source_dirs:
+            root = os.path.abspath(root)
+            visited = set()
+            stack = [(root, None)]
+            while len(stack) > 0:
+                directory, parent = stack.pop()
+                try:
+                    mtime_ns = os.stat(directory).st_mtime_ns
+                except OSError:
+                    continue
+                visited.add(directory)
+                stats["directories"] += 1
+                self.cursor.execute("SELECT mtime_ns FROM directories WHERE path = ?;", (directory,))
+                record = self.cursor.fetchone()
+                if record is not None and record[0] == mtime_ns:
+                    self.cursor.execute("SELECT path FROM directories WHERE parent = ?;", (directory,))
+                    stack.extend((record[0], directory) for record in self.cursor.fetchall())
+                    continue
+                stack.extend((subdirectory, directory) for subdirectory in self._list(directory, parent, root, mtime_ns))
+                stats["listed"] += 1
+
+            # Remove directories that no longer exist
+            self.cursor.execute("SELECT path FROM directories WHERE root = ?;", (root,))
+            removed = [(record[0],) for record in self.cursor.fetchall() if record[0] not in visited]
+            self.cursor.executemany("DELETE FROM files WHERE directory = ?;", removed)
+            self.cursor.executemany("DELETE FROM directories WHERE path = ?;", removed)
+            self.db.commit()
+
+        self.names = None
+        self.cursor.execute("SELECT COUNT(*) FROM files;")
+        stats["files"] = self.cursor.fetchone()[0]
+        return stats
+
+    def _list(self, directory: str, parent: str, root: str, mtime_ns: int) -> list:
+        """
+        Lists a directory and replaces its entries in the index
+        :param directory: The directory
+        :param parent: The parent directory (None for a root directory)
+        :param root: The root directory
+        :param mtime_ns: The modification time of the directory, from before it was listed
+        :return: A list of the subdirectories
+        """
+        files = []
+        subdirectories = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        subdirectories.append(entry.path)
+                    elif entry.is_file():
+                        files.append((entry.path, directory, entry.name))
+        except OSError:
+            return []
+        self.cursor.execute("DELETE FROM files WHERE directory = ?;", (directory,))
+        self.cursor.executemany("INSERT OR REPLACE INTO files VALUES(?, ?, ?);", files)
+        self.cursor.execute("INSERT OR REPLACE INTO directories VALUES(?, ?, ?, ?);", (directory, parent, root, mtime_ns))
+        return subdirectories
+
+    def find(self, database_path: str) -> str:
+        """
+        Resolves a database path to a path on the local machine. The file name must match exactly.
+        If there are several files with the same name, the first path (in sorted order) is used; see `duplicates`.
+        :param database_path: The path of the file in the database
+        :return: The actual file path on this machine, or "" if the file is not in the index
+        """
+        if self.names is None:
+            self.load()
+        return self.names.get(basename(database_path), "")
+
+    def contains(self, path: str) -> bool:
+        """
+        Checks whether a path is in the index. Forward and back slashes are treated the same.
+        :param path: The file path
+        :return: True if the file is in the index
+        """
+        if self.names is None:
+            self.load()
+        return path.replace("\\", "/") in self.paths
+
+    def load(self):
+        """
+        Loads the file names into memory. `find` does this the first time it is called; call it
+        before the index is used by other threads, because the index database can only be used
+        by the thread that opened it.
+        """
+        names = {}
+        paths = set()
+        self.cursor.execute("SELECT name, path FROM files ORDER BY path;")
+        for name, path in self.cursor.fetchall():
+            names.setdefault(name, path)
+            paths.add(path.replace("\\", "/"))
+        self.paths = paths
+        self.names = names
+
+    def duplicates(self) -> dict:
+        """
+        Finds file names that occur more than once under the source directories.
+        Grains from these files might be resolved to the wrong file.
+        :return: A dictionary mapping each duplicated file name to a list of its paths
+        """
+        self.cursor.execute("""SELECT name, path FROM files
+                            WHERE name IN (SELECT name FROM files GROUP BY name HAVING COUNT(*) > 1)
+                            ORDER BY name, path;""")
+        duplicates = {}
+        for name, path in self.cursor.fetchall():
+            if name not in duplicates:
+                duplicates[name] = []
+            duplicates[name].append(path)
+        return duplicates
+
+
+def open_path_index(db_path: str, source_dirs) -> PathIndex:
+    """
+    Opens the file index for a grain database, refreshes it, and reports duplicate file names
+    :param db_path: The path of the grain database
+    :param source_dirs: The directory (or list of directories) that contains the audio files
+    :return: The PathIndex
+    """
+    index = PathIndex(index_path_for(db_path))
+    stats = index.refresh(source_dirs)
+    print(f"Indexed {stats['files']} files ({stats['listed']} of {stats['directories']} directories listed)")
+    for name, paths in index.duplicates().items():
+        print(f"Duplicate file name {name}: {', '.join(paths)}")
+    return index
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python path_index.py <grain database> <source directory> [<source directory> ...]")
+        sys.exit(1)
+    index = open_path_index(sys.argv[1], sys.argv[2:])
+    index.close()
@@ -0,0 +1,151 @@
+"""
+File: query_cache.py
+
+Description: An on-disk cache of grain query results. Each result is a structured array
+(see `grain_sql.record_dtype`) stored as an uncompressed .npz file of columns, so a warm
+start loads the grain metadata without running any SQL. Entries are keyed by the normalized
+SQL, its parameters, the fields and the signature of the database file, so they go stale as
+soon as the database is written to. The least recently used entries are removed when the
+cache is larger than its size limit.
+"""
+
+from feature_index import database_signature
+import hashlib
+import numpy as np
+import os
+import sqlite3
+import sys
+import zipfile
+
+
+# Increment this when the stored format changes, so that old entries are not used
+CACHE_VERSION = 1
+
+
+class QueryCache:
+    """
+    Represents a directory of cached query results
+    """
+    def __init__(self, cache_dir: str, max_bytes: int = 2 ** 30):
+        """
+        Initializes the QueryCache.
+        :param cache_dir: The cache directory (it will be made if it doesn't exist)
+        :param max_bytes: The maximum total size of the cached results
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __repr__(self) -> str:
+        return f"QueryCache({self.cache_dir}, {self.hits} hits, {self.misses} misses)"
+
+    def key(self, cursor: sqlite3.Cursor, sql: str, params: tuple = (), fields: list = None) -> str:
+        """
+        Makes the cache key of a query
+        :param cursor: The cursor of the database that the query runs on
+        :param sql: The query. Differences in whitespace don't change the key.
+        :param params: The query parameters
+        :param fields: The fields of the result
+        :return: The key
+        """
+        cursor.execute("PRAGMA database_list;")
+        db_path = next(record[2] for record in cursor.fetchall() if record[1] == "main")
+        description = repr((CACHE_VERSION, " ".join(sql.split()), tuple(params), tuple(fields) if fields is not None else None,
+                            os.path.abspath(db_path), database_signature(db_path)))
+        return hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> np.ndarray:
+        """
+        Loads a cached result
+        :param key: The cache key (from `key`)
+        :return: The structured array, or None if the result is not in the cache
+        """
+        path = os.path.join(self.cache_dir, key + ".npz")
+        try:
+            with np.load(path) as columns:
+                names = [str(name) for name in columns["names"]]
+                records = np.zeros((columns["length"][0]), dtype=[(name, columns["dtypes"][i]) for i, name in enumerate(names)])
+                for name in names:
+                    if records.dtype[name] == object:
+                        # Text columns are stored as their distinct values and an index into them
+                        records[name] = columns[name + ".values"].astype(object)[columns[name + ".codes"]]
+                    else:
+                        records[name] = columns[name]
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            self.misses += 1
+            return None
+        os.utime(path)
+        self.hits += 1
+        return records
+
+    def put(self, key: str, records: np.ndarray):
+        """
+        Stores a result, and removes the least recently used results if the cache is too large
+        :param key: The cache key (from `key`)
+        :param records: A structured array
+        """
+        names = list(records.dtype.names)
+        columns = {
+            "names": np.array(names),
+            "dtypes": np.array([records.dtype[name].str if records.dtype[name] != object else "O" for name in names]),
+            "length": np.array([len(records)]),
+        }
+        for name in names:
+            if records.dtype[name] == object:
+                values, codes = np.unique(records[name].astype(str), return_inverse=True)
+                columns[name + ".values"] = values
+                columns[name + ".codes"] = codes.astype(np.int32)
+            else:
+                columns[name] = np.ascontiguousarray(records[name])
+        path = os.path.join(self.cache_dir, key + ".npz")
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as cache_file:
+            np.savez(cache_file, **columns)
+        os.replace(temp_path, path)
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used results until the cache fits in its size limit
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".npz"):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime_ns, stat.st_size, name))
+        entries.sort()
+        total = sum(entry[1] for entry in entries)
+        for _, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            total -= size
+
+    def clear(self):
+        """
+        Removes all cached results
+        """
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".npz"):
+                os.remove(os.path.join(self.cache_dir, name))
+
+
+def cache_dir_for(db_path: str) -> str:
+    """
+    Gets the default query cache directory for a grain database
+    :param db_path: The path of the grain database
+    :return: The cache directory, next to the grain database
+    """
+    return os.path.splitext(db_path)[0] + ".query_cache"
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python query_cache.py <grain database>")
+        print("Removes the cached query results of a grain database")
+        sys.exit(1)
+    cache = QueryCache(cache_dir_for(sys.argv[1]))
+    cache.clear()
+    print(f"Cleared {cache.cache_dir}")
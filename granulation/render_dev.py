@@ -132,8 +132,7 @@ if __name__ == "__main__":
             repeated_grain_list = grain_assembler.assemble_repeat(unique_grain_list, 100, -8150, -18.0, effect_chain, None)
 
             # mess with channel indices         
-            for k in range(0, len(repeated_grain_list)):
-                repeated_grain_list[k]["channel"] = (k + 1) % NUM_CHANNELS
+            repeated_grain_list.channel[:] = (np.arange(len(repeated_grain_list)) + 1) % NUM_CHANNELS
             
             repeated_grain_lists.append(repeated_grain_list)
         
@@ -5,7 +5,6 @@ This grain realizer produces chunks of grains with different characteristics
 and interpolates from chunk to chunk to make a final audio product.
 """
 
-import grain_sql
 import aus.audiofile as audiofile
 import aus.operations as operations
 import random
@@ -13,9 +12,18 @@ import scipy.signal as signal
 from effects import *
 import grain_assembler
 import grain_sql
+from grain_table import GrainTable
+import stream_render
+from source_store import SourceStore
+from source_cache import SourceCache
+from grain_bank import open_grain_bank
+from shared_bank import SharedGrainBank
+from path_index import PathIndex, open_path_index
+from query_cache import QueryCache, cache_dir_for
 import os
 import platform
-import multiprocessing as mp
+import collections
+import concurrent.futures
 from datetime import datetime
 
 
@@ -28,32 +36,126 @@ if SYSTEM == "Darwin":
     SOURCE_DIRS = os.path.join(MAC, "samples/granulation")
     OUT = os.path.join(MAC, "out")
     DB = os.path.join(MAC, "grains.sqlite3")
+    STORE = os.path.join(MAC, "grain_store")
+    BANK = os.path.join(MAC, "grains.bank")
     
 elif SYSTEM == "Linux":
     SOURCE_DIRS = [os.path.join(ARGON, "samples/granulation"), os.path.join("/old_Users/jmartin50/recording", "samples/granulation")]
     OUT = os.path.join(ARGON, "out")
     DB = os.path.join(ARGON, "grains.sqlite3")
+    STORE = os.path.join(ARGON, "grain_store")
+    BANK = os.path.join(ARGON, "grains.bank")
 
 else:
     SOURCE_DIRS = os.path.join(PC, "samples\\granulation")
     OUT = os.path.join(PC, "out")
     DB = os.path.join(PC, "grains.sqlite3")
+    STORE = os.path.join(PC, "grain_store")
+    BANK = os.path.join(PC, "grains.bank")
 
 print(f"Out directory: {OUT}\nSource directory: {SOURCE_DIRS}\nDatabase: {DB}")
 
 
-def render(grain_entry_categories, num_unique_grains_per_section, num_repetitions, overlap_num, num_channels, source_dirs, out_dir, name):
+def select_grains(grain_entry_categories, num_unique_grains_per_section, rng: random.Random) -> list:
+    """
+    Selects random grains from each category, without replacement. Grains that should never be used
+    (such as the church bells) are left out when the categories are retrieved (see `grain_sql.sample_grains`).
+    :param grain_entry_categories: A list of grain record arrays (from `grain_sql.select_categories`) or grain record lists
+    :param num_unique_grains_per_section: The number of grains to draw from each category. If a category has fewer grains,
+    all of them are used, in a random order.
+    :param rng: The random number generator to use
+    :return: A list with the indices of the selected grains in each category
+    """
+    return [rng.sample(range(len(entry_category)), min(num_unique_grains_per_section, len(entry_category)))
+            for entry_category in grain_entry_categories]
+
+
+def realize_categories(grain_entry_categories, selections, source_dirs, store=None, cache=None, bank=None, prefetch=0):
+    """
+    Realizes the selected grains of each category, in order. This is a generator, so the caller can work on
+    one category while the next ones are realized. With prefetch, a background thread pool reads and decodes
+    the source files of the next categories, which hides most of the file latency (spinning disks, network drives).
+    :param grain_entry_categories: A list of grain record arrays (from `grain_sql.select_categories`) or grain record lists
+    :param selections: A list with the indices of the selected grains in each category (from `select_grains`)
+    :param source_dirs: The location(s) of the audio files, or a PathIndex (see path_index.py)
+    :param store: A SourceStore, or None
+    :param cache: A SourceCache, or None. The cache can be shared by the prefetch threads.
+    :param bank: A GrainBank, or None
+    :param prefetch: The number of categories to realize ahead of the caller. At most this many categories
+    (plus the one the caller is using) are held in memory. If 0, each category is realized when it is requested.
+    :return: A generator of realized grain lists (see `grain_sql.realize_grains`), one for each category
+    """
+    def realize(j):
+        return grain_sql.realize_grains(grain_sql.record_dicts(grain_entry_categories[j], selections[j]), source_dirs, store, cache, bank)
+
+    if prefetch <= 0:
+        for j in range(len(selections)):
+            yield realize(j)
+        return
+
+    if isinstance(source_dirs, PathIndex):
+        # The index database can only be read by this thread
+        source_dirs.load()
+    with concurrent.futures.ThreadPoolExecutor(prefetch) as executor:
+        futures = collections.deque(executor.submit(realize, j) for j in range(min(prefetch, len(selections))))
+        next_category = len(futures)
+        try:
+            while len(futures) > 0:
+                grain_list = futures.popleft().result()
+                if next_category < len(selections):
+                    futures.append(executor.submit(realize, next_category))
+                    next_category += 1
+                yield grain_list
+        finally:
+            # If the caller stops early, don't realize the categories that haven't started yet
+            for future in futures:
+                future.cancel()
+
+
+def render(grain_entry_categories, num_unique_grains_per_section, num_repetitions, overlap_num, num_channels, source_dirs, out_dir, name, block_size=None, store=None, cache=None, seed=None, bank=None, 
+           prefetch=0):
     """
     Renders an audio file
-    :param grain_entry_categories: A list of grain record lists
+    :param grain_entry_categories: A list of grain record arrays (from `grain_sql.select_categories`) or grain record lists
     :param num_unique: The number of unique grains to use for each category
     :param num_channels: The number of channels in the output audio file
-    :param source_dirs: The location(s) of the audio files
+    :param source_dirs: The location(s) of the audio files, or a PathIndex (see path_index.py)
     :param out_dir: The output directory
     :param name: The output file name
+    :param block_size: If provided, the audio is merged, mastered and written in blocks of (approximately) this many frames,
+    so that peak memory doesn't depend on the length of the audio
+    :param store: A SourceStore of memory-mapped source files (see source_store.py). If None, the source files will be decoded.
+    :param cache: A SourceCache of decoded source audio (see source_cache.py), which can be shared between renders
+    :param seed: The random seed. If None, the render will not be reproducible.
+    :param bank: A GrainBank of packed grain audio (see grain_bank.py). Grains in the bank don't need the source files.
+    :param prefetch: The number of categories to realize in the background while the current category is assembled
+    (see `realize_categories`). The output doesn't depend on this.
     """
-    # print(f"Generating audio candidate {i+1}...")
+    rng = random.Random()
+    rng.seed(seed)
     
+    # Assemble the unique grain lists. There will be N lists, one for each SELECT statement.
+    # The lists are realized as render_grains consumes them.
+    selections = select_grains(grain_entry_categories, num_unique_grains_per_section, rng)
+    unique_grain_lists = ([grain for grain in grain_list if grain != 0] for grain_list in
+                          realize_categories(grain_entry_categories, selections, source_dirs, store, cache, bank, prefetch))
+
+    render_grains(unique_grain_lists, num_repetitions, overlap_num, num_channels, out_dir, name, rng, block_size)
+
+
+def render_grains(unique_grain_lists, num_repetitions, overlap_num, num_channels, out_dir, name, rng: random.Random, block_size=None):
+    """
+    Renders an audio file from realized grains
+    :param unique_grain_lists: A list (or an iterable, such as a generator) of realized grain lists, one for each category.
+    Each list is assembled as soon as it is available.
+    :param num_repetitions: The number of times to repeat each grain list
+    :param overlap_num: The distance between grains, in frames
+    :param num_channels: The number of channels in the output audio file
+    :param out_dir: The output directory
+    :param name: The output file name
+    :param rng: The random number generator to use
+    :param block_size: If provided, the audio is merged, mastered and written in blocks of (approximately) this many frames
+    """
     effect_chain = [
         ButterworthFilterEffect(50, "highpass", 4)
     ]
@@ -67,23 +169,7 @@ def render(grain_entry_categories, num_unique_grains_per_section, num_repetition
         ButterworthFilterEffect(440, "lowpass", 2),
         ChorusEffect(2, 0.5, 20, 0.4, 0.5),
     ]
-    
-    rng = random.Random()
-    rng.seed()
-    
-    # Assemble the unique grain lists. There will be N lists, one for each SELECT statement.
-    unique_grain_lists = []
-    for j, entry_category in enumerate(grain_entry_categories):
-        grain_list = []
-        # select NUM unique grains
-        for _ in range(num_unique_grains_per_section):
-            idx = rng.randrange(0, len(entry_category))
-            if "church-bell" not in entry_category[idx]["file"]:
-                grain_list.append(entry_category[idx])
-        grain_list = grain_sql.realize_grains(grain_list, source_dirs)
-        # print(f"{len(grain_list)} grains added to the list")
-        unique_grain_lists.append(grain_list)
-    
+
     # Repeat the chunks to make longer audio
     repeated_grain_lists = []
     for j, unique_grain_list in enumerate(unique_grain_lists):
@@ -92,8 +178,7 @@ def render(grain_entry_categories, num_unique_grains_per_section, num_repetition
         grain_assembler.swap_random_pair(repeated_grain_list, 0.1, rng)
 
         # mess with channel indices, etc.
-        for k in range(0, len(repeated_grain_list)):
-            repeated_grain_list[k]["channel"] = (k + 1) % num_channels
+        repeated_grain_list.channel[:] = (np.arange(len(repeated_grain_list)) + 1) % num_channels
         grain_assembler.randomize_param(repeated_grain_list, "distance_between_grains", rng, 40)
         
         repeated_grain_lists.append(repeated_grain_list)
@@ -101,19 +186,37 @@ def render(grain_entry_categories, num_unique_grains_per_section, num_repetition
     # Merge the grains into their final positions in an audio array
     grains = []
     for j in range(1, len(repeated_grain_lists)):
-        grains += grain_assembler.interpolate(repeated_grain_lists[j-1][len(repeated_grain_lists[j-1])//2:], repeated_grain_lists[j][:len(repeated_grain_lists[j])//2])
+        grains.append(grain_assembler.interpolate(repeated_grain_lists[j-1][len(repeated_grain_lists[j-1])//2:], repeated_grain_lists[j][:len(repeated_grain_lists[j])//2]))
+    grains = GrainTable.concatenate(grains)
     grain_assembler.swap_random_pair(grains, 0.1, rng)
     # print("Grains interpolated")
 
     grain_assembler.calculate_grain_positions(grains)
+    lpf = signal.butter(2, 500, btype="lowpass", output="sos", fs=44100)
+    hpf = signal.butter(8, 100, btype="highpass", output="sos", fs=44100)
+
+    if block_size is not None:
+        # The equal energy windows need to line up with the blocks
+        block_size = max(1, round(block_size / 22050)) * 22050
+        num_frames = int(grains.end_idx.max())
+        stages = [
+            stream_render.EqualEnergyStage(-3, 22050),
+            stream_render.SosFilterStage(lpf, num_channels),
+            stream_render.SosFilterStage(hpf, num_channels),
+            stream_render.FadeStage(num_frames, 22050, 22050)
+        ]
+        path = os.path.join(out_dir, name)
+        print(f"Writing file {path} with {num_frames} samples")
+        blocks = grain_assembler.merge_stream(grains, num_channels, np.hanning, block_size)
+        stream_render.render_stream(blocks, path, num_frames, num_channels, stages, -3, 44100, 24)
+        return
+
     grain_audio = grain_assembler.merge(grains, num_channels, np.hanning)
     grain_audio = operations.force_equal_energy(grain_audio, -3, 22050)
     
     # print("Ready to apply effects")
 
     # Apply final effects to the assembled audio
-    lpf = signal.butter(2, 500, btype="lowpass", output="sos", fs=44100)
-    hpf = signal.butter(8, 100, btype="highpass", output="sos", fs=44100)
     grain_audio = signal.sosfilt(lpf, grain_audio)
     grain_audio = signal.sosfilt(hpf, grain_audio)
     grain_audio = operations.fade_in(grain_audio, "hanning", 22050)
@@ -132,122 +235,261 @@ def render(grain_entry_categories, num_unique_grains_per_section, num_repetition
     # print("Done.")
 
 
+def render_candidates(grain_entry_categories, num_candidates, num_unique_grains_per_section, num_repetitions, overlap_num, num_channels, source_dirs, out_dir, 
+                      seed=None, max_workers=None, memory_limit=None, block_size=None, store=None, cache=None, bank=None, prefetch=0):
+    """
+    Renders several audio candidates in parallel. The grains for all candidates are realized once, in this process,
+    and shared with the render processes through shared memory. Candidate i is rendered with seed `seed + i`,
+    so it can be reproduced with `render(..., seed=seed + i)`.
+    :param grain_entry_categories: A list of grain record arrays (from `grain_sql.select_categories`) or grain record lists
+    :param num_candidates: The number of candidates to render
+    :param num_unique_grains_per_section: The number of unique grains to use for each category
+    :param num_repetitions: The number of times to repeat each grain list
+    :param overlap_num: The distance between grains, in frames
+    :param num_channels: The number of channels in the output audio files
+    :param source_dirs: The location(s) of the audio files, or a PathIndex (see path_index.py)
+    :param out_dir: The output directory. The files will be named out_1.wav, out_2.wav, etc.
+    :param seed: The base random seed. If None, a seed will be chosen and printed.
+    :param max_workers: The maximum number of render processes. If None, the number of CPUs is used.
+    :param memory_limit: The approximate maximum number of bytes that the render processes can use at once. If None, there is no limit.
+    :param block_size: If provided, the candidates are rendered in streaming mode (see `render`)
+    :param store: A SourceStore of memory-mapped source files (see source_store.py)
+    :param cache: A SourceCache of decoded source audio (see source_cache.py)
+    :param bank: A GrainBank of packed grain audio (see grain_bank.py)
+    :param prefetch: The number of categories to realize in the background (see `realize_categories`)
+    """
+    if seed is None:
+        seed = random.SystemRandom().randrange(2 ** 32)
+        print(f"Rendering candidates with seed {seed}")
+    seeds = [seed + i for i in range(num_candidates)]
+
+    # Select the grains for every candidate, and realize each selected grain once.
+    # The render processes repeat the same selection with the same seed.
+    selected = [set() for _ in grain_entry_categories]
+    for candidate_seed in seeds:
+        for j, selection in enumerate(select_grains(grain_entry_categories, num_unique_grains_per_section, random.Random(candidate_seed))):
+            selected[j].update(selection)
+    slots = {}
+    grain_audio = []
+    selections = [sorted(indices) for indices in selected]
+    for j, realized in enumerate(realize_categories(grain_entry_categories, selections, source_dirs, store, cache, bank, prefetch)):
+        for idx, grain in zip(selections[j], realized):
+            if grain != 0:
+                slots[(j, idx)] = len(grain_audio)
+                grain_audio.append(grain["grain"])
+    bank = SharedGrainBank.create(grain_audio)
+    del grain_audio
+
+    # Limit the number of processes, so that the renders fit in the memory limit
+    num_workers = min(num_candidates, max_workers if max_workers is not None else os.cpu_count())
+    if memory_limit is not None:
+        candidate_bytes = _estimate_render_bytes(len(grain_entry_categories), num_unique_grains_per_section, num_repetitions, bank.lengths, overlap_num, num_channels, block_size)
+        num_workers = max(1, min(num_workers, memory_limit // candidate_bytes))
+    print(f"Rendering {num_candidates} candidates with {num_workers} processes")
+
+    try:
+        with concurrent.futures.ProcessPoolExecutor(num_workers, initializer=_init_render_worker, 
+                                                    initargs=(grain_entry_categories, bank.descriptor, slots)) as executor:
+            futures = [executor.submit(_render_candidate, num_unique_grains_per_section, num_repetitions, overlap_num, num_channels, 
+                                       out_dir, f"out_{i+1}.wav", seeds[i], block_size) for i in range(num_candidates)]
+            for future in futures:
+                future.result()
+    finally:
+        bank.close()
+
+
+# The number of full-length float64 copies of the audio that the mastering chain in `render_grains` holds at once:
+# each step returns a new array, so the input and the output of a step are alive together, plus the temporary
+# arrays inside the step (such as the energy envelope of `force_equal_energy`)
+AUDIO_COPIES = 3
+# The float64 working set of `grain_assembler._overlap_add`: a chunk of up to `block_frames` (2 ** 20) stacked grains,
+# the windowed chunk, and the windowed grains gathered into start order
+MERGE_BYTES = 3 * 2 ** 20 * 8
+# The bytes per grain of a GrainTable (int32 grain, int16 channel, int32 distance and int64 start index), times the
+# number of tables that are alive at once (the repeated lists, the interpolated lists and their concatenation)
+GRAIN_ROW_BYTES = 18 * 3
+
+
+def _estimate_render_bytes(num_categories, num_unique_grains_per_section, num_repetitions, grain_lengths, overlap_num, num_channels, block_size=None) -> int:
+    """
+    Estimates the peak memory use of one render. The grains are views of a shared bank, so only the copies
+    that a render makes are counted: the effect chain output for each unique grain, the grain tables,
+    the merge working set and the output audio.
+    :param num_categories: The number of grain categories
+    :param num_unique_grains_per_section: The number of unique grains used for each category
+    :param num_repetitions: The number of times each grain list is repeated
+    :param grain_lengths: The lengths of the grains that the render draws from (such as `SharedGrainBank.lengths`)
+    :param overlap_num: The distance between grains, in frames
+    :param num_channels: The number of channels
+    :param block_size: The streaming block size, or None
+    :return: The estimated number of bytes
+    """
+    grain_length = float(np.mean(grain_lengths)) if len(grain_lengths) > 0 else 0.0
+    # Each pair of neighboring categories is interpolated, so there is one section fewer than there are categories
+    num_grains = max(num_categories - 1, 1) * num_unique_grains_per_section * num_repetitions
+    num_frames = num_grains * max(grain_length + overlap_num, 1)
+    if block_size is not None:
+        # The streaming stages only hold the current block and the tails of the grains that run past it
+        num_frames = min(num_frames, block_size + grain_length)
+    audio_bytes = num_frames * num_channels * 8 * AUDIO_COPIES
+    # The effect chain makes one float64 copy of each unique grain
+    grain_bytes = num_categories * num_unique_grains_per_section * grain_length * 8 + num_grains * GRAIN_ROW_BYTES
+    return int(audio_bytes + grain_bytes + MERGE_BYTES)
+
+
+_worker_state = {}
+
+
+def _init_render_worker(grain_entry_categories, bank_descriptor, slots):
+    """
+    Initializes a render process. This receives the grain metadata once per process.
+    :param grain_entry_categories: A list of grain record arrays (from `grain_sql.select_categories`) or grain record lists
+    :param bank_descriptor: The descriptor of the shared grain bank
+    :param slots: A dictionary mapping (category, index) to the index of the grain in the bank
+    """
+    _worker_state["categories"] = grain_entry_categories
+    _worker_state["bank"] = SharedGrainBank.attach(bank_descriptor)
+    _worker_state["slots"] = slots
+
+
+def _render_candidate(num_unique_grains_per_section, num_repetitions, overlap_num, num_channels, out_dir, name, seed, block_size):
+    """
+    Renders one candidate in a render process, using grains from the shared grain bank
+    """
+    categories = _worker_state["categories"]
+    bank = _worker_state["bank"]
+    slots = _worker_state["slots"]
+    rng = random.Random()
+    rng.seed(seed)
+    unique_grain_lists = []
+    for j, selection in enumerate(select_grains(categories, num_unique_grains_per_section, rng)):
+        grain_list = []
+        for idx in selection:
+            if (j, idx) in slots:
+                grain = grain_sql.record_dicts(categories[j], [idx])[0]
+                grain["grain"] = bank[slots[(j, idx)]]
+                grain_list.append(grain)
+        unique_grain_lists.append(grain_list)
+    render_grains(unique_grain_lists, num_repetitions, overlap_num, num_channels, out_dir, name, rng, block_size)
+
+
 if __name__ == "__main__":
     LENGTH = 8192
-    SELECT = [
-        f"""SELECT * FROM grains 
-        WHERE (length = {LENGTH})
+    CATEGORIES = [
+        f"""(length = {LENGTH})
             AND (spectral_flatness BETWEEN 0.00 AND 0.05) 
             AND (spectral_roll_off_75 BETWEEN 100 AND 200)
-            AND (frequency IS NULL);""",
-        f"""SELECT * FROM grains 
-        WHERE (length = {LENGTH})
+            AND (frequency IS NULL)""",
+        f"""(length = {LENGTH})
             AND (spectral_flatness BETWEEN 0.1 AND 0.3) 
-            AND (spectral_roll_off_75 BETWEEN 100 AND 300);""",
-        f"""SELECT * FROM grains 
-        WHERE (length = {LENGTH})
+            AND (spectral_roll_off_75 BETWEEN 100 AND 300)""",
+        f"""(length = {LENGTH})
             AND (spectral_flatness BETWEEN 0.00 AND 0.05) 
             AND (spectral_roll_off_75 BETWEEN 100 AND 200)
-            AND (frequency IS NULL);""",
-        f"""SELECT * FROM grains 
-        WHERE (length = {LENGTH})
+            AND (frequency IS NULL)""",
+        f"""(length = {LENGTH})
             AND (spectral_flatness BETWEEN 0.1 AND 0.5) 
-            AND (spectral_roll_off_75 BETWEEN 100 AND 400);""",
-        f"""SELECT * FROM grains 
-        WHERE (length = {LENGTH})
+            AND (spectral_roll_off_75 BETWEEN 100 AND 400)""",
+        f"""(length = {LENGTH})
             AND (spectral_flatness BETWEEN 0.00 AND 0.05) 
             AND (spectral_roll_off_75 BETWEEN 75 AND 500)
-            AND (frequency IS NULL);""",
-        f"""SELECT * FROM grains 
-        WHERE (length = {LENGTH})
+            AND (frequency IS NULL)""",
+        f"""(length = {LENGTH})
             AND (spectral_flatness BETWEEN 0.1 AND 0.2) 
-            AND (spectral_roll_off_75 BETWEEN 100 AND 200);""",
-        f"""SELECT * FROM grains 
-        WHERE (length = {LENGTH})
+            AND (spectral_roll_off_75 BETWEEN 100 AND 200)""",
+        f"""(length = {LENGTH})
             AND (spectral_flatness BETWEEN 0.00 AND 0.05) 
             AND (spectral_roll_off_75 BETWEEN 75 AND 600)
-            AND (frequency IS NULL);""",
-        f"""SELECT * FROM grains 
-        WHERE (length = {LENGTH})
+            AND (frequency IS NULL)""",
+        f"""(length = {LENGTH})
             AND (spectral_flatness BETWEEN 0.2 AND 0.8) 
-            AND (spectral_roll_off_75 BETWEEN 100 AND 500);""",
-        f"""SELECT * FROM grains 
-        WHERE (length = {LENGTH})
+            AND (spectral_roll_off_75 BETWEEN 100 AND 500)""",
+        f"""(length = {LENGTH})
             AND (spectral_flatness BETWEEN 0.00 AND 0.05) 
             AND (spectral_roll_off_75 BETWEEN 50 AND 800)
-            AND (frequency IS NULL);""",
-        f"""SELECT * FROM grains 
-        WHERE (length = {LENGTH})
+            AND (frequency IS NULL)""",
+        f"""(length = {LENGTH})
             AND (spectral_flatness BETWEEN 0.5 AND 1.0) 
-            AND (spectral_roll_off_75 BETWEEN 100 AND 200);""",
-        f"""SELECT * FROM grains 
-        WHERE (length = {LENGTH})
+            AND (spectral_roll_off_75 BETWEEN 100 AND 200)""",
+        f"""(length = {LENGTH})
             AND (spectral_flatness BETWEEN 0.00 AND 0.05) 
             AND (spectral_roll_off_75 BETWEEN 50 AND 900)
-            AND (frequency IS NULL);""",
-        f"""SELECT * FROM grains 
-        WHERE (length = {LENGTH})
+            AND (frequency IS NULL)""",
+        f"""(length = {LENGTH})
             AND (spectral_flatness BETWEEN 0.3 AND 0.7) 
-            AND (spectral_roll_off_75 BETWEEN 50 AND 1000);""",
-        f"""SELECT * FROM grains 
-        WHERE (length = {LENGTH})
+            AND (spectral_roll_off_75 BETWEEN 50 AND 1000)""",
+        f"""(length = {LENGTH})
             AND (spectral_flatness BETWEEN 0.00 AND 0.05) 
             AND (spectral_roll_off_75 BETWEEN 50 AND 1100)
-            AND (frequency IS NULL);""",
-        f"""SELECT * FROM grains 
-        WHERE (length = {LENGTH})
+            AND (frequency IS NULL)""",
+        f"""(length = {LENGTH})
             AND (spectral_flatness BETWEEN 0.1 AND 0.4) 
-            AND (spectral_roll_off_75 BETWEEN 20 AND 1400);""",
+            AND (spectral_roll_off_75 BETWEEN 20 AND 1400)""",
     ]
 
     # EPSILON = 0.2
-    # SELECT = [
-    #     f"""SELECT * FROM grains 
-    #         WHERE (length = 8192)
+    # CATEGORIES = [
+    #     f"""(length = 8192)
     #         AND (spectral_flatness BETWEEN 0.00 AND 0.05)
-    #         AND (midi BETWEEN {69-EPSILON} AND {69 + EPSILON});""",
-    #     f"""SELECT * FROM grains 
-    #         WHERE (length = 8192)
+    #         AND (midi BETWEEN {69-EPSILON} AND {69 + EPSILON})""",
+    #     f"""(length = 8192)
     #         AND (spectral_flatness BETWEEN 0.00 AND 0.05)
-    #         AND (midi BETWEEN {62-EPSILON} AND {62 + EPSILON});""",
-    #     f"""SELECT * FROM grains 
-    #         WHERE (length = 8192)
+    #         AND (midi BETWEEN {62-EPSILON} AND {62 + EPSILON})""",
+    #     f"""(length = 8192)
     #         AND (spectral_flatness BETWEEN 0.00 AND 0.05)
-    #         AND (midi BETWEEN {64-EPSILON} AND {64 + EPSILON});""",
-    #     f"""SELECT * FROM grains 
-    #         WHERE (length = 8192)
+    #         AND (midi BETWEEN {64-EPSILON} AND {64 + EPSILON})""",
+    #     f"""(length = 8192)
     #         AND (spectral_flatness BETWEEN 0.00 AND 0.05)
-    #         AND (midi BETWEEN {67-EPSILON} AND {67 + EPSILON});""",
+    #         AND (midi BETWEEN {67-EPSILON} AND {67 + EPSILON})""",
     #     ]
 
+    # Alternatively, select grains along a trajectory of (spectral_flatness, spectral_roll_off_75) targets
+    # with the nearest-neighbour feature index (see feature_index.py, and import feature_index)
+    # features = feature_index.load_feature_index(DB, where=f"length = {LENGTH}")
+    # grain_entry_categories = features.categories(np.stack((np.linspace(0.0, 0.3, 14), np.linspace(150, 1400, 14)), axis=-1), 2000)
+
+    # The random seed for the grain selection and the render. The same seed renders the same audio from the same database.
+    SEED = random.SystemRandom().randrange(2 ** 32)
+    # Render several candidates in parallel (see render_candidates) rather than one file
+    CANDIDATES = False
+    NUM_AUDIO_CANDIDATES = 5
+    NUM_CHANNELS = 2
+    NUM_UNIQUE_GRAINS = 100
+    print(f"Seed: {SEED}")
+
     print("Retrieving grains...")
-    # Retrieve grain metadata and grains
+    # Retrieve grain metadata and grains. Rather than retrieving every grain in each category, the grains are drawn
+    # uniformly from each category in SQLite (see grain_sql.sample_grains), with a seed for each category derived
+    # from the render seed. The samples are cached on disk (see query_cache.py), so a later run with the same seed
+    # loads them without querying the database, until the database changes. A render uses all of the grains drawn;
+    # the candidates draw from NUM_AUDIO_CANDIDATES times as many grains, so that they don't all use the same grains.
+    POOL_SIZE = NUM_UNIQUE_GRAINS * (NUM_AUDIO_CANDIDATES if CANDIDATES else 1)
     db, cursor = grain_sql.connect_to_db(DB)
-    grain_entry_categories = []
-    for i, select in enumerate(SELECT):
-        cursor.execute(select)
-        records = cursor.fetchall()
-        if len(records) == 0:
+    sample_cache = QueryCache(cache_dir_for(DB))
+    grain_entry_categories = [grain_sql.sample_grains(cursor, category, POOL_SIZE, seed=[SEED, i], exclude=["file LIKE '%church-bell%'"], cache=sample_cache)
+                              for i, category in enumerate(CATEGORIES)]
+    for i, entry_category in enumerate(grain_entry_categories):
+        if len(entry_category) == 0:
             raise Exception(f"No grains found for index {i}.")
-        entry_category = []
-        for record in records:
-            entry_category.append({grain_sql.FIELDS[i]: record[i] for i in range(len(record))})
-        grain_entry_categories.append(entry_category)
-
     db.close()
     start = datetime.now()
     print("Found grains")
 
     # Generate candidate audio
-    NUM_AUDIO_CANDIDATES = 5
-    NUM_CHANNELS = 2
-    NUM_UNIQUE_GRAINS = 100
-    render(grain_entry_categories, NUM_UNIQUE_GRAINS, 20, -8100, NUM_CHANNELS, SOURCE_DIRS, OUT, "out_1.wav")
-    # processes = [mp.Process(target=render, args=(grain_entry_categories, NUM_UNIQUE_GRAINS, 800, -4050, NUM_CHANNELS, SOURCE_DIRS, OUT, f"out_{i+1}.wav")) for i in range(NUM_AUDIO_CANDIDATES)]
-    # for p in processes:
-    #     p.start()
-    # for p in processes:
-    #     p.join()
+    # Use the memory-mapped source store if it has been built (see source_store.py)
+    store = SourceStore(STORE) if os.path.exists(STORE) else None
+    cache = SourceCache(4 * 1024 ** 3)
+    # Find the source files with the file index rather than walking the source directories
+    paths = open_path_index(DB, SOURCE_DIRS)
+    # Use the packed grain bank if it has been exported (see grain_bank.py)
+    bank = open_grain_bank(BANK)
+    if CANDIDATES:
+        render_candidates(grain_entry_categories, NUM_AUDIO_CANDIDATES, NUM_UNIQUE_GRAINS, 800, -4050, NUM_CHANNELS, paths, OUT, 
+                          seed=SEED, memory_limit=32 * 1024 ** 3, store=store, cache=cache, bank=bank, prefetch=2)
+    else:
+        render(grain_entry_categories, NUM_UNIQUE_GRAINS, 20, -8100, NUM_CHANNELS, paths, OUT, "out_1.wav", store=store, cache=cache, seed=SEED, bank=bank, prefetch=2)
+    print(cache)
+    paths.close()
     duration = datetime.now() - start
     print("Elapsed time: {}:{:2}".format(duration.seconds // 60, duration.seconds % 60))
     
\ No newline at end of file
@@ -1,13 +1,25 @@
--- The grain table
-CREATE TABLE grains (
+-- The source files. A file's path is root || path.
+CREATE TABLE files (
     id INTEGER PRIMARY KEY,
-    file TEXT NOT NULL,
+    root TEXT NOT NULL,
+    path TEXT NOT NULL,
+    sample_rate INTEGER,
+    num_frames INTEGER,
+    UNIQUE (root, path)
+);
+
+-- The grain rows. The columns are in grain_sql.FIELDS order, with a file_id instead of the file path.
+CREATE TABLE grain_data (
+    id INTEGER PRIMARY KEY,
+    file_id INTEGER NOT NULL REFERENCES files (id),
     start_frame INTEGER NOT NULL,
     end_frame INTEGER NOT NULL,
+    length INTEGER NOT NULL,
     sample_rate INTEGER NOT NULL,
     grain_duration REAL NOT NULL,
     frequency REAL,
     midi REAL,
+    energy REAL,
     spectral_centroid REAL NULL,
     spectral_entropy REAL NOT NULL,
     spectral_flatness REAL NOT NULL,
@@ -23,3 +35,26 @@ CREATE TABLE grains (
     spectral_slope_0_5_khz REAL NOT NULL,
     spectral_variance REAL NOT NULL
 );
+
+-- The grains view, with the columns in grain_sql.FIELDS order (see migrate.py)
+CREATE VIEW grains AS SELECT grain_data.id AS id, files.root || files.path AS file, grain_data.file_id, grain_data.start_frame, grain_data.end_frame, grain_data.length, grain_data.sample_rate, grain_data.grain_duration, grain_data.frequency, grain_data.midi, grain_data.energy, grain_data.spectral_centroid, grain_data.spectral_entropy, grain_data.spectral_flatness, grain_data.spectral_kurtosis, grain_data.spectral_roll_off_50, grain_data.spectral_roll_off_75, grain_data.spectral_roll_off_90, grain_data.spectral_roll_off_95, grain_data.spectral_skewness, grain_data.spectral_slope, grain_data.spectral_slope_0_1_khz, grain_data.spectral_slope_1_5_khz, grain_data.spectral_slope_0_5_khz, grain_data.spectral_variance
+    FROM grain_data LEFT JOIN files ON files.id = grain_data.file_id;
+
+-- Inserting into and deleting from the grains view
+CREATE TRIGGER grains_insert INSTEAD OF INSERT ON grains BEGIN
+    INSERT OR IGNORE INTO files (root, path, sample_rate) VALUES (rtrim(NEW.file, replace(replace(NEW.file, '/', ''), '\', '')), substr(NEW.file, length(rtrim(NEW.file, replace(replace(NEW.file, '/', ''), '\', ''))) + 1), NEW.sample_rate);
+    INSERT INTO grain_data (id, file_id, start_frame, end_frame, length, sample_rate, grain_duration, frequency, midi, energy, spectral_centroid, spectral_entropy, spectral_flatness, spectral_kurtosis, spectral_roll_off_50, spectral_roll_off_75, spectral_roll_off_90, spectral_roll_off_95, spectral_skewness, spectral_slope, spectral_slope_0_1_khz, spectral_slope_1_5_khz, spectral_slope_0_5_khz, spectral_variance) VALUES (NEW.id, COALESCE((SELECT id FROM files
+        WHERE root = rtrim(NEW.file, replace(replace(NEW.file, '/', ''), '\', '')) AND path = substr(NEW.file, length(rtrim(NEW.file, replace(replace(NEW.file, '/', ''), '\', ''))) + 1)), NEW.file_id), NEW.start_frame, NEW.end_frame, NEW.length, NEW.sample_rate, NEW.grain_duration, NEW.frequency, NEW.midi, NEW.energy, NEW.spectral_centroid, NEW.spectral_entropy, NEW.spectral_flatness, NEW.spectral_kurtosis, NEW.spectral_roll_off_50, NEW.spectral_roll_off_75, NEW.spectral_roll_off_90, NEW.spectral_roll_off_95, NEW.spectral_skewness, NEW.spectral_slope, NEW.spectral_slope_0_1_khz, NEW.spectral_slope_1_5_khz, NEW.spectral_slope_0_5_khz, NEW.spectral_variance);
+END;
+
+CREATE TRIGGER grains_delete INSTEAD OF DELETE ON grains BEGIN
+    DELETE FROM grain_data WHERE id = OLD.id;
+END;
+
+-- Indexes for the common range predicates (see migrate.py)
+CREATE INDEX grain_data_length_flatness_roll_off_75 ON grain_data (length, spectral_flatness, spectral_roll_off_75);
+CREATE INDEX grain_data_unpitched_length_flatness_roll_off_75 ON grain_data (length, spectral_flatness, spectral_roll_off_75) WHERE frequency IS NULL;
+CREATE INDEX grain_data_length_midi ON grain_data (length, midi);
+
+-- The schema version (the number of migrations in migrate.py)
+PRAGMA user_version = 3;
@@ -1,6 +1,20 @@
 from setuptools import setup, Extension
 from Cython.Build import cythonize
 import numpy as np
+import sys
 
-setup(name="grain_tools", ext_modules=cythonize(Extension("grain_tools", ["grain_tools.py"], include_dirs=[np.get_include()])))
+# OpenMP for the parallel loops in grain_tools. Apple's compiler doesn't include OpenMP,
+# so on macOS the parallel loops run on one thread.
+if sys.platform == "win32":
+    openmp_compile_args = ["/openmp"]
+    openmp_link_args = []
+elif sys.platform == "darwin":
+    openmp_compile_args = []
+    openmp_link_args = []
+else:
+    openmp_compile_args = ["-fopenmp"]
+    openmp_link_args = ["-fopenmp"]
 
+setup(name="grain_tools", ext_modules=cythonize(Extension("grain_tools", ["grain_tools.py"], include_dirs=[np.get_include()],
+                                                          extra_compile_args=openmp_compile_args, extra_link_args=openmp_link_args),
+                                                language_level=3))
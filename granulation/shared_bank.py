@@ -0,0 +1,111 @@
+"""
+File: shared_bank.py
+
+Description: A grain bank in shared memory. Realized grain audio is packed into one
+`multiprocessing.shared_memory` block, so that render processes can use the same
+grains without pickling or copying the audio.
+"""
+
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+import sys
+
+
+class SharedGrainBank:
+    """
+    A list of 1D grain arrays packed into a shared memory block
+    """
+    def __init__(self, shm: shared_memory.SharedMemory, offsets: np.ndarray, lengths: np.ndarray, dtype=np.float64, owner: bool = False):
+        """
+        Initializes the SharedGrainBank. Use `SharedGrainBank.create` or `SharedGrainBank.attach` rather than calling this directly.
+        :param shm: The shared memory block
+        :param offsets: The offset of each grain, in samples
+        :param lengths: The length of each grain, in samples
+        :param dtype: The sample data type
+        :param owner: Whether this process created the shared memory block (and should unlink it)
+        """
+        self.shm = shm
+        self.offsets = offsets
+        self.lengths = lengths
+        self.dtype = np.dtype(dtype)
+        self.owner = owner
+        self.samples = np.ndarray((int(offsets[-1] + lengths[-1]) if len(offsets) > 0 else 0), dtype=self.dtype, buffer=shm.buf)
+
+    def __len__(self) -> int:
+        return self.offsets.shape[-1]
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        """
+        Gets a grain
+        :param i: The grain index
+        :return: A view of the grain in shared memory
+        """
+        return self.samples[self.offsets[i]:self.offsets[i] + self.lengths[i]]
+
+    @property
+    def descriptor(self) -> tuple:
+        """
+        A small, picklable description of the bank that can be sent to other processes and passed to `SharedGrainBank.attach`
+        """
+        return (self.shm.name, self.offsets, self.lengths, self.dtype.str)
+
+    @staticmethod
+    def create(grains: list, dtype=np.float64):
+        """
+        Packs grain arrays into a new shared memory block
+        :param grains: A list of 1D grain arrays
+        :param dtype: The sample data type
+        :return: A new SharedGrainBank. Call `close` when finished with it.
+        """
+        lengths = np.array([grain.shape[-1] for grain in grains], dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64) if len(grains) > 0 else np.zeros((0), dtype=np.int64)
+        size = max(int(lengths.sum()) * np.dtype(dtype).itemsize, 1)
+        bank = SharedGrainBank(shared_memory.SharedMemory(create=True, size=size), offsets, lengths, dtype, True)
+        for i, grain in enumerate(grains):
+            bank[i][:] = grain
+        return bank
+
+    @staticmethod
+    def attach(descriptor: tuple):
+        """
+        Attaches to a shared grain bank made in another process
+        :param descriptor: The bank descriptor
+        :return: A SharedGrainBank. The grains should be treated as read-only.
+        The bank is unlinked by the process that created it, so that process should outlive the attached processes.
+        """
+        name, offsets, lengths, dtype = descriptor
+        if sys.version_info >= (3, 13):
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        else:
+            shm = _attach_untracked(name)
+        return SharedGrainBank(shm, offsets, lengths, dtype, False)
+
+    def close(self):
+        """
+        Closes the shared memory block, and unlinks it if this process created it
+        """
+        self.samples = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def _attach_untracked(name: str) -> shared_memory.SharedMemory:
+    """
+    Attaches to a shared memory block without registering it with the resource tracker (like `track=False`
+    in Python 3.13). Before Python 3.13, attaching registers the block, so a process with its own resource
+    tracker would unlink the block when it exits. Unregistering after attaching doesn't work either, because
+    processes started by multiprocessing share the creating process's tracker, so that would remove the
+    creator's registration too.
+    :param name: The name of the shared memory block
+    :return: The SharedMemory
+    """
+    register = resource_tracker.register
+    def register_untracked(name, rtype):
+        if rtype != "shared_memory":
+            register(name, rtype)
+    resource_tracker.register = register_untracked
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
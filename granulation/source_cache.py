@@ -0,0 +1,106 @@
+"""
+File: source_cache.py
+
+Description: A size-bounded LRU cache of decoded source audio, shared across
+`grain_sql.realize_grains` calls so that the same source file is not decoded
+again for every category and every render. The cache can be shared by threads
+(see `render_interpolator.realize_categories`); files are decoded outside the lock.
+"""
+
+import collections
+import threading
+
+
+class SourceCache:
+    """
+    An LRU cache of decoded source audio, keyed by the file name stored in the grain database.
+    Only channel 0 is cached, because that is the channel that grains are extracted from.
+    """
+    def __init__(self, max_bytes: int = 2 ** 30, ranges_only: bool = False):
+        """
+        Initializes the SourceCache.
+        :param max_bytes: The maximum number of bytes of audio to keep in the cache
+        :param ranges_only: If True, only the frame ranges that have been requested are kept
+        (rather than the whole file). This uses much less memory if only a few grains are used
+        from each file, but a request for a new range of a cached file will decode the file again.
+        """
+        self.max_bytes = max_bytes
+        self.ranges_only = ranges_only
+        self.entries = collections.OrderedDict()
+        self.entry_bytes = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, file: str) -> bool:
+        return file in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __repr__(self) -> str:
+        return f"SourceCache({len(self)} files, {self.nbytes} bytes, {self.hits} hits, {self.misses} misses, {self.evictions} evictions)"
+
+    def get(self, file: str, ranges: list, load) -> list:
+        """
+        Gets frame ranges from a source file, decoding it if necessary
+        :param file: The file name as stored in the grain database
+        :param ranges: A list of (start_frame, end_frame) tuples
+        :param load: A function that decodes the file and returns its channel 0 samples, or None if the file can't be found
+        :return: A list of arrays, one for each range, or None if the file can't be loaded
+        """
+        ranges = [(int(start), int(end)) for start, end in ranges]
+        with self.lock:
+            entry = self.entries.get(file)
+            if entry is not None and (not self.ranges_only or all(r in entry for r in ranges)):
+                self.hits += 1
+                self.entries.move_to_end(file)
+                if self.ranges_only:
+                    return [entry[r] for r in ranges]
+                return [entry[start:end] for start, end in ranges]
+            self.misses += 1
+
+        # Decode without holding the lock, so that other threads can use the cache meanwhile
+        samples = load()
+        if samples is None:
+            return None
+        with self.lock:
+            if self.ranges_only:
+                # Keep copies of the ranges, so that the rest of the file can be freed
+                new_entry = dict(self.entries.get(file, {}))
+                for start, end in ranges:
+                    if (start, end) not in new_entry:
+                        new_entry[(start, end)] = samples[start:end].copy()
+                self._insert(file, new_entry, sum(grain.nbytes for grain in new_entry.values()))
+                return [new_entry[r] for r in ranges]
+            self._insert(file, samples, samples.nbytes)
+        return [samples[start:end] for start, end in ranges]
+
+    def clear(self):
+        """
+        Removes everything from the cache. The counters are not reset.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.entry_bytes.clear()
+            self.nbytes = 0
+
+    def _insert(self, file: str, entry, nbytes: int):
+        """
+        Adds (or replaces) a cache entry and evicts the least recently used entries until the cache fits in its budget
+        :param file: The file name
+        :param entry: The cache entry
+        :param nbytes: The size of the entry in bytes
+        """
+        if file in self.entries:
+            self.nbytes -= self.entry_bytes[file]
+        self.entries[file] = entry
+        self.entries.move_to_end(file)
+        self.entry_bytes[file] = nbytes
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes and len(self.entries) > 0:
+            evicted_file, _ = self.entries.popitem(last=False)
+            self.nbytes -= self.entry_bytes.pop(evicted_file)
+            self.evictions += 1
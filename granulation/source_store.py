@@ -0,0 +1,151 @@
+"""
+File: source_store.py
+
+Description: A store of the source audio files referenced by the grain database.
+Each source file is converted once to a raw float32 file, which is memory-mapped
+when grains are realized. Only the pages that a grain touches are read from disk,
+and several render processes can share the pages through the OS cache.
+The store is keyed by the file id in the grain database, so it stays valid when the
+files are moved to another root (see `grain_sql.update_grain_root`).
+"""
+
+import aus.audiofile as audiofile
+import grain_sql
+import hashlib
+import json
+import numpy as np
+import os
+from path_index import open_path_index
+import sqlite3
+
+
+class SourceStore:
+    """
+    Represents a directory of memory-mapped source audio files
+    """
+    INDEX_FILE = "index.json"
+
+    def __init__(self, store_dir: str):
+        """
+        Initializes the SourceStore.
+        :param store_dir: The store directory (made with `build_source_store`)
+        """
+        self.store_dir = store_dir
+        self.maps = {}
+        index_path = os.path.join(store_dir, SourceStore.INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path, "r") as index_file:
+                self.index = json.loads(index_file.read())
+        else:
+            self.index = {}
+        # The file names are only used for records that don't have a file id
+        self.file_ids = {entry["file"]: int(key) for key, entry in self.index.items() if "file" in entry}
+
+    def __contains__(self, file_id: int) -> bool:
+        return str(file_id) in self.index
+
+    def samples(self, file_id: int) -> np.ndarray:
+        """
+        Gets the samples of a source file
+        :param file_id: The file id in the grain database
+        :return: A read-only memory-mapped array with shape (num_channels, num_frames)
+        """
+        if file_id not in self.maps:
+            entry = self.index[str(file_id)]
+            self.maps[file_id] = np.memmap(os.path.join(self.store_dir, entry["path"]), dtype=np.float32, mode="r",
+                                           shape=(entry["num_channels"], entry["num_frames"]))
+        return self.maps[file_id]
+
+    def add(self, file_id: int, file: str, samples: np.ndarray, sample_rate: int):
+        """
+        Adds a source file to the store. Call `save_index` afterward.
+        :param file_id: The file id in the grain database
+        :param file: The file name as stored in the grain database
+        :param samples: The audio samples, with shape (num_channels, num_frames)
+        :param sample_rate: The sample rate
+        """
+        samples = samples.reshape((-1, samples.shape[-1]))
+        path = hashlib.sha1(file.encode("utf-8")).hexdigest() + ".f32"
+        samples.astype(np.float32).tofile(os.path.join(self.store_dir, path))
+        self.index[str(file_id)] = {
+            "path": path,
+            "file": file,
+            "num_channels": samples.shape[0],
+            "num_frames": samples.shape[-1],
+            "sample_rate": sample_rate
+        }
+        self.file_ids[file] = file_id
+        self.maps.pop(file_id, None)
+
+    def rekey(self, files: list) -> bool:
+        """
+        Updates the index from the files table. Entries of stores made before the store was keyed by file id
+        are keyed by file name, and are moved to their file id (entries that don't match a file are removed).
+        The file names of moved files are updated.
+        :param files: A list of (file id, file name) tuples
+        :return: Whether the index changed (call `save_index` if so)
+        """
+        changed = False
+        for file_id, file in files:
+            key = str(file_id)
+            if key not in self.index and file in self.index:
+                self.index[key] = self.index.pop(file)
+                changed = True
+            if key in self.index and self.index[key].get("file") != file:
+                self.file_ids.pop(self.index[key].get("file"), None)
+                self.index[key]["file"] = file
+                self.file_ids[file] = file_id
+                changed = True
+        for key in [key for key in self.index if not key.isdigit()]:
+            os.remove(os.path.join(self.store_dir, self.index.pop(key)["path"]))
+            changed = True
+        return changed
+
+    def save_index(self):
+        """
+        Writes the index file
+        """
+        index_path = os.path.join(self.store_dir, SourceStore.INDEX_FILE)
+        with open(index_path + ".tmp", "w") as index_file:
+            index_file.write(json.dumps(self.index))
+        os.replace(index_path + ".tmp", index_path)
+
+
+def build_source_store(cursor: sqlite3.Cursor, source_dir, store_dir: str) -> SourceStore:
+    """
+    Converts every source file in the files table to a raw float32 file.
+    Files that are already in the store are skipped, so this can be run again after new grains are added.
+    :param cursor: The cursor for executing SQL
+    :param source_dir: The directory (or list of directories, or PathIndex) that contains the audio files
+    :param store_dir: The store directory
+    :return: The SourceStore
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    store = SourceStore(store_dir)
+    cursor.execute("SELECT id, root || path FROM files;")
+    files = cursor.fetchall()
+    if store.rekey(files):
+        store.save_index()
+    for i, (file_id, file) in enumerate(files):
+        if file_id in store:
+            continue
+        path = grain_sql.find_path(file, source_dir)
+        if not os.path.exists(path):
+            print(f"Could not find path {path} for file {file}")
+            continue
+        audio = audiofile.read(path)
+        store.add(file_id, file, audio.samples, audio.sample_rate)
+        store.save_index()
+        print(f"Stored file {i+1} of {len(files)}: {file}")
+    return store
+
+
+if __name__ == "__main__":
+    DB = "D:\\grains.sqlite3"
+    SOURCE_DIR = "D:\\Recording\\Samples\\granulation"
+    STORE_DIR = "D:\\Recording\\grain_store"
+    db, cursor = grain_sql.connect_to_db(DB)
+    paths = open_path_index(DB, SOURCE_DIR)
+    build_source_store(cursor, paths, STORE_DIR)
+    paths.close()
+    db.close()
@@ -0,0 +1,148 @@
+"""
+File: stream_render.py
+
+Description: Block-by-block mastering and writing of rendered audio. The stages in this file
+are stateful, so that they can process a sequence of audio blocks (for example the output of
+`grain_assembler.merge_stream`) and produce the same result as processing the whole audio array.
+"""
+
+import numpy as np
+import os
+import pedalboard as pb
+import scipy.signal
+
+
+class EqualEnergyStage:
+    """
+    A streaming version of `operations.force_equal_energy`. Each window of audio is scaled so
+    that its peak level is `dbfs`, and the gain is ramped from window to window.
+    The blocks should have a multiple of `window_size` frames (except the last block).
+    """
+    def __init__(self, dbfs: float = -6.0, window_size: int = 8192):
+        """
+        Initializes the EqualEnergyStage.
+        :param dbfs: The target level of each window
+        :param window_size: The window size, in frames
+        """
+        self.dbfs = dbfs
+        self.window_size = window_size
+        self.level = 10 ** (dbfs / 20)
+        self.gain = None
+
+    def __call__(self, audio: np.ndarray) -> np.ndarray:
+        """
+        Processes a block of audio
+        :param audio: The audio block
+        :return: The processed block
+        """
+        audio = audio.copy()
+        for i in range(0, audio.shape[-1], self.window_size):
+            window = audio[..., i:i+self.window_size]
+            peak = np.max(np.abs(window))
+            gain = self.level / peak if peak > 0 else 0.0
+            previous_gain = gain if self.gain is None else self.gain
+            window *= np.linspace(previous_gain, gain, window.shape[-1], False)
+            self.gain = gain
+        return audio
+
+
+class SosFilterStage:
+    """
+    A filter in second-order sections format, which keeps its state between blocks
+    """
+    def __init__(self, sos: np.ndarray, num_channels: int = 1):
+        """
+        Initializes the SosFilterStage.
+        :param sos: The filter, in second-order sections format (for example from `scipy.signal.butter`)
+        :param num_channels: The number of channels
+        """
+        self.sos = sos
+        if num_channels > 1:
+            self.zi = np.zeros((sos.shape[0], num_channels, 2))
+        else:
+            self.zi = np.zeros((sos.shape[0], 2))
+
+    def __call__(self, audio: np.ndarray) -> np.ndarray:
+        """
+        Processes a block of audio
+        :param audio: The audio block
+        :return: The processed block
+        """
+        audio, self.zi = scipy.signal.sosfilt(self.sos, audio, zi=self.zi)
+        return audio
+
+
+class FadeStage:
+    """
+    A hanning fade-in and fade-out, for audio with a known number of frames
+    """
+    def __init__(self, num_frames: int, fade_in: int, fade_out: int):
+        """
+        Initializes the FadeStage.
+        :param num_frames: The total number of frames in the audio
+        :param fade_in: The fade-in duration, in frames
+        :param fade_out: The fade-out duration, in frames
+        """
+        self.num_frames = num_frames
+        self.fade_in = np.hanning(fade_in * 2)[:fade_in]
+        self.fade_out = np.hanning(fade_out * 2)[fade_out:]
+        self.position = 0
+
+    def __call__(self, audio: np.ndarray) -> np.ndarray:
+        """
+        Processes a block of audio
+        :param audio: The audio block
+        :return: The processed block
+        """
+        start = self.position
+        end = start + audio.shape[-1]
+        self.position = end
+        audio = audio.copy()
+        fade_in_end = min(end, self.fade_in.shape[-1])
+        if start < fade_in_end:
+            audio[..., :fade_in_end - start] *= self.fade_in[start:fade_in_end]
+        fade_out_start = max(start, self.num_frames - self.fade_out.shape[-1])
+        if fade_out_start < end:
+            offset = self.num_frames - self.fade_out.shape[-1]
+            audio[..., fade_out_start - start:] *= self.fade_out[fade_out_start - offset:end - offset]
+        return audio
+
+
+def render_stream(blocks, path: str, num_frames: int, num_channels: int, stages: list = None, max_db: float = -3.0, sample_rate: int = 44100, bits_per_sample: int = 24):
+    """
+    Processes a sequence of audio blocks and writes them to an audio file. The blocks are
+    written to a temporary file first, so that the final level can be adjusted to `max_db`
+    without keeping the audio in memory.
+    :param blocks: An iterable of audio blocks
+    :param path: The output file path
+    :param num_frames: The total number of frames
+    :param num_channels: The number of channels
+    :param stages: A list of stages to apply to each block, in order. If None, no stages will be applied.
+    :param max_db: The peak level of the output file
+    :param sample_rate: The sample rate
+    :param bits_per_sample: The bit depth of the output file
+    """
+    temp_path = path + ".tmp"
+    peak = 0.0
+    try:
+        # Pass 1: process the blocks and store them as interleaved float32
+        with open(temp_path, "wb") as temp_file:
+            for block in blocks:
+                if stages is not None:
+                    for stage in stages:
+                        block = stage(block)
+                block = block.reshape((num_channels, block.shape[-1]))
+                peak = max(peak, float(np.max(np.abs(block))))
+                block.T.astype(np.float32).tofile(temp_file)
+
+        # Pass 2: adjust the level and write the output file
+        gain = 10 ** (max_db / 20) / peak if peak > 0 else 0.0
+        temp_audio = np.memmap(temp_path, dtype=np.float32, mode="r", shape=(num_frames, num_channels))
+        block_size = 65536
+        with pb.io.AudioFile(path, "w", sample_rate, num_channels, bit_depth=bits_per_sample) as audio_file:
+            for i in range(0, num_frames, block_size):
+                audio_file.write(np.ascontiguousarray(temp_audio[i:i+block_size].T) * np.float32(gain))
+        del temp_audio
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
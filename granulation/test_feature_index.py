@@ -0,0 +1,39 @@
+"""
+File: test_feature_index.py
+
+Description: Tests for feature_index.py. Run `python -m pytest` in this directory.
+"""
+
+import feature_index
+import numpy as np
+import sqlite3
+
+
+def test_feature_index(grain_db, tmp_path):
+    """
+    The nearest grains match a brute-force search, and the saved index is loaded rather than rebuilt
+    """
+    index_path = str(tmp_path / "grains.features.pickle")
+    index = feature_index.load_feature_index(grain_db, index_path, where="length = 8192")
+    loaded = feature_index.load_feature_index(grain_db, index_path, where="length = 8192")
+    assert np.array_equal(loaded.records["id"], index.records["id"])
+
+    db = sqlite3.connect(grain_db)
+    cursor = db.cursor()
+    cursor.execute("SELECT id, spectral_flatness, spectral_roll_off_75 FROM grains WHERE length = 8192;")
+    records = cursor.fetchall()
+    db.close()
+    brute_ids = np.array([record[0] for record in records])
+    brute_features = np.array([record[1:] for record in records])
+    assert np.array_equal(np.sort(index.records["id"]), np.sort(brute_ids))
+
+    k = 50
+    targets = np.stack((np.linspace(0.01, 0.5, 7), np.linspace(150, 1400, 7)), axis=-1)
+    distances, indices = index.query(targets, k)
+    brute_distances = np.linalg.norm(index.normalize(brute_features)[None, :, :] - index.normalize(targets)[:, None, :], axis=-1)
+    order = np.argsort(brute_ids)
+    for i in range(len(targets)):
+        assert np.allclose(np.sort(brute_distances[i])[:k], distances[i])
+        # The grains that were found are at those distances
+        found = order[np.searchsorted(brute_ids, index.records["id"][indices[i]], sorter=order)]
+        assert np.allclose(brute_distances[i][found], distances[i])
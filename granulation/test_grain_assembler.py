@@ -0,0 +1,82 @@
+"""
+File: test_grain_assembler.py
+
+Description: Tests for grain_assembler.py. Run `python -m pytest` in this directory.
+"""
+
+from benchmarks import _interleave_loop, _interpolate_loop, _make_grains, _merge_grain_python, _merge_loop
+import grain_assembler
+import grain_tools
+from grain_table import GrainTable
+import numpy as np
+import pytest
+
+
+MAX_LENGTH = 69
+
+
+@pytest.mark.parametrize("num_channels", [1, 2])
+def test_merge(num_channels):
+    """
+    The batched merge matches the per-grain loop with the original Python `merge_grain`,
+    and with the compiled `merge_grain` if grain_tools is compiled
+    """
+    grains = _make_grains(2000, 512, num_channels)
+    audio = grain_assembler.merge(grains, num_channels)
+    assert np.allclose(audio, _merge_loop(grains, num_channels, merge_grain=_merge_grain_python))
+    if grain_tools.COMPILED:
+        assert np.allclose(audio, _merge_loop(grains, num_channels, merge_grain=grain_tools.merge_grain))
+
+
+@pytest.mark.parametrize("merge_fraction", [0.1, 0.5, 0.9])
+def test_merge_crossfade(merge_fraction):
+    """
+    Crossfading all of the sections at once matches crossfading them one pair at a time
+    """
+    rng = np.random.default_rng(0)
+    sections = [rng.uniform(-1, 1, (2, int(rng.integers(500, 5000)))) for _ in range(20)]
+    expected = sections[0]
+    for section in sections[1:]:
+        expected = grain_tools.crossfade(expected, section, merge_fraction)
+    assert np.array_equal(grain_assembler.merge_crossfade(sections, merge_fraction), expected)
+
+
+def test_interleave_order():
+    """
+    The interleave order matches the list-slicing version for every pair of list lengths up to MAX_LENGTH.
+    The orders of all of the pairs are calculated with one call.
+    """
+    lengths = np.arange(1, MAX_LENGTH + 1)
+    len1 = np.repeat(lengths, MAX_LENGTH)
+    len2 = np.tile(lengths, MAX_LENGTH)
+    # The order of each pair indexes into that pair's lists, after the lists of the pairs before it
+    offsets = np.cumsum(len1 + len2) - (len1 + len2)
+    orders = np.split(grain_assembler._interleave_order(len1, len2), np.cumsum(len1 + len2)[:-1])
+    for length1, length2, offset, order in zip(len1.tolist(), len2.tolist(), offsets.tolist(), orders):
+        expected = _interleave_loop(list(range(length1)), list(range(length1, length1 + length2)))
+        assert (order - offset).tolist() == expected, f"{length1} + {length2} grains"
+
+
+@pytest.mark.parametrize("interpolations", [None, 1, 3, 10])
+def test_interpolate_order(interpolations):
+    """
+    The interpolate order matches the list-slicing version for every pair of list lengths up to MAX_LENGTH
+    """
+    for length1 in range(1, MAX_LENGTH + 1):
+        for length2 in range(1, MAX_LENGTH + 1):
+            expected = _interpolate_loop(list(range(length1)), list(range(length1, length1 + length2)), interpolations)
+            assert grain_assembler._interpolate_order(length1, length2, interpolations).tolist() == expected, \
+                f"{length1} + {length2} grains"
+
+
+@pytest.mark.parametrize("fn, loop_fn", [(grain_assembler.interleave, _interleave_loop),
+                                         (grain_assembler.interpolate, _interpolate_loop)])
+def test_interpolate_lists_and_tables(fn, loop_fn):
+    """
+    Lists and GrainTables are reordered the same way as the list-slicing version
+    """
+    list1 = list(range(1000))
+    list2 = list(range(1000, 1700))
+    expected = loop_fn(list1, list2)
+    assert fn(list1, list2) == expected
+    assert np.array_equal(fn(GrainTable([], np.array(list1)), GrainTable([], np.array(list2))).grain, expected)
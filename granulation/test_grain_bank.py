@@ -0,0 +1,55 @@
+"""
+File: test_grain_bank.py
+
+Description: Tests for grain_bank.py. Run `python -m pytest` in this directory.
+"""
+
+import grain_bank
+import grain_sql
+import numpy as np
+
+
+def test_grain_bank(audio_library, tmp_path):
+    """
+    The bank audio matches the source files, and grains whose rows changed after the export are read from the source files
+    """
+    source_dir, db_path = audio_library
+    bank_path = str(tmp_path / "grains.bank")
+    db, cursor = grain_sql.connect_to_db(db_path)
+    grain_bank.export_grain_bank(cursor, bank_path, source_dir)
+    records = grain_sql.select_categories(cursor, ["1"], grain_sql.RENDER_FIELDS)[0]
+    db.close()
+    bank = grain_bank.open_grain_bank(bank_path)
+    assert len(bank) == len(records)
+    selection = np.random.default_rng(0).integers(0, len(records), 400)
+
+    expected = grain_sql.realize_grains(grain_sql.record_dicts(records, selection), source_dir)
+    assert (bank.matching_positions(grain_sql.record_dicts(records, selection)) >= 0).all()
+    grains = grain_sql.realize_grains(grain_sql.record_dicts(records, selection), source_dir, bank=bank)
+    for expected_grain, grain in zip(expected, grains):
+        assert np.array_equal(expected_grain["grain"], grain["grain"]), grain["id"]
+
+    # Every other grain is moved by 100 frames, and every third grain is moved to another file
+    changed = records[selection].copy()
+    changed["start_frame"][::2] += 100
+    changed["end_frame"][::2] += 100
+    changed["file_id"][1::3] = changed["file_id"][1::3] % changed["file_id"].max() + 1
+    changed["file"][1::3] = [records["file"][records["file_id"] == file_id][0] for file_id in changed["file_id"][1::3]]
+    grain_entries = grain_sql.record_dicts(changed, np.arange(len(changed)))
+    stale = (np.arange(len(changed)) % 2 == 0) | (np.arange(len(changed)) % 3 == 1)
+    assert np.array_equal(bank.matching_positions(grain_entries) < 0, stale)
+    expected = grain_sql.realize_grains(grain_sql.record_dicts(changed, np.arange(len(changed))), source_dir)
+    grains = grain_sql.realize_grains(grain_entries, source_dir, bank=bank)
+    for expected_grain, grain in zip(expected, grains):
+        assert np.array_equal(expected_grain["grain"], grain["grain"]), grain["id"]
+
+
+def test_open_grain_bank(tmp_path):
+    """
+    A missing or unreadable bank file is not used
+    """
+    bank_path = str(tmp_path / "grains.bank")
+    assert grain_bank.open_grain_bank(bank_path) is None
+    with open(bank_path, "wb") as bank_file:
+        bank_file.write(b"not a grain bank")
+    assert grain_bank.open_grain_bank(bank_path) is None
@@ -0,0 +1,34 @@
+"""
+File: test_grain_features.py
+
+Description: Tests for grain_features.py. Run `python -m pytest` in this directory.
+"""
+
+import grain_features
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize("grain_length", [2048, 8192])
+def test_analyze_file_grains(grain_length):
+    """
+    The batched features match analyzing each grain separately, and silent grains are left out
+    """
+    sample_rate = 44100
+    seconds = 3
+    rng = np.random.default_rng(0)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    samples = 0.5 * np.sin(2 * np.pi * 220 * t) * (t < seconds / 3) + 0.2 * rng.standard_normal(t.shape) * (t > seconds / 2)
+    hop = grain_length // 2
+    expected_starts = []
+    expected = []
+    for grain_start in grain_features.slice_grains(samples.shape[-1], grain_length, hop):
+        features = grain_features.analyze_grain(samples[grain_start:grain_start + grain_length], sample_rate)
+        if features is not None:
+            expected_starts.append(grain_start)
+            expected.append([np.nan if features[field] is None else features[field] for field in grain_features.FEATURE_FIELDS])
+    # A small chunk size, so that the grains span several chunks
+    starts, features = grain_features.analyze_file_grains(samples, sample_rate, grain_length, hop, chunk_size=16)
+    assert len(expected_starts) < len(grain_features.slice_grains(samples.shape[-1], grain_length, hop))
+    assert np.array_equal(starts, expected_starts)
+    assert np.allclose(np.array(expected), features, rtol=1e-9, atol=1e-12, equal_nan=True)
@@ -0,0 +1,159 @@
+"""
+File: test_grain_sql.py
+
+Description: Tests for grain_sql.py. Run `python -m pytest` in this directory.
+"""
+
+import grain_sql
+import migrate
+import numpy as np
+import os
+import path_index
+import pytest
+import shutil
+import sqlite3
+
+
+CATEGORIES = [
+    "(length = 8192) AND (spectral_flatness BETWEEN 0.00 AND 0.05) AND (spectral_roll_off_75 BETWEEN 100 AND 2000) AND (frequency IS NULL)",
+    "(length = 8192) AND (spectral_flatness BETWEEN 0.1 AND 0.3) AND (spectral_roll_off_75 BETWEEN 100 AND 6000)",
+    "(length = 8192) AND (spectral_flatness BETWEEN 0.00 AND 0.05) AND (midi BETWEEN 68.8 AND 69.2)",
+    "length = 1",
+]
+
+
+def test_select_categories(grain_db):
+    """
+    The columnar categories have the same values as one dictionary per row
+    """
+    db = sqlite3.connect(grain_db)
+    cursor = db.cursor()
+    categories = grain_sql.select_categories(cursor, CATEGORIES)
+    render_categories = grain_sql.select_categories(cursor, CATEGORIES, grain_sql.RENDER_FIELDS)
+    for i, predicate in enumerate(CATEGORIES):
+        cursor.execute(f"SELECT {', '.join(grain_sql.FIELDS)} FROM grains WHERE {predicate};")
+        dict_category = [dict(zip(grain_sql.FIELDS, record)) for record in cursor.fetchall()]
+        assert len(categories[i]) == len(dict_category) and len(render_categories[i]) == len(dict_category)
+        for field in grain_sql.FIELDS:
+            expected = [grain[field] for grain in dict_category]
+            if field == "file":
+                assert categories[i][field].tolist() == expected
+            else:
+                assert np.array_equal(np.array(expected, dtype=categories[i].dtype[field]), categories[i][field], equal_nan=True), field
+            if field in grain_sql.RENDER_FIELDS:
+                assert render_categories[i][field].tolist() == categories[i][field].tolist(), field
+    db.close()
+
+
+SAMPLE_CATEGORIES = [
+    "length = 8192",
+    "(length = 8192) AND (spectral_flatness BETWEEN 0.00 AND 0.01)",
+    "(length = 8192) AND (spectral_flatness BETWEEN 0.00 AND 0.05) AND (midi BETWEEN 60 AND 69.2)",
+    "(length = 8192) AND (spectral_flatness BETWEEN 0.00 AND 0.05) AND (midi BETWEEN 68 AND 69.2)",
+]
+
+
+@pytest.mark.parametrize("predicate", SAMPLE_CATEGORIES)
+@pytest.mark.parametrize("k", [5, 100])
+def test_sample_grains(grain_db, predicate, k):
+    """
+    The sample is k distinct grains of the category (or the whole category, if it is smaller), without the
+    excluded grains, and the same seed draws the same sample
+    """
+    exclude = ["file LIKE '%file_1%'"]
+    db = sqlite3.connect(grain_db)
+    cursor = db.cursor()
+    category = grain_sql.select_categories(cursor, [f"({predicate}) AND NOT ({exclude[0]})"], ["id"])[0]
+    for seed in range(5):
+        sample = grain_sql.sample_grains(cursor, predicate, k, seed, exclude)
+        assert len(sample) == min(k, len(category))
+        assert len(np.unique(sample["id"])) == len(sample)
+        assert np.isin(sample["id"], category["id"]).all()
+        assert np.array_equal(sample, grain_sql.sample_grains(cursor, predicate, k, seed, exclude))
+    db.close()
+
+
+@pytest.mark.parametrize("predicate", SAMPLE_CATEGORIES[2:])
+def test_sample_grains_uniform(grain_db, predicate):
+    """
+    Every grain of a small category is drawn about equally often
+    """
+    k = 5
+    num_draws = 2000
+    db = sqlite3.connect(grain_db)
+    cursor = db.cursor()
+    category = np.sort(grain_sql.select_categories(cursor, [predicate], ["id"])[0]["id"])
+    counts = np.zeros(len(category))
+    for seed in range(num_draws):
+        counts[np.searchsorted(category, grain_sql.sample_grains(cursor, predicate, k, seed, fields=["id"])["id"])] += 1
+    db.close()
+    # Each grain is in a sample with probability min(k, len(category)) / len(category)
+    probability = min(k, len(category)) / len(category)
+    tolerance = 5 * np.sqrt(num_draws * probability * (1 - probability))
+    assert np.all(np.abs(counts - num_draws * probability) <= tolerance), counts
+
+
+def test_update_grain_root(grain_db, tmp_path):
+    """
+    Moving the library changes the path of every grain under the root directory, and nothing else
+    """
+    path = str(tmp_path / "grains.sqlite3")
+    shutil.copyfile(grain_db, path)
+    db, cursor = grain_sql.connect_to_db(path)
+    cursor.execute("SELECT id, file FROM grains ORDER BY id;")
+    expected = [(grain_id, os.path.join("/new/samples", file.split("samples/")[1])) for grain_id, file in cursor.fetchall()]
+    cursor.execute("SELECT COUNT(*) FROM grain_data;")
+    num_grains = cursor.fetchone()[0]
+    grain_sql.update_grain_root(cursor, "samples", "/new/samples")
+    db.commit()
+    cursor.execute("SELECT id, file FROM grains ORDER BY id;")
+    assert cursor.fetchall() == expected
+    cursor.execute("SELECT COUNT(*) FROM grain_data;")
+    assert cursor.fetchone()[0] == num_grains
+    db.close()
+
+
+def test_update_grain_root_collisions(tmp_path):
+    """
+    Files that would collide are skipped instead of failing on the UNIQUE constraint of the files table,
+    with and without a PathIndex
+    """
+    library = str(tmp_path / "library")
+    for path in ["a/take1.wav", "b/take1.wav", "deep/moved.wav"]:
+        os.makedirs(os.path.dirname(os.path.join(library, path)), exist_ok=True)
+        open(os.path.join(library, path), "w").close()
+    os.makedirs(tmp_path / "elsewhere")
+    open(tmp_path / "elsewhere" / "outside.wav", "w").close()
+    index = path_index.PathIndex(str(tmp_path / "paths.sqlite3"))
+    index.refresh([library, str(tmp_path / "elsewhere")])
+    new_root = os.path.join(library, "")
+    files = [
+        ("C:\\old\\samples\\a\\", "take1.wav"),       # Same name as the next file: resolved by relative path
+        ("C:\\old\\samples\\b\\", "take1.wav"),
+        ("/old/samples/", "moved.wav"),               # Moved within the library: resolved with the index
+        ("/old/samples/", "outside.wav"),             # Only in the index outside the library: relative path
+        ("/old/samples/", "twice.wav"),               # Two roots collapse into one: both skipped
+        ("/older/samples/", "twice.wav"),
+        ("/old/samples/", "kept.wav"),                # Collides with a file that is not moved: skipped
+        (new_root, "kept.wav"),
+    ]
+    for use_index in [False, True]:
+        db = sqlite3.connect(":memory:")
+        cursor = db.cursor()
+        cursor.execute(migrate.FILES_TABLE)
+        cursor.executemany("INSERT INTO files (root, path) VALUES(?, ?);", files)
+        grain_sql.update_grain_root(cursor, "samples", library, index if use_index else None)
+        cursor.execute("SELECT id, root, path FROM files ORDER BY id;")
+        result = {file_id: (root, path) for file_id, root, path in cursor.fetchall()}
+        assert result == {
+            1: (new_root, "a/take1.wav"),
+            2: (new_root, "b/take1.wav"),
+            3: (os.path.join(library, "deep", ""), "moved.wav") if use_index else (new_root, "moved.wav"),
+            4: (new_root, "outside.wav"),
+            5: files[4],
+            6: files[5],
+            7: files[6],
+            8: files[7],
+        }, f"use_index={use_index}"
+        db.close()
+    index.close()
@@ -0,0 +1,51 @@
+"""
+File: test_grain_tools.py
+
+Description: Tests for grain_tools.py. These run with the NumPy versions, and also with the compiled kernels
+after grain_tools is built (`python setup.py build_ext --inplace`). Run `python -m pytest` in this directory.
+"""
+
+import grain_tools
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize("num_threads", [1, 3, 0])
+def test_merge_grains(num_threads):
+    """
+    The tiled merge (with any number of threads) matches the NumPy scatter-add
+    """
+    rng = np.random.default_rng(0)
+    grains = rng.uniform(-1, 1, (5000, 512))
+    start_indices = np.sort(rng.integers(0, 5000 * 512 // 8, 5000))
+    expected = np.zeros((int(start_indices.max()) + 512 + 100))
+    grain_tools._merge_grains_numpy(expected, grains, start_indices)
+    audio = np.zeros(expected.shape)
+    grain_tools.merge_grains(audio, grains, start_indices, num_threads)
+    assert np.array_equal(audio, expected)
+
+
+@pytest.mark.parametrize("start_indices", [[-1, 0, 10], [0, 10, 91]])
+def test_merge_grains_outside(start_indices):
+    """
+    Grains that don't fit in the audio are rejected rather than wrapped around or written out of bounds
+    """
+    audio = np.zeros((100))
+    with pytest.raises(ValueError):
+        grain_tools.merge_grains(audio, np.ones((3, 10)), np.array(start_indices))
+    assert not audio.any()
+
+
+def test_crossfade_sections():
+    """
+    Crossfading the sections in one pass matches crossfading them one pair at a time with NumPy
+    """
+    rng = np.random.default_rng(0)
+    sections = [rng.uniform(-1, 1, (2, int(rng.integers(500, 5000)))) for _ in range(50)]
+    expected = sections[0]
+    for section in sections[1:]:
+        overlap_len = int(min(expected.shape[-1], section.shape[-1]) * 0.5)
+        x = np.linspace(0, np.pi / 2, overlap_len, False)
+        expected = np.hstack((expected[:, :-overlap_len], expected[:, -overlap_len:] * np.cos(x) + section[:, :overlap_len] * np.sin(x),
+                              section[:, overlap_len:]))
+    assert np.allclose(grain_tools.crossfade_sections(sections, 0.5), expected, rtol=0, atol=1e-12)
@@ -0,0 +1,39 @@
+"""
+File: test_grain_transforms.py
+
+Description: Tests for grain_transforms.py. Run `python -m pytest` in this directory.
+"""
+
+from benchmarks import _transform_loops
+from grain_table import GrainTable
+import grain_transforms
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize("num_grains", [1, 2, 10, 1000])
+@pytest.mark.parametrize("n, m", [(8, 3), (2, 1), (5, 5)])
+def test_transforms(num_grains, n, m):
+    """
+    The transforms match the list loops, on lists of grain dictionaries and on GrainTables
+    """
+    seed = 0
+    prob = 0.1
+    grains = [{"grain": i, "channel": 0, "distance_between_grains": 0} for i in range(num_grains)]
+    # The transforms draw from one generator, in the same order as the loops
+    rng = np.random.default_rng(seed)
+    swaps = rng.random(num_grains - 1) < prob
+    deviations = rng.integers(-40, 41, num_grains)
+    expected = [dict(grain) for grain in grains]
+    _transform_loops(expected, swaps, deviations, n, m)
+
+    table = GrainTable([], np.arange(num_grains))
+    for sequence in (grains, table):
+        rng = np.random.default_rng(seed)
+        grain_transforms.swap_nth_m_pair(sequence, n, m)
+        grain_transforms.swap_random_pair(sequence, prob, rng)
+        grain_transforms.randomize_param(sequence, "distance_between_grains", 40, rng=rng)
+        grain_transforms.delete_nth_grains(sequence, n)
+    assert grains == expected
+    assert np.array_equal(table.grain, [grain["grain"] for grain in expected])
+    assert np.array_equal(table.distance_between_grains, [grain["distance_between_grains"] for grain in expected])
@@ -0,0 +1,41 @@
+"""
+File: test_ingest.py
+
+Description: Tests for ingest.py. Run `python -m pytest` in this directory.
+"""
+
+import grain_sql
+import ingest
+import migrate
+import sqlite3
+
+
+def _grain_rows(db_path: str) -> list:
+    """
+    Gets the grain rows of a database, without the ids (which depend on the order that the workers finish in)
+    :param db_path: The database path
+    :return: The sorted rows
+    """
+    db = sqlite3.connect(db_path)
+    cursor = db.cursor()
+    cursor.execute(f"SELECT {', '.join(migrate.GRAINS_COLUMNS[1:])} FROM grains;")
+    rows = sorted(cursor.fetchall(), key=repr)
+    db.close()
+    return rows
+
+
+def test_ingest(audio_library, tmp_path):
+    """
+    Several worker processes ingest the same grains as one, and ingested files are not ingested again
+    """
+    source_dir, expected_path = audio_library
+    db_path = str(tmp_path / "grains.sqlite3")
+    stats = ingest.ingest(db_path, source_dir, grain_lengths=[8192], num_workers=2)
+    rows = _grain_rows(db_path)
+    assert stats["grains"] == len(rows) and len(rows) > 0
+    assert rows == _grain_rows(expected_path)
+    assert ingest.ingest(db_path, source_dir, grain_lengths=[8192], num_workers=2)["files"] == 0
+    assert len(_grain_rows(db_path)) == len(rows)
+    db, cursor = grain_sql.connect_to_db(db_path)
+    assert migrate.get_version(cursor) == len(migrate.MIGRATIONS)
+    db.close()
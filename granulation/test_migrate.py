@@ -0,0 +1,45 @@
+"""
+File: test_migrate.py
+
+Description: Tests for migrate.py. Run `python -m pytest` in this directory.
+"""
+
+from benchmarks import _make_grain_db
+import migrate
+import sqlite3
+
+
+def test_migrate(tmp_path):
+    """
+    Each migration keeps the results of the common queries, and the latest version answers them with an index
+    """
+    path = str(tmp_path / "grains.sqlite3")
+    _make_grain_db(path, 20_000)
+    db = sqlite3.connect(path)
+    cursor = db.cursor()
+    expected = None
+    for version in range(1, len(migrate.MIGRATIONS) + 1):
+        migrate.migrate(db, cursor, version)
+        assert migrate.get_version(cursor) == version
+        results = []
+        for query in migrate.QUERIES:
+            # Version 3 adds the file_id column
+            cursor.execute(query.replace("SELECT *", f"SELECT {', '.join(migrate.GRAINS_COLUMNS)}"))
+            results.append(sorted(cursor.fetchall()))
+        if expected is None:
+            expected = results
+        assert results == expected, f"version {version}"
+    for query in migrate.QUERIES:
+        assert migrate.uses_index(migrate.explain(cursor, query)), query
+    db.close()
+
+
+def test_migrate_latest(grain_db):
+    """
+    Migrating a database that is already at the latest version does nothing
+    """
+    db = sqlite3.connect(grain_db)
+    cursor = db.cursor()
+    migrate.migrate(db, cursor)
+    assert migrate.get_version(cursor) == len(migrate.MIGRATIONS)
+    db.close()
@@ -0,0 +1,35 @@
+"""
+File: test_path_index.py
+
+Description: Tests for path_index.py. Run `python -m pytest` in this directory.
+"""
+
+import grain_sql
+import os
+import path_index
+
+
+def test_path_index(tmp_path):
+    """
+    The index resolves the same paths as walking the directories, and a refresh only lists the changed directories
+    """
+    source_dir = str(tmp_path / "samples")
+    for i in range(20):
+        directory = os.path.join(source_dir, f"group_{i % 4}", f"dir_{i}")
+        os.makedirs(directory)
+        for j in range(5):
+            open(os.path.join(directory, f"sample_{i}_{j}.wav"), "w").close()
+    files = [f"C:\\old\\samples\\sample_{i}_{j}.wav" for i in range(20) for j in range(5)] + ["/old/samples/missing.wav"]
+    expected = [grain_sql.find_path(file, source_dir) for file in files]
+
+    index = path_index.PathIndex(path_index.index_path_for(str(tmp_path / "grains.sqlite3")))
+    index.refresh(source_dir)
+    assert index.refresh(source_dir)["listed"] == 0
+    assert [grain_sql.find_path(file, index) for file in files] == expected
+
+    # An added file is found after a refresh, which only lists the changed directory
+    duplicate = os.path.join(source_dir, "group_0", "sample_0_0.wav")
+    open(duplicate, "w").close()
+    assert index.refresh(source_dir)["listed"] == 1
+    assert duplicate in index.duplicates()["sample_0_0.wav"]
+    index.close()
@@ -0,0 +1,63 @@
+"""
+File: test_query_cache.py
+
+Description: Tests for query_cache.py. Run `python -m pytest` in this directory.
+"""
+
+import grain_sql
+import numpy as np
+import os
+import query_cache
+import shutil
+
+
+CATEGORIES = [f"(length = 8192) AND (spectral_flatness BETWEEN {0.02 * i} AND {0.02 * i + 0.1}) AND (spectral_roll_off_75 BETWEEN 100 AND 6000)"
+              for i in range(6)]
+
+
+def test_query_cache(grain_db, tmp_path):
+    """
+    Cached results match the database, are used by later runs, and go stale when the database is written to
+    """
+    path = str(tmp_path / "grains.sqlite3")
+    shutil.copyfile(grain_db, path)
+    db, cursor = grain_sql.connect_to_db(path)
+    expected = grain_sql.select_categories(cursor, CATEGORIES, grain_sql.RENDER_FIELDS)
+    db.close()
+    for hits in [0, len(CATEGORIES)]:
+        # A new connection and cache each time, like a new run of render_interpolator.py
+        db, cursor = grain_sql.connect_to_db(path)
+        cache = query_cache.QueryCache(query_cache.cache_dir_for(path))
+        result = grain_sql.select_categories(cursor, CATEGORIES, grain_sql.RENDER_FIELDS, cache=cache)
+        db.close()
+        assert cache.hits == hits
+        for expected_category, category in zip(expected, result):
+            assert np.array_equal(expected_category, category)
+
+    db, cursor = grain_sql.connect_to_db(path)
+    cursor.execute("DELETE FROM grain_data WHERE id IN (SELECT id FROM grains WHERE length = 8192 LIMIT 1000);")
+    db.commit()
+    cache = query_cache.QueryCache(query_cache.cache_dir_for(path), 2 ** 16)
+    changed = grain_sql.select_categories(cursor, CATEGORIES, grain_sql.RENDER_FIELDS, cache=cache)
+    db.close()
+    assert cache.hits == 0
+    assert sum(len(category) for category in changed) < sum(len(category) for category in expected)
+    # The least recently used results were removed to fit in the smaller size limit
+    assert sum(os.path.getsize(os.path.join(cache.cache_dir, name)) for name in os.listdir(cache.cache_dir)) <= cache.max_bytes
+
+
+def test_sample_grains_cache(grain_db, tmp_path):
+    """
+    Cached samples match the samples drawn from the database, and are only used for the same seed
+    """
+    cache = query_cache.QueryCache(str(tmp_path / "cache"))
+    db, cursor = grain_sql.connect_to_db(grain_db)
+    for seed in [0, [1, 2]]:
+        expected = grain_sql.sample_grains(cursor, CATEGORIES[0], 20, seed)
+        for hits in [cache.hits, cache.hits + 1]:
+            assert np.array_equal(grain_sql.sample_grains(cursor, CATEGORIES[0], 20, seed, cache=cache), expected)
+            assert cache.hits == hits
+    # A Generator can't be part of the key, so it is not cached
+    grain_sql.sample_grains(cursor, CATEGORIES[0], 20, np.random.default_rng(0), cache=cache)
+    assert cache.hits + cache.misses == 4
+    db.close()
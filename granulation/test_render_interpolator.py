@@ -0,0 +1,40 @@
+"""
+File: test_render_interpolator.py
+
+Description: Tests for render_interpolator.py. Run `python -m pytest` in this directory.
+"""
+
+import grain_sql
+import os
+import random
+import render_interpolator
+
+
+def test_select_grains():
+    """
+    The selection is distinct indices of each category, and all of a category that is smaller than the number of grains
+    """
+    categories = [list(range(100)), list(range(3)), []]
+    for seed in range(20):
+        selections = render_interpolator.select_grains(categories, 10, random.Random(seed))
+        assert [len(selection) for selection in selections] == [10, 3, 0]
+        for category, selection in zip(categories, selections):
+            assert len(set(selection)) == len(selection) and set(selection) <= set(range(len(category)))
+
+
+def test_render_prefetch(audio_library, tmp_path):
+    """
+    Prefetching the next categories doesn't change the render
+    """
+    source_dir, db_path = audio_library
+    db, cursor = grain_sql.connect_to_db(db_path)
+    categories = grain_sql.select_categories(cursor, [f"file_id % 3 = {i}" for i in range(3)], grain_sql.RENDER_FIELDS)
+    db.close()
+    outputs = []
+    for prefetch in (0, 2):
+        name = f"prefetch_{prefetch}.wav"
+        render_interpolator.render(categories, 20, 2, -4050, 2, source_dir, str(tmp_path), name, block_size=44100 * 2,
+                                   seed=0, prefetch=prefetch)
+        with open(os.path.join(tmp_path, name), "rb") as audio_file:
+            outputs.append(audio_file.read())
+    assert len(outputs[0]) > 0 and outputs[0] == outputs[1]
@@ -0,0 +1,57 @@
+"""
+File: test_source_store.py
+
+Description: Tests for source_store.py. Run `python -m pytest` in this directory.
+"""
+
+import grain_sql
+import json
+import numpy as np
+import os
+import shutil
+import source_store
+
+
+def test_source_store_after_update_grain_root(audio_library, tmp_path):
+    """
+    The store is keyed by file id, so it still serves every grain after the library is moved,
+    and stores that were keyed by file name are re-keyed
+    """
+    source_dir, grain_db = audio_library
+    db_path = str(tmp_path / "grains.sqlite3")
+    shutil.copyfile(grain_db, db_path)
+    store_dir = str(tmp_path / "store")
+    db, cursor = grain_sql.connect_to_db(db_path)
+    store = source_store.build_source_store(cursor, source_dir, store_dir)
+    records = grain_sql.select_categories(cursor, ["1"], grain_sql.RENDER_FIELDS)[0]
+    selection = np.arange(0, len(records), 7)
+    expected = grain_sql.realize_grains(grain_sql.record_dicts(records, selection), source_dir)
+
+    # An index keyed by file name, like the stores made before the store was keyed by file id, with an entry for a file that is gone
+    index = {entry["file"]: {key: value for key, value in entry.items() if key != "file"} for entry in store.index.values()}
+    open(os.path.join(store_dir, "gone.f32"), "wb").close()
+    index["/nowhere/gone.wav"] = {"path": "gone.f32", "num_channels": 1, "num_frames": 0, "sample_rate": 44100}
+    with open(os.path.join(store_dir, source_store.SourceStore.INDEX_FILE), "w") as index_file:
+        index_file.write(json.dumps(index))
+    store = source_store.build_source_store(cursor, source_dir, store_dir)
+    cursor.execute("SELECT id FROM files;")
+    assert sorted(store.index) == sorted(str(record[0]) for record in cursor.fetchall())
+    assert not os.path.exists(os.path.join(store_dir, "gone.f32"))
+
+    # The source files are not available after the move, so every grain must come from the store
+    new_dir = str(tmp_path / "moved")
+    grain_sql.update_grain_root(cursor, os.path.basename(source_dir), new_dir)
+    db.commit()
+    records = grain_sql.select_categories(cursor, ["1"], grain_sql.RENDER_FIELDS)[0]
+    grains = grain_sql.realize_grains(grain_sql.record_dicts(records, selection), new_dir, source_store.SourceStore(store_dir))
+    for expected_grain, grain in zip(expected, grains):
+        assert grain != 0 and grain["file"].startswith(new_dir) and np.array_equal(expected_grain["grain"], grain["grain"])
+
+    # Rebuilding the store updates the file names, which are used for records without a file id
+    store = source_store.build_source_store(cursor, new_dir, store_dir)
+    assert all(entry["file"].startswith(new_dir) for entry in store.index.values())
+    grain_entries = [{key: value for key, value in grain.items() if key != "file_id"} for grain in grain_sql.record_dicts(records, selection)]
+    grains = grain_sql.realize_grains(grain_entries, new_dir, store)
+    for expected_grain, grain in zip(expected, grains):
+        assert grain != 0 and np.array_equal(expected_grain["grain"], grain["grain"])
+    db.close()